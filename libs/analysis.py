@@ -1,40 +1,66 @@
+from dask.base import tokenize
+import dask
+import dask.array
 import datetime
+import libs.comoments
+import libs.memo
 import libs.plot
 import libs.vars
+import numpy as np
+import pandas
 import xarray
 xarray.set_options(keep_attrs=True);
 
+# Last cube computed by composite_cube(), kept in memory for repeated plots
+_composite_cubes = {}
+
 def calc_diffs(ds, unit, relative=False, verbose=True):
-    delta_obj = {}
-    for v in ds:
-        clim_mean = float(ds[v].sel(year=slice('1980', '2010')).mean('year'))
-        end_mean = float(ds[v].sel(year=slice('2080', '2100')).mean('year'))
-        delta = end_mean - clim_mean
-        delta_unit = unit
-
-        if relative:
-            delta = (100 * end_mean / clim_mean) - 100
-            delta_unit = '%'
-
-        if v != 'Ensemble mean':
-            delta_obj[v] = delta
-
-        verbose and print(
-            v,
-            f'-> 1980-2010: {clim_mean:.2f}{unit}',
-            f'-> 2080-2100: {end_mean:.2f}{unit}',
-            f'-> delta: {delta:.2f}{delta_unit}',
-            sep='\n'
-        )
+    '''
+    Function: calc_diffs()
+        Calculate the change of each member between 1980-2010 and 2080-2100,
+        and the mean, median and range of the member changes (see
+        change_statistics()). Previously 'median' was the midrange, which is
+        now returned as 'midrange'.
 
-    delta_list = list(delta_obj.values())
-    arr_min = min(delta_list)
-    arr_max = max(delta_list)
+    Inputs:
+    - ds (xarray.Dataset): annual data, with one variable per member
+    - unit (string): unit of data
+    - relative (bool): whether to calculate relative (%) changes
+        default: False
+    - verbose (bool): whether to print the changes
+        default: True
+
+    Outputs:
+    - (dict): {
+            'delta': (dict), 'mean': (float), 'median': (float),
+            'midrange': (float), 'range': (string)
+        }
+    '''
+    statistics = change_statistics(ds, unit)
+    members = statistics['members']
+    quantity = 'delta_relative' if relative else 'delta'
+    delta_unit = '%' if relative else unit
+
+    if verbose:
+        for row in members.itertuples():
+            print(
+                row.member,
+                f'-> 1980-2010: {row.baseline:.2f}{unit}',
+                f'-> 2080-2100: {row.future:.2f}{unit}',
+                f'-> delta: {getattr(row, quantity):.2f}{delta_unit}',
+                sep='\n'
+            )
+
+    summary = statistics['summary'].set_index('quantity').loc[quantity]
     analysis = {
-        'delta': delta_obj,
-        'mean': sum(delta_list) / len(delta_list),
-        'median': arr_min + ((arr_max - arr_min) / 2),
-        'range': f'{arr_min} - {arr_max}'
+        'delta': {
+            row.member: float(getattr(row, quantity))
+            for row in members.itertuples() if row.member != 'Ensemble mean'
+        },
+        'mean': float(summary['mean']),
+        'median': float(summary['median']),
+        'midrange': float(summary['min'] + (summary['max'] - summary['min']) / 2),
+        'range': f'{summary["min"]} - {summary["max"]}'
     }
 
     if verbose:
@@ -47,6 +73,115 @@ def calc_diffs(ds, unit, relative=False, verbose=True):
     return analysis
 
 
+def change_statistics(
+    variables,
+    unit='',
+    baseline=slice('1980', '2010'),
+    future=slice('2080', '2100'),
+    dim='year',
+    quantiles=[0.05, 0.25, 0.75, 0.95],
+    verbose=False
+):
+    '''
+    Function: change_statistics()
+        Calculate the change between a baseline and future period for every
+        variable, member (and e.g. region) at once, with a single
+        dask.compute, and summarise the spread of member changes
+
+    Inputs:
+    - variables (xarray or dict): data with one variable per member (e.g.
+        from libs.local.get_ensemble_series(), optionally with an 'Ensemble
+        mean' variable), or stacked (see libs.ensemble.stack()), or a dict of
+        either, keyed by variable name. Any other dimensions (e.g. region)
+        are kept as columns.
+    - unit (string or dict): unit of data, or a dict of units keyed as
+        variables
+        default: ''
+    - baseline (slice): baseline period
+        default: slice('1980', '2010')
+    - future (slice): future period
+        default: slice('2080', '2100')
+    - dim (string): time dimension
+        default: 'year'
+    - quantiles (array): quantiles of member changes to summarise
+        default: [0.05, 0.25, 0.75, 0.95]
+    - verbose (bool): whether to print a report
+        default: False
+
+    Outputs:
+    - (dict): {
+            'members': (pandas.DataFrame), 'summary': (pandas.DataFrame)
+        }
+        where 'members' has a row for each variable, member (and e.g.
+        region), with columns baseline, future, delta, delta_relative (%)
+        and unit, and 'summary' has a row for each variable (and e.g.
+        region) and quantity (delta/delta_relative), with columns count,
+        mean, median, min, max, std and each quantile (e.g. q05), over
+        members excluding 'Ensemble mean'
+    '''
+    if type(variables) != dict:
+        variables = { '': variables }
+
+    means = {}
+    for key, data in variables.items():
+        if type(data) == xarray.Dataset:
+            data = data.to_array('member')
+
+        data = data.reset_coords(drop=True)
+        means[key] = (
+            data.sel({ dim: baseline }).mean(dim),
+            data.sel({ dim: future }).mean(dim)
+        )
+
+    # One compute for all variables, so shared inputs are only read once
+    means = dask.compute(means)[0]
+
+    tables = []
+    for key, (baseline_mean, future_mean) in means.items():
+        table = xarray.Dataset({
+            'baseline': baseline_mean,
+            'future': future_mean,
+            'delta': future_mean - baseline_mean,
+            'delta_relative': 100 * future_mean / baseline_mean - 100
+        }).to_dataframe().reset_index()
+        table.insert(0, 'variable', key)
+        table['unit'] = unit.get(key, '') if type(unit) == dict else unit
+        tables.append(table)
+
+    members = pandas.concat(tables, ignore_index=True)
+    group_by = [c for c in members.columns if c not in ['member', 'baseline', 'future', 'delta', 'delta_relative', 'unit']]
+
+    rows = []
+    for keys, group in members[members.member != 'Ensemble mean'].groupby(group_by, dropna=False, sort=False):
+        for quantity in ['delta', 'delta_relative']:
+            values = group[quantity].dropna()
+            rows.append({
+                **dict(zip(group_by, keys)),
+                'quantity': quantity,
+                'count': len(values),
+                'mean': values.mean(),
+                'median': values.median(),
+                'min': values.min(),
+                'max': values.max(),
+                'std': values.std(),
+                **{ f'q{round(q * 100):02d}': values.quantile(q) for q in quantiles }
+            })
+
+    summary = pandas.DataFrame(rows)
+
+    if verbose:
+        with pandas.option_context(
+            'display.max_columns', None,
+            'display.max_rows', None,
+            'display.precision', 2,
+            'display.width', 200
+        ):
+            print(members, '', summary, '', sep='\n')
+
+    return { 'members': members, 'summary': summary }
+
+
+@libs.memo.memoize
 def calendar_division_mean(data, time, division='month'):
     '''
     Function: calendar_division_mean()
@@ -79,6 +214,7 @@ def calendar_division_mean(data, time, division='month'):
         .mean(dim=('time'), skipna=True)
 
 
+@libs.memo.memoize
 def climatology_monthly(data, date_start, date_end, relative=False):
     baseline = data.sel(time=slice(date_start, date_end))
     period = 'time.month'
@@ -100,6 +236,80 @@ def climatology_seasonal(arr, date_start, date_end, season):
 '''
 
 
+def composite_cube(time_slices, division='month'):
+    '''
+    Function: composite_cube()
+        Calculate the mean of every month/season of every time slice and
+        ensemble member in each grid cell, in one grouped pass over each
+        slice. The cube is memoized on disk (see libs.memo) and the last one
+        is kept in memory, so plotting e.g. each month in turn only indexes it.
+
+    Inputs:
+    - time_slices (array): time slices, see generate_slices(), with
+        ensembles as arrays of members or stacked (see libs.ensemble.stack())
+    - division (string): type of time division
+        allowed values: 'month', 'season'
+        default: 'month'
+
+    Outputs:
+    - (xarray.DataArray): means, with dimensions (slice, month/season,
+        member, ...), slice labels as the slice coordinate, month numbers or
+        season names as the month/season coordinate, and member labels as
+        the member and label coordinates
+    '''
+    key = tokenize(time_slices, division)
+    if key not in _composite_cubes:
+        _composite_cubes.clear()
+        _composite_cubes[key] = _composite_cube(time_slices, division).load()
+
+    return _composite_cubes[key]
+
+
+@libs.memo.memoize
+def correlation_clim(
+    data_a,
+    data_b,
+    climatology_period=slice('1980-01-01', '2011-01-01'),
+    correlation_period=None,
+    division='season',
+    lag=0
+):
+    '''
+    Function: correlation_clim()
+        Calculate the correlation over time of the anomalies of two
+        variables from their climatologies, for every month/season, in each
+        grid cell. Co-moments are accumulated over time chunks (see
+        libs.comoments.accumulate()), so each variable is read once.
+
+    Inputs:
+    - data_a (xarray): first variable, optionally with a member dimension
+    - data_b (xarray or array): second variable, on the same grid, or an
+        array of variables (correlated along a 'variable' dimension)
+    - climatology_period (slice): time slice of the climatology
+        default: slice('1980-01-01', '2011-01-01')
+    - correlation_period (slice): time slice to correlate over
+        default: None (all time steps)
+    - division (string): type of time division
+        allowed values: 'month', 'season'
+        default: 'season'
+    - lag (int): number of months data_b lags data_a
+        default: 0
+
+    Outputs:
+    - (xarray): correlation, with a month/season dimension
+    '''
+    moments = libs.comoments.accumulate(
+        data_a,
+        data_b,
+        climatology_period,
+        correlation_period,
+        division,
+        lag
+    )
+
+    return libs.comoments.correlation(moments)
+
+
 def correlation_spatial_clim(
     ensemble_a,
     ensemble_b,
@@ -108,45 +318,32 @@ def correlation_spatial_clim(
     correlation_period=None,
     division='season',
     periods=['DJF', 'MAM', 'JJA', 'SON'],
-    shape=None
+    shape=None,
+    lag=0
 ):
-    var_a_name = ensemble_a[0]['data'].name
-    var_b_name = ensemble_b[0]['data'].name
+    if type(ensemble_a) == xarray.DataArray:
+        data_a = ensemble_a
+        data_b = ensemble_b
+        labels = [str(v) for v in ensemble_a['source_id'].values]
+    else:
+        data_a = _stack_data(ensemble_a)
+        data_b = _stack_data(ensemble_b)
+        labels = [item['source_id'] for item in ensemble_a]
+
+    # All periods and members are computed in one pass over each variable
+    correlation = correlation_clim(data_a, data_b, climatology_period, correlation_period, division, lag)
+    title_lag = f', lag {lag} months' if lag != 0 else ''
     correlation_data = []
 
     for p in periods:
-        ensemble_data = []
-
-        for i, item in enumerate(ensemble_a):
-            baseline_a = item['data']\
-                .sel(time=climatology_period)\
-                .where(item['data'].time[f'time.{division}'] == p)\
-                .mean('time')
-
-            item_a = item['data']\
-                .where(item['data'].time[f'time.{division}'] == p) - baseline_a
-
-            baseline_b = ensemble_b[i]['data']\
-                .sel(time=climatology_period)\
-                .where(ensemble_b[i]['data'].time[f'time.{division}'] == p)\
-                .mean('time')
-
-            item_b = ensemble_b[i]['data']\
-                .where(ensemble_b[i]['data'].time[f'time.{division}'] == p) - baseline_b
-
-            if correlation_period != None:
-                item_a = item_a.sel(time=correlation_period)
-                item_b = item_b.sel(time=correlation_period)
-
-            ensemble_data.append({
-                'data': xarray.corr(item_a, item_b, dim='time'),
-                'label': item['source_id']
-            })
-
+        ensemble_data = [{
+            'data': correlation.sel({ division: p }).isel(member=m),
+            'label': label
+        } for m, label in enumerate(labels)]
 
         libs.plot.nstereo(
             ensemble_data,
-            title=f'{p} {var_a_name}/{var_b_name} correlation (climatology 1980-2010)',
+            title=f'{p} {data_a.name}/{data_b.name} correlation (climatology 1980-2010{title_lag})',
             colorbar_label='Correlation',
             colormesh_kwargs={
                 'cmap': cmap,
@@ -206,6 +403,8 @@ def generate_slices(
             'label': (string),
             'plot_kwargs': (dict)
         }
+        or a stacked ensemble (see libs.ensemble.stack()), in which case
+        'ensemble' of each slice is the stacked data sliced
     - slices (array): array of slices in format
         {
             'slice': { 'time': slice('2015-01-01', '2036-01-01') },
@@ -225,6 +424,15 @@ def generate_slices(
     '''
     slices_ensemble = []
 
+    if type(ensemble) == xarray.DataArray:
+        ensemble = ensemble.copy()
+        ensemble.attrs['plot_kwargs'] = item_plot_kwargs
+
+        return [{
+            'ensemble': ensemble.sel(**s['slice']),
+            'label': s['label']
+        } for s in slices]
+
     for s in slices:
         ensemble_processed = [{
             'color': item['color'],
@@ -241,6 +449,41 @@ def generate_slices(
     return slices_ensemble
 
 
+def ice_free_season(siconc, threshold=15):
+    '''
+    Function: ice_free_season()
+        Calculate the ice-free season of each year, i.e. months with sea ice
+        concentration below threshold, see season_length()
+
+    Inputs:
+    - siconc (xarray): sea ice concentration (%)
+    - threshold (float): maximum concentration of ice-free months
+        default: 15
+
+    Outputs:
+    - (xarray.Dataset or dict): see season_length()
+    '''
+    return season_length(siconc, threshold, below=True)
+
+
+def melt_pond_season(simpconc, threshold=0):
+    '''
+    Function: melt_pond_season()
+        Calculate the melt pond season of each year, i.e. months with melt
+        pond concentration above threshold, see season_length()
+
+    Inputs:
+    - simpconc (xarray): melt pond concentration (%)
+    - threshold (float): minimum concentration of melt pond months
+        default: 0 (i.e. any melt ponds)
+
+    Outputs:
+    - (xarray.Dataset or dict): see season_length()
+    '''
+    return season_length(simpconc, threshold)
+
+
+@libs.memo.memoize
 def monthly_weighted(data, weight, method='sum', dim=None):
     '''
     Function: monthly_weighted()
@@ -275,17 +518,205 @@ def monthly_weighted(data, weight, method='sum', dim=None):
         .mean('time')
 
 
-def smoothed_mean(data, time=60):
+def rain_season(prra, pr, threshold=0.5):
+    '''
+    Function: rain_season()
+        Calculate the rain season of each year, i.e. months where rainfall
+        is more than threshold of total precipitation (by default, where
+        rainfall exceeds snowfall), see season_length()
+
+    Inputs:
+    - prra (xarray): rainfall
+    - pr (xarray): total precipitation, e.g. prra + prsn
+    - threshold (float): minimum prra/pr of rain season months
+        default: 0.5
+
+    Outputs:
+    - (xarray.Dataset or dict): see season_length()
+    '''
+    return season_length(prra / pr, threshold)
+
+
+def season_length(data, threshold, below=False):
+    '''
+    Function: season_length()
+        Find the months of each year where data is above (or below)
+        threshold, and the season they form, in every cell/region and
+        member at once. Time is split into (year, month), and all years are
+        scanned together over the 12 months. Months with missing data do
+        not qualify.
+
+    Inputs:
+    - data (xarray): monthly data, either a DataArray (e.g. spatial fields,
+        optionally stacked, see libs.ensemble.stack()) or a Dataset with one
+        variable per member (e.g. from libs.local.get_ensemble_series())
+    - threshold (float): threshold of qualifying months
+    - below (bool): whether qualifying months are below threshold, rather
+        than above
+        default: False
+
+    Outputs:
+    - (xarray.Dataset or dict): for a DataArray, a Dataset with time
+        replaced by a year dimension (e.g. for libs.trends.fit(data,
+        dim='year')), and variables
+        - count: number of qualifying months
+        - end: last qualifying month (1-12), NaN if none
+        - length: longest run of consecutive qualifying months
+        - onset: first qualifying month (1-12), NaN if none
+        and for a Dataset, a dict of Datasets keyed by the above (e.g. for
+        libs.plot.time_series_from_vars(..., xattr='year')), with one
+        variable per member, keeping its attrs
+    '''
+    if type(data) == xarray.Dataset:
+        seasons = season_length(data.to_array('member'), threshold, below)
+
+        return {
+            k: xarray.Dataset(
+                data_vars={
+                    v: seasons[k].sel(member=v, drop=True).assign_attrs(data[v].attrs) for v in data.data_vars
+                },
+                attrs=data.attrs
+            ) for k in seasons.data_vars
+        }
+
+    qualifies = (data < threshold) if below else (data > threshold)
+    qualifies = qualifies.where(data.notnull(), False)\
+        .assign_coords(year=data.time.dt.year, month=data.time.dt.month)\
+        .set_index(time=['year', 'month'])\
+        .unstack('time', fill_value=False)
+
+    if qualifies.chunks != None:
+        qualifies = qualifies.chunk({ 'month': -1 })
+
+    count, onset, end, length = xarray.apply_ufunc(
+        _season_kernel,
+        qualifies,
+        input_core_dims=[['month']],
+        output_core_dims=[[], [], [], []],
+        dask='parallelized',
+        output_dtypes=[np.float64] * 4,
+        kwargs={ 'months': qualifies.month.values }
+    )
+
+    seasons = xarray.Dataset({ 'count': count, 'end': end, 'length': length, 'onset': onset })
+    seasons.attrs = {
+        'below': int(below),
+        'threshold': threshold
+    }
+
+    return seasons.transpose('year', ...)
+
+
+def smoothed_mean(data, time=60, min_periods=None):
     '''
     Function: smoothed_mean()
-        Smooth data over rolling window
+        Smooth data over centred rolling window, as
+        data.rolling(time=time, center=True).mean(). Window sums are
+        differences of cumulative sums, so cost does not depend on the
+        window length, and chunks of spatial fields only overlap by one
+        window, rather than every window being built.
 
     Inputs:
     - data (xarray): data to smooth
-    - time (int): length of rolling window, in months
+    - time (int): length of rolling window, in months, e.g. 240 (20 years)
         default: 60 (i.e. 5 years)
+    - min_periods (int): minimum number of values in a window, e.g. to
+        average masked cells over their valid values
+        default: None (i.e. time, so windows with any NaN are NaN)
 
     Outputs:
     - (xarray): smoothed data
     '''
-    return data.rolling(time=time, center=True).mean(dim=('month'))
+    min_periods = time if min_periods == None else min_periods
+    axis = data.get_axis_num('time')
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+
+    if data.chunks == None:
+        values = _rolling_mean(data.values, time, min_periods, axis).astype(dtype)
+    else:
+        # Windows longer than data only overlap all of it
+        values = dask.array.map_overlap(
+            _rolling_mean,
+            data.data,
+            depth={ axis: min(time, data.shape[axis]) },
+            boundary=np.nan,
+            dtype=dtype,
+            window=time,
+            min_periods=min_periods,
+            axis=axis
+        )
+
+    return data.copy(data=values)
+
+
+@libs.memo.memoize
+def _composite_cube(time_slices, division):
+    slices = []
+    for s in time_slices:
+        data = s['ensemble']
+        if type(data) != xarray.DataArray:
+            data = _stack_data(data)
+
+        slices.append(data.groupby(f'time.{division}').mean('time', skipna=True))
+
+    return xarray.concat(
+        slices,
+        dim='slice',
+        coords='minimal',
+        compat='override'
+    ).assign_coords(slice=[s['label'] for s in time_slices])
+
+
+def _stack_data(ensemble):
+    # Members of an array ensemble along a member dimension, labelled as in
+    # libs.ensemble.stack()
+    labels = [item['label'] for item in ensemble]
+
+    return xarray.concat(
+        [item['data'] for item in ensemble],
+        dim='member',
+        coords='minimal',
+        compat='override',
+        join='override'
+    ).assign_coords(member=labels, label=('member', labels))
+
+
+def _rolling_mean(values, window, min_periods, axis):
+    # Centred rolling mean along axis from cumulative sums, the window of
+    # each step covering [step - window // 2, step + window - window // 2 - 1]
+    values = np.moveaxis(values, axis, -1)
+    valid = ~np.isnan(values)
+    zeros = np.zeros(values.shape[:-1] + (1,))
+    sums = np.concatenate([zeros, np.cumsum(np.where(valid, values, 0), axis=-1, dtype=np.float64)], axis=-1)
+    counts = np.concatenate([zeros, np.cumsum(valid, axis=-1)], axis=-1)
+
+    steps = np.arange(values.shape[-1])
+    start = np.maximum(steps - window // 2, 0)
+    end = np.minimum(steps + window - window // 2, values.shape[-1])
+    window_sums = sums[..., end] - sums[..., start]
+    window_counts = counts[..., end] - counts[..., start]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(window_counts >= max(min_periods, 1), window_sums / window_counts, np.nan)
+
+    return np.moveaxis(mean, -1, axis).astype(values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64)
+
+
+def _season_kernel(qualifies, months):
+    # Count, first and last qualifying month, and longest run of
+    # consecutive qualifying months, scanning the last (month) axis once
+    count = np.zeros(qualifies.shape[:-1])
+    onset = np.full(qualifies.shape[:-1], np.nan)
+    end = np.full(qualifies.shape[:-1], np.nan)
+    run = np.zeros(qualifies.shape[:-1])
+    length = np.zeros(qualifies.shape[:-1])
+
+    for m, month in enumerate(months):
+        q = qualifies[..., m].astype(bool)
+        count += q
+        onset = np.where(q & np.isnan(onset), month, onset)
+        end = np.where(q, month, end)
+        run = (run + 1) * q
+        length = np.maximum(length, run)
+
+    return count, onset, end, length
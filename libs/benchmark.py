@@ -0,0 +1,515 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import datetime
+import json
+import libs.analysis
+import libs.ensemble
+import libs.local
+import libs.memo
+import libs.synthetic
+import libs.vars
+import matplotlib
+import matplotlib.pyplot as plt
+import multiprocessing
+import numpy as np
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import traceback
+import warnings
+import xarray
+
+BASELINE_PATH = '_data/_benchmarks/baseline.json'
+HISTORY_PATH = '_data/_benchmarks/history.jsonl'
+
+# Last year of historical synthetic files, ssp585 files start the year after
+# (see libs.synthetic.write()). Cases read ssp585 with historical, so runs
+# need years of both
+HISTORICAL_END = 2014
+
+# Ensemble sizes (number of members) each case is run at
+SCALES = [1, 10, 50]
+
+# Ratio of wall time or peak memory to the baseline above which a result is
+# reported as a regression
+THRESHOLD = 1.2
+
+# Length of the daily noleap time axis converted by the convert_calendar
+# case, in years
+CALENDAR_YEARS = 300
+
+# Variables of the synthetic processed files the cases read
+VARIABLES = ['evspsbl', 'pr', 'siconc']
+
+# Target of regrid/ingest: the ORCA1 grid of UKESM1-0-LL, as in
+# preprocessing/remote-download.ipynb
+REGRID_KWARGS = {
+    'method': 'bilinear',
+    'extrap_method': 'nearest_s2d',
+    'copy_dims': ['i', 'j', 'longitude', 'latitude']
+}
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''
+    Function: compare()
+        Compare benchmark results with a baseline
+
+    Inputs:
+    - results (dict): results, see run()
+    - baseline (dict): baseline run, see read_baseline()
+    - threshold (float): ratio to the baseline above which a result is a
+        regression
+        default: THRESHOLD
+
+    Outputs:
+    - (dict): { (case/members): {
+            'memory_ratio': (float), 'regression': (bool), 'time_ratio': (float)
+        } }, for results run in both
+    '''
+    comparison = {}
+    previous = baseline.get('results', {})
+
+    for key, result in results.items():
+        if key not in previous or result['status'] != 'done' or previous[key]['status'] != 'done':
+            continue
+
+        time_ratio = result['seconds'] / max(previous[key]['seconds'], 1e-6)
+        memory_ratio = result['peak_memory_mb'] / max(previous[key]['peak_memory_mb'], 1e-6)
+        comparison[key] = {
+            'memory_ratio': memory_ratio,
+            'regression': time_ratio > threshold or memory_ratio > threshold,
+            'time_ratio': time_ratio
+        }
+
+    return comparison
+
+
+def generate(root=libs.synthetic.ROOT, members=max(SCALES), start=1980, end=2100, seed=0):
+    '''
+    Function: generate()
+        Write the synthetic files the benchmark cases read (see
+        libs.synthetic), skipping existing files: processed files of
+        VARIABLES, and pr source files on the N96 grid for regrid/ingest
+
+    Inputs:
+    - root (string): directory to write to
+        default: libs.synthetic.ROOT
+    - members (int): number of members
+        default: max(SCALES)
+    - start (int): first year
+        default: 1980
+    - end (int): last year (inclusive)
+        default: 2100
+    - seed (int): random seed
+        default: 0
+
+    Outputs:
+    - (dict): source file paths of each member, see libs.synthetic.write_source()
+    '''
+    libs.synthetic.write(root, members=members, variables=VARIABLES, start=start, end=end, seed=seed)
+
+    return libs.synthetic.write_source(
+        root,
+        members=members,
+        start=start,
+        end=end,
+        years_per_file=50,
+        seed=seed
+    )
+
+
+def main(argv=None):
+    '''
+    Function: main()
+        Command line entry point of run(), e.g.
+        `python -m libs.benchmark --members 1 10 --start 2000 --end 2030`
+        run from the repository root
+
+    Inputs:
+    - argv (array): arguments
+        default: None (sys.argv)
+
+    Outputs:
+    - (int): exit status, 1 if any case failed or regressed
+    '''
+    parser = argparse.ArgumentParser(
+        prog='python -m libs.benchmark',
+        description='Time analysis functions on synthetic ensembles, comparing with a baseline'
+    )
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--cases', nargs='+', choices=list(CASES))
+    parser.add_argument('--end', default=2100, type=int, help='last year of synthetic data')
+    parser.add_argument('--members', nargs='+', default=SCALES, type=int, help='ensemble sizes')
+    parser.add_argument('--no-generate', action='store_true', help='do not write missing synthetic files')
+    parser.add_argument('--root', default=libs.synthetic.ROOT, help='directory of synthetic data')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--start', default=1980, type=int, help='first year of synthetic data')
+    parser.add_argument('--threshold', default=THRESHOLD, type=float)
+    args = parser.parse_args(argv)
+    if args.start > HISTORICAL_END or args.end <= HISTORICAL_END:
+        parser.error(f'--start and --end should include historical (to {HISTORICAL_END}) and ssp585 (from {HISTORICAL_END + 1}) years')
+
+    baseline = read_baseline(args.baseline)
+    record = run(
+        cases=args.cases,
+        scales=args.members,
+        root=args.root,
+        start=args.start,
+        end=args.end,
+        generate_data=not args.no_generate,
+        baseline_path=args.baseline,
+        save_baseline=args.save_baseline
+    )
+
+    comparison = compare(record['results'], baseline, args.threshold) if baseline != None else {}
+    if baseline == None and not args.save_baseline:
+        print(f'No baseline at {args.baseline}, run with --save-baseline to store one')
+
+    print('', 'Benchmark results:', sep='\n')
+    print(f'{"case":<26}{"members":>8}{"seconds":>10}{"peak MB":>10}{"time x":>8}{"mem x":>8}  status')
+    for key, result in record['results'].items():
+        case, members = key.split('/')
+        c = comparison.get(key, {})
+        seconds = f'{result["seconds"]:.2f}' if result['seconds'] != None else ''
+        memory = f'{result["peak_memory_mb"]:.0f}' if result['peak_memory_mb'] != None else ''
+        time_ratio = f'{c["time_ratio"]:.2f}' if c != {} else ''
+        memory_ratio = f'{c["memory_ratio"]:.2f}' if c != {} else ''
+        status = 'regression' if c.get('regression') else result['status']
+        print(f'{case:<26}{members:>8}{seconds:>10}{memory:>10}{time_ratio:>8}{memory_ratio:>8}  {status}')
+        if result['error'] != None:
+            print(f'{"":<26}{result["error"].strip().splitlines()[-1]}')
+
+    failed = [r for r in record['results'].values() if r['status'] == 'failed']
+    regressed = [c for c in comparison.values() if c['regression']]
+
+    return 1 if len(failed) > 0 or len(regressed) > 0 else 0
+
+
+def read_baseline(path=BASELINE_PATH):
+    '''
+    Function: read_baseline()
+        Read a stored baseline
+
+    Inputs:
+    - path (string): baseline path
+        default: BASELINE_PATH
+
+    Outputs:
+    - (dict): baseline run, see run(), or None if not stored
+    '''
+    if not Path(path).exists():
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def run(
+    cases=None,
+    scales=SCALES,
+    root=libs.synthetic.ROOT,
+    start=1980,
+    end=2100,
+    generate_data=True,
+    baseline_path=BASELINE_PATH,
+    history_path=HISTORY_PATH,
+    save_baseline=False
+):
+    '''
+    Function: run()
+        Run benchmark cases on synthetic ensembles of each size in scales.
+        Each case and size runs in a new process, with root as the working
+        directory and memoization disabled, timing only the call being
+        benchmarked (not loading its inputs) and recording the peak resident
+        memory of the process. Cases fail if any member can't be loaded.
+        Every run is appended to history_path.
+
+    Inputs:
+    - cases (array): cases to run, any of CASES
+        default: None (all)
+    - scales (array): ensemble sizes
+        default: SCALES
+    - root (string): directory of synthetic data, see libs.synthetic.write()
+        default: libs.synthetic.ROOT
+    - start (int): first year of synthetic data, up to HISTORICAL_END
+        default: 1980
+    - end (int): last year (inclusive) of synthetic data, after
+        HISTORICAL_END
+        default: 2100
+    - generate_data (bool): whether to write missing synthetic files first
+        default: True
+    - baseline_path (string): path to store the baseline at
+        default: BASELINE_PATH
+    - history_path (string): path of the history of runs
+        default: HISTORY_PATH
+    - save_baseline (bool): whether to store this run as the baseline
+        default: False
+
+    Outputs:
+    - (dict): {
+            'end': (int), 'machine': (dict), 'start': (int), 'time': (string),
+            'results': { (case/members): {
+                'error': (string), 'memory_before_mb': (float),
+                'peak_memory_mb': (float), 'seconds': (float),
+                'status': 'done', 'failed' or 'skipped'
+            } }
+        }
+    '''
+    cases = cases or list(CASES)
+    unknown = [c for c in cases if c not in CASES]
+    if len(unknown) > 0:
+        raise ValueError(f'`cases` should be any of {list(CASES)}, got {unknown}')
+
+    if start > HISTORICAL_END or end <= HISTORICAL_END:
+        raise ValueError(f'`start` and `end` should include historical (to {HISTORICAL_END}) and ssp585 (from {HISTORICAL_END + 1}) years, got {start}-{end}')
+
+    if generate_data:
+        sources = generate(root, members=max(scales), start=start, end=end)
+    else:
+        sources = {
+            item['source_id']: [str(p) for p in sorted(Path(root, f'_data/cmip6/{item["source_id"]}/pr').glob('pr_Amon_*[0-9].nc'))]
+            for item in libs.synthetic.ensemble(max(scales))
+        }
+
+    options = {
+        'climatology_period': (f'{start}-01-01', f'{min(start + 31, end + 1)}-01-01'),
+        'sources': {k: [str(Path(p).resolve()) for p in v] for k, v in sources.items()}
+    }
+
+    results = {}
+    for case in cases:
+        for members in scales:
+            key = f'{case}/{members}'
+            print(f'[running] {key}')
+
+            # A new process for each, so peak memory is of this case only
+            with ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(str(Path(root).resolve()),)
+            ) as executor:
+                try:
+                    results[key] = executor.submit(_run_case, case, members, options).result()
+                except Exception:
+                    results[key] = _result('failed', error=traceback.format_exc())
+
+            print(f'[{results[key]["status"]}] {key}')
+
+    record = {
+        'end': end,
+        'machine': {
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+            'python': platform.python_version()
+        },
+        'results': results,
+        'start': start,
+        'time': datetime.datetime.now().isoformat(timespec='seconds')
+    }
+
+    Path(history_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    if save_baseline:
+        Path(baseline_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f'{baseline_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp, baseline_path)
+        print(f'   -> Saved baseline to {baseline_path}')
+
+    return record
+
+
+def _areacello_grid():
+    paths = libs.local.get_paths('Ofx', 'piControl', 'UKESM1-0-LL', 'areacello', 'r1i1p1f2')
+
+    return xarray.open_dataset(paths[0])
+
+
+def _check_members(ensemble, items):
+    # Members without synthetic files are dropped by get_and_preprocess(),
+    # which would otherwise time a loop over fewer (or no) members
+    if len(ensemble) < len(items):
+        raise ValueError(f'Loaded {len(ensemble)} of {len(items)} members, generate synthetic data for start/end')
+
+    return ensemble
+
+
+def _init_worker(root):
+    matplotlib.use('Agg')
+    warnings.filterwarnings('ignore')
+    os.chdir(root)
+    libs.memo.ENABLED = False
+
+
+def _peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _result(status, seconds=None, memory_before_mb=None, peak_memory_mb=None, error=None):
+    return {
+        'error': error,
+        'memory_before_mb': memory_before_mb,
+        'peak_memory_mb': peak_memory_mb,
+        'seconds': seconds,
+        'status': status
+    }
+
+
+def _run_case(case, members, options):
+    items = libs.synthetic.ensemble(members)
+
+    try:
+        function = CASES[case](items, options)
+    except ImportError:
+        # e.g. libs.utils without xesmf installed
+        return _result('skipped', error=traceback.format_exc())
+    except Exception:
+        return _result('failed', error=traceback.format_exc())
+
+    memory_before = _peak_memory_mb()
+    try:
+        started = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - started
+    except Exception:
+        return _result('failed', error=traceback.format_exc())
+    finally:
+        plt.close('all')
+
+    return _result('done', seconds, memory_before, _peak_memory_mb())
+
+
+def _case_climatology_monthly(items, options):
+    ensemble, _ = libs.ensemble.get_and_preprocess('Amon', 'ssp585', 'pr', members=items)
+    _check_members(ensemble, items)
+
+    def _run():
+        for item in ensemble:
+            libs.analysis.climatology_monthly(item['data'], *options['climatology_period']).compute()
+
+    return _run
+
+
+def _case_convert_calendar(items, options):
+    import libs.utils
+    # The cost is in the time axis, so each member is a small grid
+    time = xarray.date_range(
+        '1801-01-01',
+        periods=CALENDAR_YEARS * 365,
+        freq='D',
+        calendar='noleap',
+        use_cftime=True
+    )
+    data = xarray.Dataset(
+        {
+            'pr': (('time', 'j', 'i'), np.ones((len(time), 4, 4), dtype=np.float32)),
+            'time_bnds': (('time', 'bnds'), np.stack([time.values, (time + datetime.timedelta(days=1)).values], axis=-1))
+        },
+        coords={ 'time': ('time', time, { 'bounds': 'time_bnds' }) }
+    )
+    data.time.encoding['calendar'] = 'noleap'
+
+    def _run():
+        for item in items:
+            libs.utils.convert_calendar(data, frequency='day', daily_method='aggregate')
+            libs.utils.convert_calendar(data, frequency='day', daily_method='remap')
+
+    return _run
+
+
+def _case_correlation_spatial_clim(items, options):
+    ensemble_a, _ = libs.ensemble.get_and_preprocess('SImon', 'ssp585', 'siconc', members=items)
+    ensemble_b, _ = libs.ensemble.get_and_preprocess('Amon', 'ssp585', 'evspsbl', members=items)
+    _check_members(ensemble_a, items)
+    _check_members(ensemble_b, items)
+
+    return lambda: libs.analysis.correlation_spatial_clim(
+        ensemble_a,
+        ensemble_b,
+        climatology_period=slice(*options['climatology_period'])
+    )
+
+
+def _case_get_and_preprocess(items, options):
+    return lambda: _check_members(
+        libs.ensemble.get_and_preprocess('SImon', 'ssp585', 'siconc', members=items)[0],
+        items
+    )
+
+
+def _case_ingest(items, options):
+    import libs.utils
+    regrid_kwargs = { **REGRID_KWARGS, 'grid': _areacello_grid() }
+
+    def _run():
+        with tempfile.TemporaryDirectory() as output_dir:
+            for item in items:
+                libs.utils.ingest(
+                    options['sources'][item['source_id']],
+                    output_dir,
+                    'pr',
+                    force_write=True,
+                    frequency='mon',
+                    regrid_kwargs=regrid_kwargs
+                )
+
+    return _run
+
+
+def _case_regrid(items, options):
+    import libs.utils
+    grid = _areacello_grid()
+    sources = [
+        xarray.open_mfdataset(options['sources'][item['source_id']], combine='by_coords', use_cftime=True)
+        for item in items
+    ]
+
+    def _run():
+        for data in sources:
+            libs.utils.regrid(data.pr, grid=grid, **REGRID_KWARGS).compute()
+
+    return _run
+
+
+def _case_time_series_weighted(items, options):
+    conf = [v for v in libs.vars.variables() if v['variable_id'] == 'siconc'][0]
+    ensemble, weight = libs.ensemble.get_and_preprocess('SImon', 'ssp585', 'siconc', access='series', members=items)
+    _check_members(ensemble, items)
+
+    return lambda: libs.ensemble.time_series_weighted(
+        ensemble,
+        weight,
+        conf['weighting_method'],
+        conf['weighting_process'],
+        statistics=['raw', 'smoothed'],
+        climatology_period=options['climatology_period']
+    )
+
+
+# Benchmark cases: function(items, options) that loads the inputs of the
+# call being benchmarked, returning it as a function without arguments
+CASES = {
+    'climatology_monthly': _case_climatology_monthly,
+    'convert_calendar': _case_convert_calendar,
+    'correlation_spatial_clim': _case_correlation_spatial_clim,
+    'get_and_preprocess': _case_get_and_preprocess,
+    'ingest': _case_ingest,
+    'regrid': _case_regrid,
+    'time_series_weighted': _case_time_series_weighted
+}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,349 @@
+from contextlib import contextmanager
+from pathlib import Path
+import itertools
+import json
+import sqlite3
+import time
+import urllib.parse
+import urllib.request
+
+CATALOG_PATH = '_data/_cache/esgf_catalog.sqlite'
+SEARCH_URL = 'https://esgf-index1.ceda.ac.uk/esg-search/search/'
+#SEARCH_URL = 'https://esgf-node.llnl.gov/esg-search/search/'
+
+# Query parameters that control paging/formatting rather than the result set
+_PAGING_KEYS = ['format', 'limit', 'offset']
+
+
+def availability(
+    experiments,
+    sources,
+    variables,
+    base_url=SEARCH_URL,
+    headers={},
+    page_size=500,
+    path=CATALOG_PATH,
+    ttl=7 * 24 * 3600,
+    **query
+):
+    '''
+    Function: availability()
+        Check which (source_id, variable_id, experiment_id) combinations
+        have datasets, answered from the catalog where possible
+
+    Inputs:
+    - experiments (array): experiment ids, e.g. ['historical', 'ssp585']
+    - sources (array): source ids, e.g. ['UKESM1-0-LL', 'CanESM5']
+    - variables (array): variable ids, e.g. ['pr', 'prsn', 'siconca']
+    - base_url (string): ESGF search url
+        default: SEARCH_URL
+    - headers (dict): request headers
+        default: {}
+    - page_size (int): number of results per request
+        default: 500
+    - path (string): catalog path
+        default: CATALOG_PATH
+    - ttl (int): seconds before cached results are considered stale
+        default: 7 days
+    - **query: any additional query parameters, e.g. table_id='Amon'
+
+    Outputs:
+    - (dict): { (source_id, variable_id, experiment_id): (bool) }
+    '''
+    results = search_bulk(
+        {
+            **query,
+            'experiment_id': experiments,
+            'source_id': sources,
+            'variable_id': variables
+        },
+        split_by=['experiment_id', 'source_id', 'variable_id'],
+        base_url=base_url,
+        headers=headers,
+        page_size=page_size,
+        path=path,
+        ttl=ttl
+    )
+
+    return {
+        (k['source_id'], k['variable_id'], k['experiment_id']): len(docs) > 0
+        for k, docs in results
+    }
+
+
+def clear(path=CATALOG_PATH, older_than=None):
+    '''
+    Function: clear()
+        Delete cached responses from the catalog
+
+    Inputs:
+    - path (string): catalog path
+        default: CATALOG_PATH
+    - older_than (int): only delete responses older than this many seconds
+        default: None (delete all)
+    '''
+    with _connect(path) as conn:
+        if older_than == None:
+            conn.execute('DELETE FROM responses')
+        else:
+            conn.execute('DELETE FROM responses WHERE fetched < ?', (time.time() - older_than,))
+
+
+def normalize_query(query, base_url=SEARCH_URL):
+    '''
+    Function: normalize_query()
+        Create a stable catalog key for a query, independent of parameter
+        order and paging parameters
+
+    Inputs:
+    - query (dict): query parameters, values can be strings or lists
+    - base_url (string): url the query is sent to
+        default: SEARCH_URL
+
+    Outputs:
+    - (string): catalog key
+    '''
+    normalized = {}
+    for k, v in query.items():
+        if k in _PAGING_KEYS or v == None:
+            continue
+
+        if type(v) in [list, tuple, set]:
+            v = sorted(str(x) for x in v)
+            v = v[0] if len(v) == 1 else v
+        else:
+            v = str(v)
+
+        normalized[k] = v
+
+    return json.dumps([base_url, normalized], sort_keys=True)
+
+
+def search(
+    query,
+    base_url=SEARCH_URL,
+    headers={},
+    page_size=500,
+    path=CATALOG_PATH,
+    refresh=False,
+    ttl=7 * 24 * 3600
+):
+    '''
+    Function: search()
+        Run an ESGF Solr query, paging through all results. Responses are
+        stored in a local SQLite catalog keyed by the normalised query, so
+        repeated queries within ttl make no network calls.
+
+    Inputs:
+    - query (dict): query parameters, e.g.
+        { 'experiment_id': 'ssp585', 'source_id': 'UKESM1-0-LL', 'type': 'Dataset' }
+        list values are OR'd together by the search api
+    - base_url (string): ESGF search url
+        default: SEARCH_URL
+    - headers (dict): request headers
+        default: {}
+    - page_size (int): number of results per request
+        default: 500
+    - path (string): catalog path
+        default: CATALOG_PATH
+    - refresh (bool): whether to ignore cached responses
+        default: False
+    - ttl (int): seconds before cached responses are considered stale
+        default: 7 days
+
+    Outputs:
+    - (array): response['response']['docs'] for all pages
+    '''
+    key = normalize_query(query, base_url)
+    if not refresh:
+        docs = _read(path, key, ttl)
+        if docs != None:
+            return docs
+
+    docs = _fetch_all(base_url, query, headers, page_size)
+    _write(path, key, base_url, docs)
+
+    return docs
+
+
+def search_bulk(
+    query,
+    split_by=['experiment_id', 'source_id', 'variable_id'],
+    base_url=SEARCH_URL,
+    headers={},
+    page_size=500,
+    path=CATALOG_PATH,
+    refresh=False,
+    ttl=7 * 24 * 3600
+):
+    '''
+    Function: search_bulk()
+        Answer a whole matrix of queries (e.g. ensemble x variable x
+        experiment) with a single paged query. Results are split back into
+        one catalog entry per combination of split_by values, including
+        empty entries for combinations without results, so later calls to
+        search() for any single combination are answered from the catalog.
+
+    Inputs:
+    - query (dict): query parameters, where split_by parameters are lists
+    - split_by (array): list-valued query parameters to split results by
+        default: ['experiment_id', 'source_id', 'variable_id']
+    - base_url, headers, page_size, path, refresh, ttl: see search()
+
+    Outputs:
+    - (array): array of (combination, docs) tuples, where combination is a
+        dict of split_by values, e.g.
+        [({ 'experiment_id': 'ssp585', 'source_id': 'CanESM5', 'variable_id': 'pr' }, [...]), ...]
+    '''
+    split_values = [
+        [str(x) for x in query[k]] if type(query[k]) in [list, tuple, set] else [str(query[k])]
+        for k in split_by
+    ]
+    combinations = [dict(zip(split_by, c)) for c in itertools.product(*split_values)]
+
+    def sub_key(combination):
+        return normalize_query({ **query, **combination }, base_url)
+
+    results = {}
+    if not refresh:
+        for c in combinations:
+            docs = _read(path, sub_key(c), ttl)
+            if docs == None:
+                break
+            results[sub_key(c)] = docs
+
+    if len(results) < len(combinations):
+        docs = _fetch_all(base_url, query, headers, page_size)
+        results = { sub_key(c): [] for c in combinations }
+
+        for doc in docs:
+            values = {}
+            for k in split_by:
+                v = doc.get(k)
+                values[k] = str(v[0] if type(v) == list else v)
+
+            key = sub_key(values)
+            if key in results:
+                results[key].append(doc)
+
+        with _connect(path) as conn:
+            for key, key_docs in results.items():
+                _write(path, key, base_url, key_docs, conn=conn)
+
+    return [(c, results[sub_key(c)]) for c in combinations]
+
+
+def search_files(
+    item,
+    base_url='https://esgf-index1.ceda.ac.uk/search_files/',
+    headers={},
+    page_size=1000,
+    path=CATALOG_PATH,
+    refresh=False,
+    ttl=7 * 24 * 3600
+):
+    '''
+    Function: search_files()
+        List the files of a dataset, via the catalog
+
+    Inputs:
+    - item (dict): dataset doc from search()
+    - base_url (string): ESGF search_files url
+        default: 'https://esgf-index1.ceda.ac.uk/search_files/'
+    - headers, page_size, path, refresh, ttl: see search()
+
+    Outputs:
+    - (array): response['response']['docs'] for all files
+    '''
+    url = f'{base_url}{item["id"]}/{item["index_node"]}/'
+
+    return search(
+        {},
+        base_url=url,
+        headers=headers,
+        page_size=page_size,
+        path=path,
+        refresh=refresh,
+        ttl=ttl
+    )
+
+
+@contextmanager
+def _connect(path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                fetched REAL,
+                num_found INTEGER,
+                docs TEXT
+            )
+        ''')
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _fetch_all(base_url, query, headers, page_size):
+    docs = []
+    offset = 0
+    num_found = None
+
+    while num_found == None or offset < num_found:
+        page_query = {
+            **{ k: v for k, v in query.items() if v != None },
+            'format': 'application/solr+json',
+            'limit': page_size,
+            'offset': offset
+        }
+        url = f'{base_url}?{urllib.parse.urlencode(page_query, doseq=True)}'
+        print('Requesting:')
+        print(f'-> {url}')
+
+        req = urllib.request.Request(url, headers=headers)
+        response = urllib.request.urlopen(req)
+        if response.status < 200 or response.status > 299:
+            msg = '\n'.join([
+                f'An error occurred making request:',
+                f'-> URL: {url}',
+                f'-> Status code: {response.status}',
+            ])
+            raise ConnectionError(msg)
+
+        page = json.load(response)['response']
+        num_found = page['numFound']
+        docs += page['docs']
+        offset += page_size
+
+        if len(page['docs']) == 0:
+            break
+
+    return docs
+
+
+def _read(path, key, ttl):
+    if not Path(path).exists():
+        return None
+
+    with _connect(path) as conn:
+        row = conn.execute('SELECT fetched, docs FROM responses WHERE key = ?', (key,)).fetchone()
+
+    if row == None or (ttl != None and time.time() - row[0] > ttl):
+        return None
+
+    return json.loads(row[1])
+
+
+def _write(path, key, url, docs, conn=None):
+    if conn == None:
+        with _connect(path) as conn:
+            return _write(path, key, url, docs, conn=conn)
+
+    conn.execute(
+        'INSERT OR REPLACE INTO responses (key, url, fetched, num_found, docs) VALUES (?, ?, ?, ?, ?)',
+        (key, url, time.time(), len(docs), json.dumps(docs))
+    )
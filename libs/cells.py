@@ -0,0 +1,208 @@
+from pathlib import Path
+import hashlib
+import libs.vars
+import numpy as np
+import xarray
+
+CELLS_DIR = '_data/_cache/_cells'
+NSIDC_MASK_PATH = '_data/_cache/NSIDC_Regions_Masks_Ocean_nearest_s2d.nc'
+
+# Cell indexes by key, see cell_index()
+_indexes = {}
+
+
+def cell_index(
+    latitude,
+    longitude=None,
+    mask_path=NSIDC_MASK_PATH,
+    region='All',
+    min_latitude=60
+):
+    '''
+    Function: cell_index()
+        Get the index of the grid cells inside an NSIDC region and north of
+        min_latitude, i.e. the cells left unmasked by
+        `.where(latitude > 60).where(np.isin(nsidc_mask.values, ...))`.
+        Indexes are cached in memory and in CELLS_DIR, keyed by a hash of
+        the grid, mask and region.
+
+    Inputs:
+    - latitude (xarray): 2D latitude of the grid, e.g. data.latitude
+    - longitude (xarray): 2D longitude of the grid, kept for unpack()
+        default: None
+    - mask_path (string): NSIDC region mask, on the same grid
+        default: NSIDC_MASK_PATH
+    - region (string): label of region in libs.vars.nsidc_regions()
+        default: 'All'
+    - min_latitude (float): minimum latitude
+        default: 60
+
+    Outputs:
+    - (dict): index, formatted as
+        {
+            'dims': (tuple), 'i': (np.array), 'j': (np.array), 'key': (string),
+            'latitude': (np.array), 'longitude': (np.array), 'shape': (tuple)
+        }
+        where 'j', 'i' are positions of cells along dims
+    '''
+    latitude_values = np.ascontiguousarray(latitude.values)
+    digest = hashlib.sha1(latitude_values.tobytes())
+    digest.update(str([mask_path, Path(mask_path).stat().st_mtime, region, min_latitude]).encode())
+    key = digest.hexdigest()[:16]
+
+    if key in _indexes:
+        return _indexes[key]
+
+    cache_path = Path(CELLS_DIR, f'{key}.npz')
+    if cache_path.exists():
+        return _load(key)
+
+    values = [r for r in libs.vars.nsidc_regions() if r['label'] == region][0]['values']
+    with xarray.open_dataset(mask_path) as mask:
+        in_region = np.isin(mask.mask.values, values)
+
+    j, i = np.nonzero(in_region & (latitude_values > min_latitude))
+    index = {
+        'dims': tuple(latitude.dims),
+        'i': i,
+        'j': j,
+        'key': key,
+        'latitude': latitude_values,
+        'longitude': np.asarray(longitude.values) if type(longitude) == xarray.DataArray else np.full(latitude.shape, np.nan),
+        'shape': latitude.shape
+    }
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path, **{ k: v for k, v in index.items() if k != 'key' })
+    _indexes[key] = index
+
+    return index
+
+
+def get_index(data):
+    '''
+    Function: get_index()
+        Get the cell index packed data was created with
+
+    Inputs:
+    - data (xarray): packed data, see pack()
+
+    Outputs:
+    - (dict): index, see cell_index()
+    '''
+    key = data.attrs['cell_index']
+
+    return _indexes[key] if key in _indexes else _load(key)
+
+
+def pack(data, index=None):
+    '''
+    Function: pack()
+        Keep only the cells of index, replacing the 2D spatial dimensions
+        with a 1D 'cell' dimension. Latitude/longitude become 1D
+        coordinates along 'cell'.
+
+    Inputs:
+    - data (xarray): data on the grid of index, or already packed data
+        (returned as is)
+    - index (dict): see cell_index()
+        default: None (NSIDC 'All' cells of data.latitude)
+
+    Outputs:
+    - (xarray): packed data, with attrs['cell_index'] set to the index key
+    '''
+    if 'cell' in data.dims:
+        return data
+
+    if index == None:
+        index = cell_index(data.latitude, data.longitude if 'longitude' in data.coords else None)
+
+    dims = index['dims']
+    packed = data.isel({
+        dims[0]: xarray.DataArray(index['j'], dims='cell'),
+        dims[1]: xarray.DataArray(index['i'], dims='cell')
+    })
+    packed.attrs['cell_index'] = index['key']
+    if type(packed) == xarray.Dataset:
+        for v in packed.data_vars:
+            packed[v].attrs['cell_index'] = index['key']
+
+    return packed
+
+
+def unpack(data, index=None):
+    '''
+    Function: unpack()
+        Scatter packed data back onto the 2D grid, with NaN outside the
+        cells, e.g. for plotting with libs.plot.nstereo(). Variables of a
+        Dataset without a 'cell' dimension (e.g. time_bnds) are kept as is.
+
+    Inputs:
+    - data (xarray): packed data, see pack()
+    - index (dict): see cell_index()
+        default: None (index data was packed with)
+
+    Outputs:
+    - (xarray): data with 2D latitude/longitude coordinates
+    '''
+    if index == None:
+        index = get_index(data)
+
+    dims = index['dims']
+    cell_coords = [c for c in data.coords if 'cell' in data[c].dims]
+
+    if type(data) == xarray.Dataset:
+        cell_vars = [v for v in data.data_vars if 'cell' in data[v].dims]
+        unpacked = data.drop_vars(cell_coords + cell_vars)
+        for v in cell_vars:
+            unpacked[v] = _scatter(data[v].drop_vars(cell_coords), index)
+        unpacked = unpacked[list(data.data_vars)]
+    else:
+        unpacked = _scatter(data.drop_vars(cell_coords), index)
+
+    unpacked.attrs.pop('cell_index', None)
+
+    return unpacked.assign_coords({
+        'latitude': (dims, index['latitude']),
+        'longitude': (dims, index['longitude'])
+    })
+
+
+def _load(key):
+    cached = np.load(Path(CELLS_DIR, f'{key}.npz'))
+    _indexes[key] = {
+        'dims': tuple(str(d) for d in cached['dims']),
+        'i': cached['i'],
+        'j': cached['j'],
+        'key': key,
+        'latitude': cached['latitude'],
+        'longitude': cached['longitude'],
+        'shape': tuple(int(s) for s in cached['shape'])
+    }
+
+    return _indexes[key]
+
+
+def _scatter(data, index):
+    # Values of a packed DataArray on the 2D grid of index
+    dims = index['dims']
+    shape = index['shape']
+
+    def scatter(values):
+        out = np.full(values.shape[:-1] + shape, np.nan, dtype=np.result_type(values.dtype, np.float32))
+        out[..., index['j'], index['i']] = values
+        return out
+
+    unpacked = xarray.apply_ufunc(
+        scatter,
+        data,
+        input_core_dims=[['cell']],
+        output_core_dims=[list(dims)],
+        dask='parallelized',
+        dask_gufunc_kwargs={ 'output_sizes': dict(zip(dims, shape)) },
+        output_dtypes=[np.result_type(data.dtype, np.float32)],
+        keep_attrs=True
+    )
+    unpacked.attrs.pop('cell_index', None)
+
+    return unpacked
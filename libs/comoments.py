@@ -0,0 +1,251 @@
+import dask
+import numpy as np
+import xarray
+
+# Moments accumulated for each month/season, see accumulate()
+MOMENTS = ['count', 'mean_a', 'mean_b', 'm2_a', 'm2_b', 'c_ab', 'count_clim_a', 'count_clim_b']
+
+
+def accumulate(
+    data_a,
+    data_b,
+    climatology_period=slice('1980-01-01', '2011-01-01'),
+    correlation_period=None,
+    division='season',
+    lag=0
+):
+    '''
+    Function: accumulate()
+        Accumulate the count, means, second moments and co-moment of two
+        variables in each cell, for every month/season (and member) at once.
+        Each time chunk is read once: its moments are calculated in memory
+        and merged pairwise with those of other chunks (Chan et al.'s
+        update of Welford's algorithm), so no pass over the data is needed
+        to first find the means.
+
+        Correlation does not change when a per-cell constant (e.g. the
+        climatology of a month/season) is subtracted, so anomalies are never
+        calculated. Only the number of values in the climatology period is
+        kept, as correlation is undefined where the climatology is.
+
+    Inputs:
+    - data_a (xarray.DataArray): first variable, optionally with a member
+        dimension
+    - data_b (xarray.DataArray or array): second variable, on the same grid,
+        or an array of variables, which are correlated with data_a in the
+        same pass along a 'variable' dimension
+    - climatology_period (slice): time slice of the climatology
+        default: slice('1980-01-01', '2011-01-01')
+    - correlation_period (slice): time slice to correlate over
+        default: None (all time steps)
+    - division (string): type of time division
+        allowed values: 'month', 'season'
+        default: 'season'
+    - lag (int): number of months data_b lags data_a, i.e. data_a at each
+        time is paired with data_b `lag` months later. Time steps are
+        grouped by the month/season of data_a.
+        default: 0
+
+    Outputs:
+    - (xarray.Dataset): moments (see MOMENTS), with dimensions
+        (month/season, ...), where m2_a, m2_b and c_ab are sums of squared
+        deviations from, and products of deviations from, the means
+    '''
+    if division not in ['month', 'season']:
+        raise ValueError(f'`division` should be either `month` or `season`, got {division}')
+
+    if type(data_b) in [list, tuple]:
+        data_b = xarray.concat(
+            [d.shift(time=-lag) for d in data_b],
+            dim='variable',
+            coords='minimal',
+            compat='override',
+            join='inner'
+        ).assign_coords(variable=[d.name for d in data_b])
+    else:
+        data_b = data_b.shift(time=-lag)
+
+    data_a, data_b = xarray.align(
+        data_a,
+        data_b,
+        join='inner',
+        exclude=set(data_a.dims).union(data_b.dims) - { 'time' }
+    )
+
+    # Only read time steps in the correlation or climatology periods
+    positions = np.arange(data_a.sizes['time'])
+    position = xarray.DataArray(positions, coords={ 'time': data_a.time })
+    in_clim = np.isin(positions, position.sel(time=climatology_period).values)
+    in_corr = np.isin(positions, position.sel(time=correlation_period).values)\
+        if correlation_period != None else np.ones(len(positions), dtype=bool)
+    keep = in_clim | in_corr
+    data_a = data_a.isel(time=keep)
+    data_b = data_b.isel(time=keep)
+
+    group_values = data_a.time[f'time.{division}'].values
+    labels = np.unique(group_values)
+    groups = np.searchsorted(labels, group_values)
+
+    # Other dimensions are on the same grid, so coordinates are taken from data_a
+    data_a, data_b = xarray.align(data_a, data_b, join='override')
+    data_a, data_b = xarray.broadcast(data_a, data_b)
+    data_a = data_a.transpose('time', ...)
+    data_b = data_b.transpose(*data_a.dims)
+    in_clim = in_clim[keep]
+    in_corr = in_corr[keep]
+
+    blocks_a, blocks_b, lengths = _blocks(data_a, data_b)
+    starts = np.cumsum((0,) + tuple(lengths))
+
+    # Moments of each block are merged along time in a pairwise tree, so
+    # blocks are merged in parallel
+    merged = np.empty(blocks_a.shape[1:], dtype=object)
+    for index in np.ndindex(*blocks_a.shape[1:]):
+        moments = [
+            dask.delayed(_moments)(
+                blocks_a[(t,) + index],
+                blocks_b[(t,) + index],
+                groups[starts[t]:starts[t + 1]],
+                in_clim[starts[t]:starts[t + 1]],
+                in_corr[starts[t]:starts[t + 1]],
+                len(labels)
+            )
+            for t in range(len(lengths))
+        ]
+
+        while len(moments) > 1:
+            moments = [
+                dask.delayed(_merge)(*moments[k:k + 2]) if k + 1 < len(moments) else moments[k]
+                for k in range(0, len(moments), 2)
+            ]
+
+        merged[index] = moments[0]
+
+    for index, value in zip(np.ndindex(*merged.shape), dask.compute(*merged.ravel())):
+        merged[index] = value
+
+    values = { k: np.block(_nested(merged, k)) for k in MOMENTS }
+
+    template = data_a.isel(time=0, drop=True)
+    dims = (division,) + template.dims
+    coords = { **template.coords, division: labels }
+
+    return xarray.Dataset(
+        data_vars={ k: (dims, values[k]) for k in MOMENTS },
+        coords=coords,
+        attrs={ 'division': division, 'lag': lag }
+    )
+
+
+def correlation(moments):
+    '''
+    Function: correlation()
+        Calculate the (Pearson) correlation from accumulated moments, as
+        xarray.corr() of the anomalies from the climatology of each
+        month/season
+
+    Inputs:
+    - moments (xarray.Dataset): see accumulate()
+
+    Outputs:
+    - (xarray.DataArray): correlation
+    '''
+    defined = (moments.count_clim_a > 0) & (moments.count_clim_b > 0) & (moments['count'] > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = moments.c_ab / np.sqrt(moments.m2_a * moments.m2_b)
+
+    corr = corr.where(defined)
+    corr.attrs = { 'lag': moments.attrs['lag'] }
+
+    return corr
+
+
+def _blocks(data_a, data_b):
+    # Blocks of data_a and data_b (as arrays of delayed arrays, time first)
+    # with the same chunks, and the length of each time chunk
+    if data_a.chunks == None and data_b.chunks == None:
+        blocks_a = np.empty((1,) * data_a.ndim, dtype=object)
+        blocks_b = np.empty((1,) * data_a.ndim, dtype=object)
+        blocks_a[(0,) * data_a.ndim] = data_a.values
+        blocks_b[(0,) * data_a.ndim] = data_b.values
+
+        return blocks_a, blocks_b, (data_a.sizes['time'],)
+
+    if data_a.chunks == None:
+        data_a = data_a.chunk({ 'time': 120 })
+
+    data_b = data_b.chunk(dict(zip(data_a.dims, data_a.chunks)))
+
+    return data_a.data.to_delayed(), data_b.data.to_delayed(), data_a.chunks[0]
+
+
+def _merge(x, y):
+    count = x['count'] + y['count']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(count > 0, y['count'] / count, 0)
+        weight = np.where(count > 0, x['count'] * y['count'] / count, 0)
+
+    delta_a = y['mean_a'] - x['mean_a']
+    delta_b = y['mean_b'] - x['mean_b']
+
+    return {
+        'count': count,
+        'count_clim_a': x['count_clim_a'] + y['count_clim_a'],
+        'count_clim_b': x['count_clim_b'] + y['count_clim_b'],
+        'c_ab': x['c_ab'] + y['c_ab'] + delta_a * delta_b * weight,
+        'm2_a': x['m2_a'] + y['m2_a'] + delta_a ** 2 * weight,
+        'm2_b': x['m2_b'] + y['m2_b'] + delta_b ** 2 * weight,
+        'mean_a': x['mean_a'] + delta_a * fraction,
+        'mean_b': x['mean_b'] + delta_b * fraction
+    }
+
+
+def _moments(a, b, groups, in_clim, in_corr, n_groups):
+    # Moments of one time chunk, from its means, per month/season
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    shape = (n_groups,) + a.shape[1:]
+    moments = { k: np.zeros(shape) for k in MOMENTS }
+
+    valid_a = ~np.isnan(a)
+    valid_b = ~np.isnan(b)
+    valid = valid_a & valid_b
+    a = np.where(valid, a, 0)
+    b = np.where(valid, b, 0)
+
+    for g in np.unique(groups):
+        clim = (groups == g) & in_clim
+        moments['count_clim_a'][g] = valid_a[clim].sum(axis=0)
+        moments['count_clim_b'][g] = valid_b[clim].sum(axis=0)
+
+        steps = (groups == g) & in_corr
+        if not steps.any():
+            continue
+
+        count = valid[steps].sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_a = np.where(count > 0, a[steps].sum(axis=0) / count, 0)
+            mean_b = np.where(count > 0, b[steps].sum(axis=0) / count, 0)
+
+        deviation_a = np.where(valid[steps], a[steps] - mean_a, 0)
+        deviation_b = np.where(valid[steps], b[steps] - mean_b, 0)
+
+        moments['count'][g] = count
+        moments['mean_a'][g] = mean_a
+        moments['mean_b'][g] = mean_b
+        moments['m2_a'][g] = (deviation_a ** 2).sum(axis=0)
+        moments['m2_b'][g] = (deviation_b ** 2).sum(axis=0)
+        moments['c_ab'][g] = (deviation_a * deviation_b).sum(axis=0)
+
+    return moments
+
+
+def _nested(merged, key):
+    # Nested lists of the blocks of one moment, for np.block()
+    if type(merged) == dict:
+        return merged[key]
+
+    if merged.ndim == 0:
+        return merged[()][key]
+
+    return [_nested(m, key) for m in merged]
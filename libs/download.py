@@ -0,0 +1,487 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+import hashlib
+import http.client
+import json
+import re
+import threading
+import urllib.parse
+
+# Keep-alive connections, one pool per worker thread keyed by (scheme, host)
+_connections = threading.local()
+_manifest_lock = threading.Lock()
+
+MANIFEST_FILENAME = '_manifest.json'
+
+
+def checksum_file(path, checksum_type='SHA256', block_size=1024 * 1024):
+    '''
+    Function: checksum_file()
+        Calculate the checksum of a local file
+
+    Inputs:
+    - path (string): path of file to checksum
+    - checksum_type (string): hashlib algorithm name, e.g. 'SHA256', 'MD5'
+        default: 'SHA256'
+    - block_size (int): number of bytes to read at a time
+        default: 1 MiB
+
+    Outputs:
+    - (string): hex digest
+    '''
+    digest = hashlib.new(checksum_type.lower())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def close_connections():
+    '''
+    Function: close_connections()
+        Close all keep-alive connections opened by the current thread, e.g.
+        by download_file(). Connections of download_files() workers are
+        closed by download_files()
+    '''
+    _close_pool(getattr(_connections, 'pool', {}))
+    _connections.pool = {}
+
+
+def download_file(
+    url,
+    path,
+    headers={},
+    checksum=None,
+    checksum_type='SHA256',
+    size=None,
+    block_size=1024 * 1024,
+    max_redirects=5,
+    retries=3,
+    timeout=120
+):
+    '''
+    Function: download_file()
+        Download a single file over a keep-alive connection. The file is
+        streamed into `{path}.part`, which is resumed with an HTTP Range
+        request if it already exists (e.g. after an interrupted download),
+        and only moved to `path` once the checksum (if known) is verified.
+
+    Inputs:
+    - url (string): remote file url
+    - path (string): local path to save to
+    - headers (dict): request headers
+        default: {}
+    - checksum (string): expected hex digest
+        default: None (not verified)
+    - checksum_type (string): hashlib algorithm name of checksum
+        default: 'SHA256'
+    - size (int): expected size in bytes
+        default: None (not verified)
+    - block_size (int): number of bytes to read at a time
+        default: 1 MiB
+    - max_redirects (int): maximum number of redirects to follow
+        default: 5
+    - retries (int): number of attempts before giving up
+        default: 3
+    - timeout (int): socket timeout in seconds
+        default: 120
+
+    Outputs:
+    - (dict): manifest record, e.g.
+        {
+            'checksum': (string),
+            'checksum_type': (string),
+            'size': (int),
+            'status': 'verified' | 'unverified',
+            'url': (string)
+        }
+    '''
+    path = Path(path)
+    part_path = Path(f'{path}.part')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    error = None
+
+    for attempt in range(retries):
+        try:
+            digest = _download_to_part(
+                url,
+                part_path,
+                headers,
+                checksum_type,
+                block_size,
+                max_redirects,
+                timeout
+            )
+        except (OSError, http.client.HTTPException) as e:
+            # Keep the .part file so the next attempt can resume from it
+            error = e
+            _drop_connection(url)
+            continue
+
+        part_size = part_path.stat().st_size
+        if size != None and part_size != int(size):
+            error = ValueError(f'Size mismatch: expected {size}, got {part_size}')
+            part_path.unlink()
+            continue
+
+        if checksum != None and digest != checksum.lower():
+            error = ValueError(f'Checksum mismatch: expected {checksum}, got {digest}')
+            part_path.unlink()
+            continue
+
+        part_path.replace(path)
+
+        return {
+            'checksum': digest,
+            'checksum_type': checksum_type,
+            'size': part_size,
+            'status': 'verified' if checksum != None else 'unverified',
+            'url': url
+        }
+
+    raise ConnectionError(f'Failed to download {url} after {retries} attempts: {error}')
+
+
+def download_files(
+    files,
+    local_path,
+    headers={},
+    max_workers=4,
+    verbose=True
+):
+    '''
+    Function: download_files()
+        Download a list of files concurrently with a bounded worker pool,
+        skipping files that have already been downloaded and verified.
+        Progress is recorded in a per-directory manifest
+        `{local_path}/_manifest.json`.
+
+    Inputs:
+    - files (array): files to download, formatted as
+        {
+            'checksum': (string or None),
+            'checksum_type': (string or None),
+            'filename': (string),
+            'size': (int or None),
+            'url': (string)
+        }
+    - local_path (string): path to save to (not including filename)
+    - headers (dict): request headers
+        default: {}
+    - max_workers (int): maximum number of concurrent downloads
+        default: 4
+    - verbose (bool): whether to print progress
+        default: True
+
+    Outputs:
+    - (array): array of local paths, in the same order as files
+    '''
+    manifest = read_manifest(local_path)
+    local_filenames = []
+    pending = []
+
+    for item in files:
+        local_filename = Path(local_path, item['filename'])
+        local_filenames.append(str(local_filename))
+
+        if is_downloaded(local_filename, item, manifest.get(item['filename'])):
+            verbose and print(f'   -> Already exists, skipping: {local_filename}')
+            if item['filename'] not in manifest:
+                record_manifest(local_path, item['filename'], {
+                    'checksum': item.get('checksum'),
+                    'checksum_type': item.get('checksum_type'),
+                    'size': local_filename.stat().st_size,
+                    'status': 'verified' if item.get('checksum') != None else 'unverified',
+                    'url': item['url']
+                })
+            continue
+
+        pending.append(item)
+
+    if len(pending) == 0:
+        return local_filenames
+
+    # Connections are kept alive between the downloads of each worker
+    # thread, and closed once all downloads are done
+    pools = {}
+    def download(item):
+        try:
+            return download_file(
+                item['url'],
+                Path(local_path, item['filename']),
+                headers=headers,
+                checksum=item.get('checksum'),
+                checksum_type=item.get('checksum_type') or 'SHA256',
+                size=item.get('size')
+            )
+        finally:
+            pools[threading.get_ident()] = getattr(_connections, 'pool', {})
+
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = { executor.submit(download, item): item for item in pending }
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    verbose and print(f'   -> Failed: {item["url"]}', f'   -> {e}', sep='\n')
+                    errors.append(e)
+                    continue
+
+                record_manifest(local_path, item['filename'], record)
+                verbose and print(f'   -> Downloaded ({record["status"]}): {item["filename"]}')
+    finally:
+        for pool in pools.values():
+            _close_pool(pool)
+
+    if len(errors) > 0:
+        raise ConnectionError(f'{len(errors)} of {len(pending)} downloads failed')
+
+    return local_filenames
+
+
+def files_from_search(results, time_slice=None, filter_daterange=None):
+    '''
+    Function: files_from_search()
+        Convert ESGF `search_files` response docs into a list of
+        files to pass to download_files()
+
+    Inputs:
+    - results (array): response['response']['docs'] from
+        `https://esgf-index1.ceda.ac.uk/search_files/{item_id}/{item_index_node}/`
+    - time_slice (slice): only include files overlapping time_slice
+        default: None
+    - filter_daterange (function): function(time_slice, filename) returning
+        True if the file is out of bounds
+        default: None
+
+    Outputs:
+    - (array): array of files
+    '''
+    files = []
+    for item in results:
+        file_url = [url.split('|')[0] for url in item['url'] if 'HTTPServer' in url]
+        if len(file_url) == 0:
+            continue
+
+        file_url = file_url[0]
+        filename = urllib.parse.urlparse(file_url).path.split('/')[-1]
+
+        if time_slice != None and filter_daterange != None:
+            if filter_daterange(time_slice, filename):
+                continue
+
+        checksum = item.get('checksum')
+        checksum_type = item.get('checksum_type')
+        files.append({
+            'checksum': checksum[0] if type(checksum) == list else checksum,
+            'checksum_type': checksum_type[0] if type(checksum_type) == list else checksum_type,
+            'filename': filename,
+            'size': item.get('size'),
+            'url': file_url
+        })
+
+    return files
+
+
+def is_downloaded(local_filename, item, record=None):
+    '''
+    Function: is_downloaded()
+        Check whether a local file is a complete copy of a remote file.
+        Files of a different size than the remote file are not. A manifest
+        record with a matching checksum is trusted, otherwise the checksum
+        of the local file is calculated.
+
+    Inputs:
+    - local_filename (Path): local file path
+    - item (dict): file from files_from_search()
+    - record (dict): manifest record for the file
+        default: None
+
+    Outputs:
+    - (bool)
+    '''
+    if not Path(local_filename).exists():
+        return False
+
+    # e.g. partial files left by urlretrieve before downloads were resumable
+    size = item.get('size')
+    if size != None and Path(local_filename).stat().st_size != int(size):
+        return False
+
+    checksum = item.get('checksum')
+    if checksum == None:
+        # Nothing else to verify against, so trust files of the expected size
+        return True
+
+    if record != None and record.get('status') == 'verified':
+        return record.get('checksum') == checksum.lower()
+
+    checksum_type = item.get('checksum_type') or 'SHA256'
+    return checksum_file(local_filename, checksum_type) == checksum.lower()
+
+
+def read_manifest(local_path):
+    '''
+    Function: read_manifest()
+        Read the download manifest for a directory
+
+    Inputs:
+    - local_path (string): directory containing `_manifest.json`
+
+    Outputs:
+    - (dict): manifest records keyed by filename
+    '''
+    manifest_path = Path(local_path, MANIFEST_FILENAME)
+    if not manifest_path.exists():
+        return {}
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def record_manifest(local_path, filename, record):
+    '''
+    Function: record_manifest()
+        Add or update a record in the download manifest for a directory.
+        Safe to call from multiple threads.
+
+    Inputs:
+    - local_path (string): directory containing `_manifest.json`
+    - filename (string): filename of record
+    - record (dict): record, see download_file()
+    '''
+    manifest_path = Path(local_path, MANIFEST_FILENAME)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with _manifest_lock:
+        manifest = read_manifest(local_path)
+        manifest[filename] = {
+            **record,
+            'recorded': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        }
+
+        tmp_path = Path(f'{manifest_path}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+        tmp_path.replace(manifest_path)
+
+
+def _close_pool(pool):
+    for conn in pool.values():
+        conn.close()
+
+    pool.clear()
+
+
+def _download_to_part(url, part_path, headers, checksum_type, block_size, max_redirects, timeout):
+    digest = hashlib.new(checksum_type.lower())
+    offset = 0
+    if part_path.exists():
+        # Hash what we already have so the final digest covers the whole file
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+                offset += len(block)
+
+    request_headers = { **headers, 'Connection': 'keep-alive' }
+    if offset > 0:
+        request_headers['Range'] = f'bytes={offset}-'
+
+    response = _request(url, request_headers, max_redirects, timeout)
+
+    if response.status == 416:
+        # Range not satisfiable, i.e. the .part file is already complete
+        response.read()
+        return digest.hexdigest()
+
+    if response.status == 200 and offset > 0:
+        # Server ignored the Range header, start again from scratch
+        digest = hashlib.new(checksum_type.lower())
+        offset = 0
+
+    if response.status not in [200, 206]:
+        response.read()
+        raise ConnectionError(f'An error occurred downloading {url}: status {response.status}')
+
+    if response.status == 206 and _range_start(response) != offset:
+        # The body doesn't continue the .part file, so it can't be appended;
+        # start again from scratch on the next attempt
+        part_path.unlink(missing_ok=True)
+        raise http.client.HTTPException(
+            f'Unexpected Content-Range downloading {url}: {response.getheader("Content-Range")}, expected bytes {offset}-'
+        )
+
+    written = 0
+    with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+        for block in iter(lambda: response.read(block_size), b''):
+            f.write(block)
+            digest.update(block)
+            written += len(block)
+
+    # http.client ends the body early without an error if the connection is
+    # dropped, so raise to keep the .part file and resume it
+    length = response.getheader('Content-Length')
+    if length != None and written < int(length):
+        raise http.client.IncompleteRead(b'', int(length) - written)
+
+    return digest.hexdigest()
+
+
+def _drop_connection(url):
+    parsed = urllib.parse.urlparse(url)
+    pool = getattr(_connections, 'pool', {})
+    conn = pool.pop((parsed.scheme, parsed.netloc), None)
+    if conn != None:
+        conn.close()
+
+
+def _get_connection(parsed, timeout):
+    if not hasattr(_connections, 'pool'):
+        _connections.pool = {}
+
+    key = (parsed.scheme, parsed.netloc)
+    if key not in _connections.pool:
+        connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        _connections.pool[key] = connection_class(parsed.netloc, timeout=timeout)
+
+    return _connections.pool[key]
+
+
+def _range_start(response):
+    # First byte of a 206 response body, from `Content-Range: bytes {start}-{end}/{size}`
+    match = re.match(r'^bytes (\d+)-', response.getheader('Content-Range') or '')
+
+    return int(match[1]) if match else None
+
+
+def _request(url, headers, max_redirects, timeout):
+    for i in range(max_redirects + 1):
+        parsed = urllib.parse.urlparse(url)
+        path = parsed.path + (f'?{parsed.query}' if parsed.query else '')
+        conn = _get_connection(parsed, timeout)
+
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            # Stale keep-alive connection, reconnect once and retry
+            _drop_connection(url)
+            conn = _get_connection(parsed, timeout)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+
+        if response.status in [301, 302, 303, 307, 308]:
+            location = response.getheader('Location')
+            response.read()
+            url = urllib.parse.urljoin(url, location)
+            continue
+
+        return response
+
+    raise ConnectionError(f'Too many redirects: {url}')
@@ -1,12 +1,34 @@
+import dask
 import libs.analysis
+import libs.cells
+import libs.execution
 import libs.local
 import libs.plot
+import libs.regions
 import libs.vars
 import numpy as np
 import xarray
 xarray.set_options(keep_attrs=True);
 
+# Statistics of time_series_weighted()/time_series_regional():
+# 'delta'/'delta_relative' are monthly anomalies (absolute/%) from a
+# climatology, see libs.analysis.climatology_monthly(), and 'min'/'max' the
+# envelope of members
+STATISTICS = ['delta', 'delta_relative', 'max', 'min', 'raw', 'smoothed']
+
 def calc_variable_mean(data, subset=None, to_array='variable', var_name='Ensemble mean'):
+    if type(data) == xarray.DataArray and 'member' in data.dims:
+        # Stacked ensemble, see stack(): append the mean as another member
+        data = data.drop_sel(member=var_name, errors='ignore')
+        ds = data if subset == None else data.sel(member=subset)
+        member_coords = [c for c in data.coords if data[c].dims == ('member',) and c != 'member']
+        ensemble_mean = ds.drop_vars(member_coords).mean('member', skipna=True)\
+            .expand_dims(member=[var_name])\
+            .assign_coords({ c: ('member', [var_name]) for c in member_coords })\
+            .assign_coords(color=('member', ['#000']), label=('member', ['Ensemble mean']))
+
+        return xarray.concat([data, ensemble_mean], dim='member', coords='minimal', compat='override')
+
     # Just in case 'Ensemble mean' already exists, delete + re-calculate
     if var_name in data:
         del data[var_name]
@@ -27,9 +49,55 @@ def get_and_preprocess(
     component,
     experiment,
     variable_id,
-    preprocess=lambda x, e, s, vl: x
+    preprocess=lambda x, e, s, vl: x,
+    access=None,
+    stacked=False,
+    packed=False,
+    members=None
 ):
+    '''
+    Function: get_and_preprocess()
+        Load a variable for all ensemble members, masked to the Arctic NSIDC
+        regions
+
+    Inputs:
+    - component (string): model component, e.g. 'Amon', 'SImon'
+    - experiment (string): model experiment, e.g. 'ssp585'
+    - variable_id (string): variable, e.g. 'pr'
+    - preprocess (function): function(data, experiment, source_id, variant_label)
+        applied to each member
+        default: identity
+    - access (string): how the data will be read, used to choose the chunk
+        layout of Zarr stores (see libs.store.choose_layout())
+        allowed values:
+            'series': every time step of the Arctic regions, e.g. for
+                time_series_weighted(). Data and weight are cropped to the
+                bounding box of the regions
+            'maps': a 20 year slice of the whole grid, e.g. for
+                libs.plot.calendar_division_spatial()
+        default: None
+    - stacked (bool): whether to return the ensemble as one DataArray with a
+        member dimension (see stack()) instead of an array of members
+        default: False
+    - packed (bool): whether to keep only the Arctic NSIDC cells, along a 1D
+        'cell' dimension (see libs.cells.pack()), instead of masking the
+        full grid. Packed Zarr copies are read where they exist (see
+        libs.store.pack_group()). access is ignored, as only the cells are
+        read
+        default: False
+    - members (array): source_ids of the members to load, or ensemble
+        items formatted as libs.vars.ensemble() (e.g. synthetic members,
+        see libs.synthetic.ensemble())
+        default: None (all members of libs.vars.ensemble())
+
+    Outputs:
+    - (tuple): (ensemble, weight)
+    '''
     ensemble = libs.vars.ensemble()
+    if members != None and all(type(m) == dict for m in members):
+        ensemble = [dict(item) for item in members]
+    elif members != None:
+        ensemble = [item for item in ensemble if item['source_id'] in members]
 
     # Since variables have been regridded, can use UKESM areacello
     # for all ensemble member weighted means/sums
@@ -42,6 +110,23 @@ def get_and_preprocess(
     nsidc_all = [
         r for r in libs.vars.nsidc_regions() if r['label'] == 'All'
     ][0]
+    in_regions = np.isin(nsidc_mask.values, nsidc_all['values'])
+
+    selection = None
+    if packed:
+        index = libs.cells.cell_index(areacello.latitude, areacello.longitude)
+        weight = libs.cells.pack(weight, index)
+    elif access == 'series':
+        # Cells outside the regions are masked, so only read their bounding box
+        rows, cols = np.nonzero(in_regions)
+        selection = {
+            weight.dims[0]: slice(rows.min(), rows.max() + 1),
+            weight.dims[1]: slice(cols.min(), cols.max() + 1)
+        }
+        weight = weight.isel(selection)
+        in_regions = in_regions[selection[weight.dims[0]], selection[weight.dims[1]]]
+    elif access == 'maps':
+        selection = { 'time': slice(0, 240) }
 
     # Retrieve all ensemble data
     for i, item in enumerate(ensemble):
@@ -54,7 +139,9 @@ def get_and_preprocess(
             'source_id': source_id,
             'variable_id': variable_id,
             'variant_label': variant_label,
-            'include_hist': True
+            'include_hist': True,
+            'packed': packed,
+            'selection': selection
         }
 
         if variable_id in item:
@@ -67,10 +154,18 @@ def get_and_preprocess(
         ]:
             continue
 
-        # Mask to arctic + nsidc regions
-        var_base[variable_id] = var_base[variable_id]\
-            .where(var_base[variable_id].latitude > 60)\
-            .where(np.isin(nsidc_mask.values, nsidc_all['values']))
+        if packed:
+            if var_base.sizes['cell'] != weight.sizes['cell']:
+                print('Error: packed cells differ from weight', f'-> {source_id} {variant_label}', sep='\n')
+                continue
+        else:
+            if access == 'series':
+                var_base = var_base.isel({ d: s for d, s in selection.items() if d in var_base.dims })
+
+            # Mask to arctic + nsidc regions
+            var_base[variable_id] = var_base[variable_id]\
+                .where(var_base[variable_id].latitude > 60)\
+                .where(in_regions)
 
         var_base[variable_id].attrs['label'] = var_base.attrs['source_id']
         var_base[variable_id].attrs['color'] = item['color']
@@ -85,9 +180,58 @@ def get_and_preprocess(
 
     ensemble = [item for item in ensemble if 'data' in item]
 
+    if stacked:
+        return stack(ensemble), weight
+
     return ensemble, weight
 
 
+def stack(ensemble, dim='member'):
+    '''
+    Function: stack()
+        Stack ensemble members into one DataArray with a member dimension,
+        so analyses run as a single operation over all members. Members are
+        all on the UKESM grid, so spatial coordinates are taken from the
+        first member.
+
+    Inputs:
+    - ensemble (array or xarray.Dataset): array with items formatted as
+        { 'color': (string), 'data': (xarray), 'label': (string) },
+        or a Dataset with one variable per member (e.g. from
+        libs.local.get_ensemble_series()), excluding 'Ensemble mean'
+    - dim (string): name of member dimension
+        default: 'member'
+
+    Outputs:
+    - (xarray.DataArray): stacked data, with member labels as the member
+        coordinate and color, label, source_id and variant_label
+        coordinates along it
+    '''
+    if type(ensemble) == xarray.Dataset:
+        ensemble = [{
+            'color': ensemble[v].attrs.get('color'),
+            'data': ensemble[v],
+            'label': ensemble[v].attrs.get('label', v)
+        } for v in ensemble.data_vars if v != 'Ensemble mean']
+
+    data = xarray.concat(
+        [item['data'].drop_vars('height', errors='ignore') for item in ensemble],
+        dim=dim,
+        coords='minimal',
+        compat='override',
+        join='override',
+        combine_attrs='drop_conflicts'
+    )
+
+    return data.assign_coords({
+        dim: [item['label'] for item in ensemble],
+        'color': (dim, [item.get('color') for item in ensemble]),
+        'label': (dim, [item['label'] for item in ensemble]),
+        'source_id': (dim, [item.get('source_id', item['label']) for item in ensemble]),
+        'variant_label': (dim, [item.get('variant_label', '') for item in ensemble])
+    })
+
+
 def time_series_full_variability(ensemble_series, plot_kwargs):
     for member in list(ensemble_series):
         kwargs = dict(plot_kwargs)
@@ -101,35 +245,220 @@ def time_series_weighted(
     weighting_method,
     weighting_process,
     fillna=0,
-    item_plot_kwargs={}
+    item_plot_kwargs={},
+    statistics=None,
+    climatology_period=('1980-01-01', '2011-01-01')
 ):
-    ensemble_weighted_reduced = []
-    ensemble_weighted_reduced_smooth = []
+    '''
+    Function: time_series_weighted()
+        Reduce each member to a weighted sum or mean over its spatial
+        dimensions, and the smoothed series of it. If statistics are
+        requested, the reduction of all members is computed once, in a
+        single compute, and every statistic is derived from it in memory.
+
+    Inputs:
+    - ensemble (array or xarray.DataArray): array with items formatted as
+        { 'color': (string), 'data': (xarray), 'label': (string) },
+        or a stacked ensemble (see stack())
+    - weight (xarray): weight of each cell, e.g. areacello
+    - weighting_method (string): 'sum' or 'mean'
+    - weighting_process (function): function(data) applied before reducing
+    - fillna (float): value to fill missing reduced values with
+        default: 0
+    - item_plot_kwargs (dict): plot_kwargs of each item
+        default: {}
+    - statistics (array): statistics to return, any of STATISTICS
+        default: None (lazy (reduced, smoothed) tuple)
+    - climatology_period (tuple): (start, end) dates of the climatology of
+        'delta' and 'delta_relative'
+        default: ('1980-01-01', '2011-01-01')
 
-    for item in ensemble:
-        item_data = weighting_process(item['data'])
-        item_data_weighted = item_data.weighted(weight)
+    Outputs:
+    - (tuple): (reduced, smoothed), in the format of ensemble, or if
+        statistics are set
+    - (dict): each statistic, see _series_statistics()
+    '''
+    members = [ensemble] if type(ensemble) == xarray.DataArray else [item['data'] for item in ensemble]
+    members_reduced = []
+
+    for data in members:
+        data_weighted = weighting_process(data).weighted(weight)
 
         # Reduce data, i.e. taking sum or average over spatial dimensions
-        item_data_reduced = getattr(item_data_weighted, weighting_method)(
-            dim=item_data_weighted.weights.dims,
+        data_reduced = getattr(data_weighted, weighting_method)(
+            dim=data_weighted.weights.dims,
             skipna=True
         )
 
         if fillna != None:
-            item_data_reduced = item_data_reduced.fillna(fillna)
+            data_reduced = data_reduced.fillna(fillna)
+
+        members_reduced.append(data_reduced)
+
+    if statistics != None:
+        with libs.execution.progress():
+            members_reduced = dask.compute(*members_reduced)
+
+    results = _series_statistics(
+        ensemble,
+        members_reduced,
+        statistics or ['raw', 'smoothed'],
+        climatology_period,
+        item_plot_kwargs
+    )
+
+    if statistics != None:
+        return results
 
-        item_base_kwargs = {
+    return results['raw'], results['smoothed']
+
+
+def time_series_regional(
+    ensemble,
+    weight,
+    weighting_method,
+    weighting_process,
+    regions=libs.vars.nsidc_regions(),
+    fillna=0,
+    item_plot_kwargs={},
+    statistics=None,
+    climatology_period=('1980-01-01', '2011-01-01')
+):
+    '''
+    Function: time_series_regional()
+        Same as time_series_weighted(), for every NSIDC region at once. A
+        sparse region x cell weight matrix (see libs.regions.weight_matrix())
+        is built once, and every member is reduced over all regions in a
+        single pass, so each member is read once however many regions there
+        are. The reduced series are small, so are computed together before
+        returning.
+
+    Inputs:
+    - ensemble (array or xarray.DataArray): array with items formatted as
+        { 'color': (string), 'data': (xarray), 'label': (string) },
+        or a stacked ensemble (see stack())
+    - weight (xarray): weight of each cell, e.g. areacello, from
+        get_and_preprocess()
+    - weighting_method (string): 'sum' or 'mean'
+    - weighting_process (function): function(data) applied before reducing
+    - regions (array): regions, see libs.vars.nsidc_regions()
+        default: libs.vars.nsidc_regions()
+    - fillna (float): value to fill missing reduced values with
+        default: 0
+    - item_plot_kwargs (dict): plot_kwargs of each item
+        default: {}
+    - statistics (array): statistics to return, any of STATISTICS
+        default: None ((reduced, smoothed) tuple)
+    - climatology_period (tuple): (start, end) dates of the climatology of
+        'delta' and 'delta_relative'
+        default: ('1980-01-01', '2011-01-01')
+
+    Outputs:
+    - (tuple): (reduced, smoothed), formatted as for time_series_weighted(),
+        with a 'region' dimension of region labels, or if statistics are set
+    - (dict): each statistic, see _series_statistics()
+    '''
+    matrix = libs.regions.weight_matrix(weight, regions=regions)
+    members = [ensemble] if type(ensemble) == xarray.DataArray else [item['data'] for item in ensemble]
+    members_reduced = [
+        libs.regions.reduce(weighting_process(data), matrix, method=weighting_method)
+        for data in members
+    ]
+
+    with libs.execution.progress():
+        members_reduced = dask.compute(*members_reduced)
+
+    if fillna != None:
+        members_reduced = [data.fillna(fillna) for data in members_reduced]
+
+    results = _series_statistics(
+        ensemble,
+        members_reduced,
+        statistics or ['raw', 'smoothed'],
+        climatology_period,
+        item_plot_kwargs
+    )
+
+    if statistics != None:
+        return results
+
+    return results['raw'], results['smoothed']
+
+
+def unstack(data, dim='member'):
+    '''
+    Function: unstack()
+        Split a stacked ensemble (see stack()) into an array of members, e.g.
+        for plotting functions
+
+    Inputs:
+    - data (xarray.DataArray): stacked data
+    - dim (string): name of member dimension
+        default: 'member'
+
+    Outputs:
+    - (array): array with items formatted as
+        { 'color': (string), 'data': (xarray), 'label': (string) }
+    '''
+    ensemble = []
+    for member in data[dim].values:
+        item_data = data.sel({ dim: member })
+        ensemble.append({
+            'color': str(item_data['color'].values) if 'color' in item_data.coords else None,
+            'data': item_data,
+            'label': str(item_data['label'].values) if 'label' in item_data.coords else str(member)
+        })
+
+    return ensemble
+
+
+def _series_statistics(ensemble, members_reduced, statistics, climatology_period, item_plot_kwargs):
+    '''
+    Derive statistics from the reduced series of each member, formatted as
+    { statistic: (array or xarray.DataArray) } in the format of ensemble.
+    'min'/'max' are envelopes over members: a single 'Ensemble min'/'Ensemble
+    max' item, or reduced over the member dimension of a stacked ensemble.
+    '''
+    processes = {
+        'delta': lambda x: libs.analysis.climatology_monthly(x, *climatology_period),
+        'delta_relative': lambda x: libs.analysis.climatology_monthly(x, *climatology_period, relative=True),
+        'raw': lambda x: x,
+        'smoothed': lambda x: libs.analysis.smoothed_mean(x.fillna(0))
+    }
+    stacked = type(ensemble) == xarray.DataArray
+    results = {}
+
+    for statistic in statistics:
+        if statistic not in STATISTICS:
+            raise ValueError(f'Unknown statistic: {statistic}, allowed values: {STATISTICS}')
+
+        if statistic in ['max', 'min']:
+            data = members_reduced[0] if stacked else xarray.concat(
+                members_reduced,
+                dim='member',
+                coords='minimal',
+                compat='override'
+            )
+            envelope = getattr(data, statistic)('member')
+            envelope.attrs['plot_kwargs'] = item_plot_kwargs
+            results[statistic] = envelope if stacked else [{
+                'color': '#000',
+                'data': envelope,
+                'label': f'Ensemble {statistic}',
+                'plot_kwargs': item_plot_kwargs
+            }]
+            continue
+
+        if stacked:
+            results[statistic] = processes[statistic](members_reduced[0])
+            results[statistic].attrs['plot_kwargs'] = item_plot_kwargs
+            continue
+
+        results[statistic] = [{
             'color': item['color'],
+            'data': processes[statistic](data),
             'label': item['label'],
             'plot_kwargs': item_plot_kwargs
-        }
-
-        ensemble_weighted_reduced.append(
-            { **item_base_kwargs, **{ 'data': item_data_reduced } }
-        )
-        ensemble_weighted_reduced_smooth.append(
-            { **item_base_kwargs, **{ 'data': libs.analysis.smoothed_mean(item_data_reduced.fillna(0)) } }
-        )
+        } for item, data in zip(ensemble, members_reduced)]
 
-    return ensemble_weighted_reduced, ensemble_weighted_reduced_smooth
+    return results
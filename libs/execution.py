@@ -0,0 +1,168 @@
+from contextlib import nullcontext
+from dask.diagnostics import ProgressBar
+import dask
+
+# Dask chunks used by the libs.local loaders, keyed by model component (or
+# 'obs'/'series'). Processed data is on the ORCA1 grid (330 x 360), so one
+# time step of the whole grid is ~0.5 MB: spatial maps are only ever split
+# along time, in chunks of ~50-100 MB.
+CHUNKS = {
+    # Precipitation/evaporation, mostly reduced to regional time series
+    'Amon': { 'time': 240 },
+    # Fixed fields, e.g. areacello
+    'Ofx': {},
+    'Omon': { 'time': 120 },
+    # Sea ice, mostly averaged by month/season over 20 year slices
+    'SImon': { 'time': 120 },
+    'obs': { 'time': 120 },
+    # Regional time series from _data/_cache, small enough for one chunk
+    'series': { 'time': -1 }
+}
+
+# Default chunks for components not in CHUNKS
+DEFAULT_CHUNKS = { 'time': 120 }
+
+BACKENDS = ['batch', 'cluster', 'processes', 'threads']
+
+_client = None
+_cluster = None
+# dask.config.set() of setup(), undone by shutdown()
+_config = None
+
+
+def chunks_for(component):
+    '''
+    Function: chunks_for()
+        Get the dask chunks to open data of a model component with
+
+    Inputs:
+    - component (string): model component, e.g. 'Amon', 'SImon', or 'obs',
+        'series'
+
+    Outputs:
+    - (dict): chunks, e.g. { 'time': 120 }
+    '''
+    return dict(CHUNKS.get(component, DEFAULT_CHUNKS))
+
+
+def client():
+    '''
+    Function: client()
+        Get the distributed client created by setup(), if any
+
+    Outputs:
+    - (distributed.Client or None)
+    '''
+    return _client
+
+
+def progress():
+    '''
+    Function: progress()
+        Progress feedback for a computation, as a context manager. Local
+        schedulers print a ProgressBar; distributed clusters report progress
+        on their dashboard, so nothing is printed.
+
+    Outputs:
+    - (context manager)
+    '''
+    return nullcontext() if _client != None else ProgressBar()
+
+
+def setup(
+    backend='threads',
+    n_workers=4,
+    threads_per_worker=1,
+    memory_limit='4GB',
+    local=True,
+    queue=None,
+    walltime='02:00:00'
+):
+    '''
+    Function: setup()
+        Set the dask execution backend for all subsequent computations,
+        shutting down any cluster started by a previous call
+
+    Inputs:
+    - backend (string): one of
+        'threads': threaded scheduler in this process (dask default)
+        'processes': multiprocessing scheduler, no shared memory
+        'cluster': distributed LocalCluster with n_workers worker processes
+        'batch': distributed cluster of batch jobs (dask_jobqueue.SLURMCluster),
+            one worker per job. If local is True, a LocalCluster with the same
+            workers stands in for the batch queue, e.g. for testing
+        default: 'threads'
+    - n_workers (int): number of workers (threads, processes or batch jobs)
+        default: 4
+    - threads_per_worker (int): threads per worker process ('cluster', 'batch')
+        default: 1
+    - memory_limit (string): memory limit per worker ('cluster', 'batch')
+        default: '4GB'
+    - local (bool): whether 'batch' runs on a LocalCluster
+        default: True
+    - queue (string): batch queue, e.g. 'short-serial'
+        default: None
+    - walltime (string): batch job walltime
+        default: '02:00:00'
+
+    Outputs:
+    - (distributed.Client or None): client, for 'cluster' and 'batch'
+    '''
+    global _client, _cluster, _config
+
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend: {backend}, allowed values: {BACKENDS}')
+
+    shutdown()
+
+    if backend in ['processes', 'threads']:
+        _config = dask.config.set(scheduler=backend, num_workers=n_workers)
+        return None
+
+    from distributed import Client, LocalCluster
+
+    if backend == 'cluster' or local:
+        _cluster = LocalCluster(
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            memory_limit=memory_limit,
+            processes=True
+        )
+    else:
+        from dask_jobqueue import SLURMCluster
+
+        _cluster = SLURMCluster(
+            cores=threads_per_worker,
+            memory=memory_limit,
+            processes=1,
+            queue=queue,
+            walltime=walltime
+        )
+        _cluster.scale(jobs=n_workers)
+
+    _client = Client(_cluster)
+    print(f'Dask dashboard: {_client.dashboard_link}')
+
+    return _client
+
+
+def shutdown():
+    '''
+    Function: shutdown()
+        Close the cluster started by setup(), if any, and return to the
+        scheduler configured before setup() (by default, dask's threaded
+        scheduler for arrays)
+    '''
+    global _client, _cluster, _config
+
+    if _client != None:
+        _client.close()
+        _client = None
+
+    if _cluster != None:
+        _cluster.close()
+        _cluster = None
+
+    if _config != None:
+        _config.__exit__(None, None, None)
+        _config = None
@@ -0,0 +1,1044 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dask.base import tokenize
+from pathlib import Path
+import argparse
+import ast
+import dask
+import datetime
+import fnmatch
+import hashlib
+import importlib.util
+import json
+import libs.analysis
+import libs.cells
+import libs.ensemble
+import libs.local
+import libs.plot
+import libs.series
+import libs.vars
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import sys
+import time
+import traceback
+import warnings
+import xarray
+
+FIGURES_DIR = '_data/_figures'
+MANIFEST_PATH = '_data/_cache/_figures/manifest.json'
+
+# Regions of the E/P correlation figure averaged as lower latitudes, the
+# others are averaged as higher latitudes
+LOWER_LATITUDES = ['Labrador', 'Greenland', 'Barents']
+
+# Spatial figures drawn for each ensemble member of every variable: the
+# months to draw, colormesh_kwargs of libs.plot.nstereo() and the text/units
+# of the gridded variable (by default those of libs.vars.variables()).
+# Variables without settings from their notebooks are coloured by their
+# robust range, see SPATIAL_DEFAULTS
+SPATIAL = {
+    'prra_siconc': {
+        'colormesh_kwargs': { 'extend': 'max', 'levels': 21, 'vmin': 0, 'vmax': 1.6 },
+        'times': ['APR', 'MAY', 'JUN', 'JUL', 'AUG']
+    },
+    'siconc': {
+        'colormesh_kwargs': { 'cmap': 'PuBu_r', 'extend': 'neither', 'levels': 11, 'vmin': 0, 'vmax': 100 },
+        'text': 'sea-ice concentration',
+        'units': '%'
+    },
+    'simpconc': {
+        'colormesh_kwargs': { 'extend': 'neither', 'levels': 21, 'vmin': 0, 'vmax': 100 },
+        'times': ['APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP']
+    },
+    'sisnthick': {
+        'colormesh_kwargs': { 'extend': 'max', 'levels': 21, 'vmin': 0, 'vmax': 0.4 }
+    },
+    'sithick': {
+        'colormesh_kwargs': { 'extend': 'max', 'levels': 21, 'vmin': 0, 'vmax': 3 }
+    }
+}
+
+SPATIAL_DEFAULTS = {
+    'colormesh_kwargs': { 'extend': 'both', 'levels': 21, 'robust': True },
+    'times': ['MAR', 'SEP']
+}
+
+# Figures of the annual mean series and 20 year mean seasonal cycles of two
+# variables (solid/dashed), with the observations of obs_variable_ids (see
+# libs.vars.variables()) converted to the units of the variables as
+# obs * obs_scales + obs_offsets. If obs_difference, the first observation
+# is replaced by the difference of the two, e.g. ERA5 rainfall as tp - sf
+TRENDS = {
+    'pr_evspsbl': {
+        'annual_scale': 360,
+        'monthly_scale': 30,
+        'obs_difference': False,
+        'obs_offsets': [0, 0],
+        # Convert s => day, with the notebooks' fixed factor of 100; evaporation
+        # is negative in ERA5
+        'obs_scales': [86400 / 100, -86400 / 100],
+        'obs_variable_ids': ['pr', 'evspsbl'],
+        'title': 'annual mean precipitation (solid) and evaporation (dashed) 60-90°N',
+        'variable_ids': ['pr', 'evspsbl'],
+        'ylabels': ['pr|evspsbl (mm year⁻¹)', 'pr|evspsbl (mm month⁻¹)'],
+        'yranges': [(0, 800), (0, 72)]
+    },
+    'prra_prsn': {
+        'annual_scale': 360,
+        'monthly_scale': 30,
+        'obs_difference': True,
+        'obs_offsets': [0, 0],
+        'obs_scales': [86400 / 100, 86400 / 100],
+        'obs_variable_ids': ['pr', 'prsn'],
+        'title': 'annual mean rainfall (solid) and snowfall (dashed) 60-90°N',
+        'variable_ids': ['prra', 'prsn'],
+        'ylabels': ['prra|prsn (mm year⁻¹)', 'prra|prsn (mm month⁻¹)'],
+        'yranges': [(0, 700), (0, 70)]
+    },
+    'tas_tos': {
+        'annual_scale': 1,
+        'monthly_scale': 1,
+        'obs_difference': False,
+        # K => °C
+        'obs_offsets': [-273.15, -273.15],
+        'obs_scales': [1, 1],
+        'obs_variable_ids': ['tas', 'tos'],
+        'title': 'mean tas (solid) and sst (dashed) 60-90°N (°C)',
+        'variable_ids': ['tas', 'tos'],
+        'ylabels': ['Temperature (°C)', 'Temperature (°C)'],
+        'yranges': [(-16, 10), (-24, 12)]
+    }
+}
+
+
+def build(
+    figures=None,
+    figures_dir=FIGURES_DIR,
+    manifest_path=MANIFEST_PATH,
+    max_workers=4,
+    force=False
+):
+    '''
+    Function: build()
+        Render figures in a process pool of headless (Agg) matplotlib
+        workers, saving them as PNG files in figures_dir. A figure is
+        skipped when the content hashes of its input files (see
+        libs.series.file_record()) and the code that draws it are the same
+        as when it was last rendered, and its outputs still exist, so after
+        one model changes only the figures that read its files are redrawn.
+        Render time is reported per figure.
+
+    Inputs:
+    - figures (array): figures from expand_figures()
+        default: None (all figures of expand_figures())
+    - figures_dir (string): output directory
+        default: FIGURES_DIR
+    - manifest_path (string): path of the manifest of rendered figures
+        default: MANIFEST_PATH
+    - max_workers (int): number of worker processes
+        default: 4
+    - force (bool): whether to redraw every figure
+        default: False
+
+    Outputs:
+    - (dict): result of each figure keyed by figure id, formatted as
+        { 'error': (string or None), 'outputs': (array), 'seconds': (float or None), 'status': (string) }
+        where status is one of 'done', 'failed', 'missing' (an input file
+        does not exist) or 'skipped'
+    '''
+    figures = figures if figures != None else expand_figures()
+    manifest = read_manifest(manifest_path)
+    files = manifest['files']
+
+    results = {}
+    pending = []
+    for figure in figures:
+        outputs = [str(Path(figures_dir, o)) for o in figure['outputs']]
+        if figure['inputs'] == None:
+            results[figure['id']] = { 'error': None, 'outputs': [], 'seconds': None, 'status': 'missing' }
+            print(f'[missing] {figure["id"]}')
+            continue
+
+        for path in figure['inputs']:
+            files[path] = libs.series.file_record(path, files.get(path))
+
+        key = tokenize(
+            figure['figure'],
+            figure['kwargs'],
+            [files[path]['sha1'] for path in figure['inputs']],
+            _code_hash(figure['figure'], files)
+        )
+
+        record = manifest['figures'].get(figure['id'], {})
+        if not force and record.get('key') == key and all(Path(o).exists() for o in outputs):
+            results[figure['id']] = { 'error': None, 'outputs': outputs, 'seconds': None, 'status': 'skipped' }
+            print(f'[skipped] {figure["id"]}')
+            continue
+
+        pending.append((figure, outputs, key))
+
+    Path(figures_dir).mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(max(1, (os.cpu_count() or 1) // max_workers),)
+    ) as executor:
+        futures = {
+            executor.submit(_render, figure, outputs): (figure, key)
+            for figure, outputs, key in pending
+        }
+
+        for future in as_completed(futures):
+            figure, key = futures[future]
+            result = future.result()
+            results[figure['id']] = result
+
+            if result['status'] == 'done':
+                manifest['figures'][figure['id']] = {
+                    'key': key,
+                    'outputs': result['outputs'],
+                    'seconds': result['seconds'],
+                    'time': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+                }
+                _write_manifest(manifest, manifest_path)
+
+            print(f'[{result["status"]}] {figure["id"]}', f'-> {result["seconds"]:.2f}s', sep='\n')
+            result['error'] != None and print(result['error'])
+
+    _write_manifest(manifest, manifest_path)
+
+    return results
+
+
+def expand_figures(experiment='ssp585', variables=None, members=None):
+    '''
+    Function: expand_figures()
+        Get every registered figure (see FIGURES), with the input files
+        each one reads
+
+        - regions: NSIDC regions
+        - series_{variable_id}: smoothed annual mean of each member and the
+            ensemble mean, from the cached 'All' series
+        - monthly_{variable_id}: monthly means of each default time slice
+        - prra_pr_seasonal: ensemble mean monthly prra/pr of 20 year slices
+        - rain_season_length: rain season length of each member
+        - trends_{name}: annual means and 20 year seasonal cycles of two
+            variables and their observations (see TRENDS)
+        - ep_regional: monthly E/P of each region, 2080-2100
+        - ep_siconc_correlation: inter-model correlation of monthly E/P and
+            sea-ice area of each region in 2080-2100, and of the ensemble
+            mean anomalies from 1980-2010
+        - evspsbl_siconc_contribution: 20 year seasonal cycles of the
+            evaporation over sea ice lost since 1980-2010, relative to
+            evaporation and precipitation, one file per higher/lower latitudes
+        - spatial_{variable_id}_{source_id}: monthly means of each default
+            time slice of one member (see SPATIAL), one file per month
+
+    Inputs:
+    - experiment (string): model experiment
+        default: 'ssp585'
+    - variables (array): variable_ids of series, monthly and spatial figures
+        default: None (all of libs.vars.variables())
+    - members (array): source_ids of spatial figures
+        default: None (all members of libs.vars.ensemble())
+
+    Outputs:
+    - (array): figures, formatted as
+        {
+            'figure': (string), key of FIGURES
+            'id': (string),
+            'inputs': (array or None), file paths, None if any are missing
+            'kwargs': (dict), kwargs of the render function
+            'outputs': (array), file names
+        }
+    '''
+    variables = [
+        v for v in libs.vars.variables()
+        if variables == None or v['variable_id'] in variables
+    ]
+    ensemble = [
+        item for item in libs.vars.ensemble()
+        if members == None or item['source_id'] in members
+    ]
+
+    def series_inputs(variable_ids, regions=['All']):
+        paths = [libs.series.series_path(v, experiment, r) for v in variable_ids for r in regions]
+        return paths if all(_exists(p) for p in paths) else None
+
+    regions = [r['label'] for r in libs.vars.nsidc_regions() if len(r['values']) == 1]
+
+    figures = [{
+        'figure': 'regions',
+        'id': 'regions',
+        'inputs': [libs.cells.NSIDC_MASK_PATH] if _exists(libs.cells.NSIDC_MASK_PATH) else None,
+        'kwargs': {},
+        'outputs': ['regions.png']
+    }]
+
+    for v in variables:
+        kwargs = {
+            'experiment': experiment,
+            'text': v['text'],
+            'units': v['units'],
+            'variable_id': v['variable_id']
+        }
+        figures += [{
+            'figure': name,
+            'id': f'{name}_{v["variable_id"]}_{experiment}',
+            'inputs': series_inputs([v['variable_id']]),
+            'kwargs': kwargs,
+            'outputs': [f'{name}_{v["variable_id"]}_{experiment}.png']
+        } for name in ['series', 'monthly']]
+
+    figures += [{
+        'figure': name,
+        'id': f'{name}_{experiment}',
+        'inputs': series_inputs(variable_ids),
+        'kwargs': { 'experiment': experiment },
+        'outputs': [f'{name}_{experiment}.png']
+    } for name, variable_ids in [('prra_pr_seasonal', ['pr', 'prra']), ('rain_season_length', ['prra', 'prsn'])]]
+
+    for name, conf in TRENDS.items():
+        inputs = series_inputs(conf['variable_ids'])
+        obs_inputs = _obs_inputs(conf['obs_variable_ids'])
+        figures.append({
+            'figure': 'trends',
+            'id': f'trends_{name}_{experiment}',
+            'inputs': inputs + obs_inputs if inputs != None and obs_inputs != None else None,
+            'kwargs': { 'experiment': experiment, **conf },
+            'outputs': [f'trends_{name}_{experiment}{suffix}.png' for suffix in ['', '_legend_a', '_legend_b']]
+        })
+
+    figures += [{
+        'figure': 'ep_regional',
+        'id': f'ep_regional_{experiment}',
+        'inputs': series_inputs(['evspsbl', 'pr'], regions),
+        'kwargs': { 'experiment': experiment },
+        'outputs': [f'ep_regional_{experiment}.png']
+    }, {
+        'figure': 'ep_siconc_correlation',
+        'id': f'ep_siconc_correlation_{experiment}',
+        'inputs': series_inputs(['evspsbl', 'pr', 'siconc'], regions),
+        'kwargs': { 'experiment': experiment },
+        'outputs': [f'ep_siconc_correlation_{experiment}{suffix}.png' for suffix in ['', '_legend_a', '_legend_b']]
+    }]
+
+    # Members without all three variables are left out, as by
+    # libs.ensemble.get_and_preprocess()
+    contribution_inputs = []
+    contribution_members = []
+    for item in ensemble:
+        paths = [
+            _member_inputs(component, experiment, variable_id, item)
+            for component, variable_id in [('Amon', 'evspsbl'), ('Amon', 'pr'), ('SImon', 'siconc')]
+        ]
+        if any(p == None for p in paths):
+            continue
+
+        contribution_members.append(item['source_id'])
+        for path in sum(paths, []):
+            if path not in contribution_inputs:
+                contribution_inputs.append(path)
+
+    figures.append({
+        'figure': 'evspsbl_siconc_contribution',
+        'id': f'evspsbl_siconc_contribution_{experiment}',
+        'inputs': contribution_inputs if len(contribution_members) > 0 else None,
+        'kwargs': { 'experiment': experiment, 'members': contribution_members },
+        'outputs': [f'evspsbl_siconc_contribution_{experiment}_{r}.png' for r in ['higher', 'lower']]
+    })
+
+    for v in variables:
+        conf = {
+            **SPATIAL_DEFAULTS,
+            'text': v['text'],
+            'units': v['units'],
+            **SPATIAL.get(v['variable_id'], {})
+        }
+        colormesh_kwargs = { **conf['colormesh_kwargs'], 'x': 'longitude', 'y': 'latitude' }
+        for item in ensemble:
+            figure_id = f'spatial_{v["variable_id"]}_{experiment}_{item["source_id"]}'
+            figures.append({
+                'figure': 'spatial',
+                'id': figure_id,
+                'inputs': _member_inputs(v['component'], experiment, v['variable_id'], item),
+                'kwargs': {
+                    'colormesh_kwargs': colormesh_kwargs,
+                    'component': v['component'],
+                    'experiment': experiment,
+                    'source_id': item['source_id'],
+                    'text': conf['text'],
+                    'times': conf['times'],
+                    'units': conf['units'],
+                    'variable_id': v['variable_id']
+                },
+                'outputs': [f'{figure_id}_{t}.png' for t in conf['times']]
+            })
+
+    return figures
+
+
+def main(argv=None):
+    '''
+    Function: main()
+        Command line entry point of build(), e.g.
+        `python -m libs.figures --workers 4 --only 'series_*'`
+        run from the repository root
+
+    Inputs:
+    - argv (array): arguments
+        default: None (sys.argv)
+
+    Outputs:
+    - (int): exit status, 1 if any figure failed
+    '''
+    parser = argparse.ArgumentParser(
+        prog='python -m libs.figures',
+        description='Render figures, skipping those whose inputs and code are unchanged'
+    )
+    parser.add_argument('--experiment', default='ssp585')
+    parser.add_argument('--force', action='store_true', help='redraw every figure')
+    parser.add_argument('--list', action='store_true', help='list figures and exit')
+    parser.add_argument('--members', nargs='+', help='source_ids of spatial figures')
+    parser.add_argument('--only', nargs='+', help='figure id patterns, e.g. series_*')
+    parser.add_argument('--output', default=FIGURES_DIR)
+    parser.add_argument('--variables', nargs='+')
+    parser.add_argument('--workers', default=4, type=int)
+    args = parser.parse_args(argv)
+
+    figures = expand_figures(args.experiment, variables=args.variables, members=args.members)
+    if args.only != None:
+        figures = [f for f in figures if any(fnmatch.fnmatch(f['id'], p) for p in args.only)]
+
+    if args.list:
+        for f in figures:
+            print(f['id'], '(missing inputs)' if f['inputs'] == None else '')
+        return 0
+
+    started = time.perf_counter()
+    results = build(figures, figures_dir=args.output, max_workers=args.workers, force=args.force)
+    elapsed = time.perf_counter() - started
+
+    print('', 'Figure render times:', sep='\n')
+    for figure_id, result in results.items():
+        seconds = f'{result["seconds"]:8.2f}s' if result['seconds'] != None else ' ' * 9
+        print(f'{seconds}  {result["status"]:<8} {figure_id}')
+
+    counts = {}
+    for result in results.values():
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print(f'{len(results)} figures in {elapsed:.2f}s:', ', '.join(f'{n} {s}' for s, n in sorted(counts.items())))
+
+    return 1 if counts.get('failed', 0) > 0 else 0
+
+
+def read_manifest(path=MANIFEST_PATH):
+    '''
+    Function: read_manifest()
+        Read the manifest of rendered figures
+
+    Inputs:
+    - path (string): manifest path
+        default: MANIFEST_PATH
+
+    Outputs:
+    - (dict): {
+            'figures': { (figure id): { 'key': (string), 'outputs': (array), 'seconds': (float), 'time': (string) } },
+            'files': { (path): (dict), see libs.series.file_record() }
+        }
+    '''
+    if not Path(path).exists():
+        return { 'figures': {}, 'files': {} }
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _code_functions(function, found=None):
+    # function, and the functions of this module it calls (recursively),
+    # e.g. _series_process()
+    found = found if found != None else []
+    found.append(function)
+
+    names = []
+    codes = [function.__code__]
+    while len(codes) > 0:
+        code = codes.pop()
+        names += code.co_names
+        codes += [c for c in code.co_consts if hasattr(c, 'co_code')]
+
+    for name in names:
+        value = globals().get(name)
+        if callable(value) and getattr(value, '__module__', None) == function.__module__ and value not in found:
+            _code_functions(value, found)
+
+    return found
+
+
+def _code_hash(figure, files):
+    digest = hashlib.sha1()
+    for function in _code_functions(FIGURES[figure]):
+        digest.update(libs.series.function_id(function).encode())
+
+    for module in CODE_MODULES:
+        path = importlib.util.find_spec(module).origin
+        files[path] = libs.series.file_record(path, files.get(path))
+        digest.update(files[path]['sha1'].encode())
+
+    return digest.hexdigest()
+
+
+def _exists(path):
+    if not Path(path).exists():
+        print('Error 404', f'-> {path}', sep='\n')
+        return False
+
+    return True
+
+
+def _imported_modules(module, found=None):
+    # libs modules imported by module, directly or by the modules it
+    # imports, read from their source so nothing is imported
+    found = found if found != None else set()
+    with open(importlib.util.find_spec(module).origin) as f:
+        tree = ast.parse(f.read())
+
+    for node in ast.walk(tree):
+        names = []
+        if type(node) == ast.Import:
+            names = [alias.name for alias in node.names]
+        elif type(node) == ast.ImportFrom and node.module != None:
+            names = [node.module]
+
+        for name in names:
+            if name.startswith('libs.') and name not in found:
+                found.add(name)
+                _imported_modules(name, found)
+
+    return sorted(found)
+
+
+def _init_worker(threads):
+    matplotlib.use('Agg')
+    matplotlib.rcParams.update({ 'font.size': 18 })
+    warnings.filterwarnings('ignore')
+
+    # Figures are rendered in parallel, so each worker computes with a share
+    # of the cores
+    dask.config.set(scheduler='threads', num_workers=threads)
+
+
+def _member_inputs(component, experiment, variable_id, item):
+    kwargs = {
+        'component': component,
+        'experiment_id': experiment,
+        'include_hist': True,
+        'source_id': item['source_id'],
+        'variable_id': variable_id,
+        'variant_label': item['variant_label']
+    }
+    if variable_id in item:
+        kwargs = { **kwargs, **item[variable_id] }
+
+    paths = libs.local.get_paths(**kwargs)
+    areacello = libs.local.get_paths('Ofx', 'piControl', 'UKESM1-0-LL', 'areacello', 'r1i1p1f2')
+    if paths == None or areacello == None or not _exists(libs.cells.NSIDC_MASK_PATH):
+        return None
+
+    return paths + areacello + [libs.cells.NSIDC_MASK_PATH]
+
+
+def _obs_inputs(variable_ids):
+    # Observation files of variable_ids, and the weight and mask they are
+    # reduced with, or None if any are missing
+    confs = { v['variable_id']: v for v in libs.vars.variables() }
+    paths = [f'_data/_cache/_obs/{obs["filename"]}' for v in variable_ids for obs in confs[v]['obs']]
+    areacello = libs.local.get_paths('Ofx', 'piControl', 'UKESM1-0-LL', 'areacello', 'r1i1p1f2')
+    if areacello == None or not all(_exists(p) for p in paths + [libs.cells.NSIDC_MASK_PATH]):
+        return None
+
+    return paths + areacello + [libs.cells.NSIDC_MASK_PATH]
+
+
+def _obs_series(variable_ids, scales, offsets):
+    # Dataset of the weighted series of each observation of variable_ids,
+    # named '{source_id} {variable}', e.g. 'ERA5 tp', reduced as the first
+    # variable is. Observations of the first variable are drawn solid, of
+    # the second dashed
+    confs = { v['variable_id']: v for v in libs.vars.variables() }
+    areacello = libs.local.get_data('Ofx', 'piControl', 'UKESM1-0-LL', 'areacello', 'r1i1p1f2').areacello
+
+    obs_arr = []
+    linestyles = []
+    for i, (variable_id, scale, offset) in enumerate(zip(variable_ids, scales, offsets)):
+        for obs in confs[variable_id]['obs']:
+            obs_data = libs.local.get_obs(**obs)
+            obs_arr.append({
+                'color': obs_data.attrs['color'],
+                'data': obs_data * scale + offset,
+                'label': obs_data.attrs['label']
+            })
+            linestyles.append('solid' if i == 0 else (0, (5, 1)))
+
+    obs_reduced, _ = libs.ensemble.time_series_weighted(
+        obs_arr,
+        areacello.fillna(0),
+        confs[variable_ids[0]]['weighting_method'],
+        confs[variable_ids[0]]['weighting_process'],
+        fillna=None
+    )
+
+    data_vars = {}
+    for item, linestyle in zip(obs_reduced, linestyles):
+        key = f'{item["label"]} {item["data"].name}'
+        data_vars[key] = _series_process(item['data'])
+        data_vars[key].attrs = {
+            'color': item['color'],
+            'label': key,
+            'plot_kwargs': { 'linestyle': linestyle, 'linewidth': 3, 'zorder': 10 }
+        }
+
+    return xarray.Dataset(data_vars=data_vars)
+
+
+def _preprocess_kwargs(variable_id):
+    # Unit conversion of the variable's members, e.g. to mm day⁻¹, see
+    # libs.vars.variables()
+    conf = [v for v in libs.vars.variables() if v['variable_id'] == variable_id][0]
+
+    return { 'preprocess': conf['preprocess'] } if 'preprocess' in conf else {}
+
+
+def _region_series(ensemble, weight, region, siconc=None):
+    # Dataset of the weighted sum of each member over region, and the
+    # ensemble mean. With siconc, only cells where the sea ice of the month
+    # has been lost are summed: concentration <= 25%, having been > 25% in
+    # the 1980-2010 mean of the month
+    nsidc_mask = xarray.open_dataset(libs.cells.NSIDC_MASK_PATH).mask
+    in_region = np.isin(nsidc_mask.values, region['values'])
+    siconc = { item['label']: item['data'] for item in siconc } if siconc != None else None
+
+    data_vars = {}
+    for item in ensemble:
+        if siconc != None and item['label'] not in siconc:
+            continue
+
+        data = _series_process(item['data']).where(in_region)
+        if siconc != None:
+            item_siconc = _series_process(siconc[item['label']])
+            baseline = item_siconc.sel(time=slice('1980-01-01', '2011-01-01')).groupby('time.month').mean('time')
+            data = data.where(item_siconc <= 25).groupby('time.month').where(baseline > 25)
+
+        data_weighted = data.weighted(weight)
+        data_vars[item['label']] = data_weighted.sum(dim=data_weighted.weights.dims, skipna=True)
+
+    return libs.ensemble.calc_variable_mean(xarray.Dataset(data_vars=data_vars))
+
+
+def _render(figure, outputs):
+    result = { 'error': None, 'outputs': outputs, 'seconds': None, 'status': 'done' }
+    started = time.perf_counter()
+    try:
+        FIGURES[figure['figure']](outputs, **figure['kwargs'])
+    except Exception:
+        result['error'] = traceback.format_exc()
+        result['status'] = 'failed'
+    finally:
+        plt.close('all')
+
+    result['seconds'] = time.perf_counter() - started
+
+    return result
+
+
+def _save(fig, path):
+    fig.savefig(path, bbox_inches='tight')
+
+
+def _save_legends(fig, legend_confs, paths):
+    # libs.plot.legend_standalone() draws the legend of each axes of fig on
+    # a figure of its own
+    numbers = plt.get_fignums()
+    libs.plot.legend_standalone(fig, legend_confs=legend_confs)
+    legends = [plt.figure(n) for n in plt.get_fignums() if n not in numbers]
+
+    for legend, path in zip(legends, paths):
+        _save(legend, path)
+
+
+def _series_process(data):
+    # Drop coords that differ between members, as in the notebooks
+    return data.drop_vars(['height', 'type'], errors='ignore')
+
+
+def _write_manifest(manifest, path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = f'{path}.tmp'
+    with open(path_tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path_tmp, path)
+
+
+def _figure_ep_regional(outputs, experiment):
+    regions_evspsbl = libs.local.get_ensemble_regional_series('evspsbl', experiment)
+    regions_pr = libs.local.get_ensemble_regional_series('pr', experiment)
+    s = libs.vars.default_time_slices()[-1]
+
+    arr = []
+    for data_e, data_pr in zip(regions_evspsbl, regions_pr):
+        ratio = (_series_process(data_e) / _series_process(data_pr)).sel(**s['slice']).groupby('time.month').mean('time')
+        ratio.attrs = data_e.attrs
+        arr.append([ratio.load()])
+
+    libs.plot.monthly_variability_regional(
+        arr,
+        title=f'{s["label"]} {experiment} mean E/P over sea ice and ocean 60-90°N',
+        ylabel='E/P',
+        yrange=(0, 1.25)
+    )
+    _save(plt.gcf(), outputs[0])
+
+
+def _figure_ep_siconc_correlation(outputs, experiment):
+    regions_evspsbl = libs.local.get_ensemble_regional_series('evspsbl', experiment)
+    regions_pr = libs.local.get_ensemble_regional_series('pr', experiment)
+    regions_siconc = libs.local.get_ensemble_regional_series('siconc', experiment)
+    s = libs.vars.default_time_slices()[-1]
+
+    # (a) Correlation across members of the 2080-2100 monthly means, and
+    # (b) across the ensemble of monthly anomalies from 1980-2010
+    corr_intermodel = {}
+    corr_ensemble_mean = {}
+    for data_e, data_pr, data_siconc in zip(regions_evspsbl, regions_pr, regions_siconc):
+        region = data_siconc.attrs['region']
+        ratio = (_series_process(data_e) / _series_process(data_pr)).load()
+        siconc = _series_process(data_siconc).load()
+
+        corr_intermodel[region] = xarray.corr(
+            ratio.sel(**s['slice']).groupby('time.month').mean('time').to_array('variable'),
+            siconc.sel(**s['slice']).groupby('time.month').mean('time').to_array('variable'),
+            dim='variable'
+        )
+
+        ratio_clim = libs.analysis.climatology_monthly(ratio, '1980-01-01', '2011-01-01').to_array('variable')
+        siconc_clim = libs.analysis.climatology_monthly(siconc, '1980-01-01', '2011-01-01').to_array('variable')
+        corr_ensemble_mean[region] = xarray.concat([
+            xarray.corr(
+                ratio_clim.where(ratio_clim.time.dt.month == month, drop=True),
+                siconc_clim.where(siconc_clim.time.dt.month == month, drop=True)
+            ) for month in range(1, 13)
+        ], dim='month').assign_coords({ 'month': np.arange(1, 13) })
+
+    fig, axes = plt.subplots(1, 2, figsize=(15, 6))
+    for ax, corr in zip(axes, [corr_intermodel, corr_ensemble_mean]):
+        ds_corr = xarray.Dataset(data_vars=corr)
+        higher = [r for r in ds_corr if r not in LOWER_LATITUDES]
+        for names, label, linestyle in [(LOWER_LATITUDES, 'Lower latitude', 'dashed'), (higher, 'Higher latitude', 'dashdot')]:
+            ds_corr = libs.ensemble.calc_variable_mean(ds_corr, subset=names, var_name=f'Mean ({label})')
+            ds_corr[f'Mean ({label})'].attrs['plot_kwargs'] = { 'linestyle': linestyle, 'linewidth': 2 }
+
+        for key in ds_corr:
+            ds_corr[key].attrs['label'] = key
+
+        libs.plot.monthly_variability(
+            ds_corr,
+            ax=ax,
+            fig=fig,
+            show_legend=False,
+            ylabel='Correlation',
+            yrange=(-1, 0.6)
+        )
+
+    _save(fig, outputs[0])
+    _save_legends(fig, [{ 'ncol': 5, 'exclude': [] }, { 'ncol': 6, 'exclude': [] }], outputs[1:])
+
+
+def _figure_evspsbl_siconc_contribution(outputs, experiment, members):
+    ensembles = {}
+    for component, variable_id in [('Amon', 'evspsbl'), ('Amon', 'pr'), ('SImon', 'siconc')]:
+        ensembles[variable_id], weight = libs.ensemble.get_and_preprocess(
+            component,
+            experiment,
+            variable_id,
+            members=members,
+            **_preprocess_kwargs(variable_id)
+        )
+
+    for path, label in zip(outputs, ['Higher Latitudes', 'Lower Latitudes']):
+        region = [r for r in libs.vars.nsidc_regions() if r['label'] == label][0]
+        e = _region_series(ensembles['evspsbl'], weight, region)
+        e_si = _region_series(ensembles['evspsbl'], weight, region, siconc=ensembles['siconc'])
+        pr = _region_series(ensembles['pr'], weight, region)
+
+        fig, axes = plt.subplots(1, 2, figsize=(15, 6))
+        fig.suptitle(f'{experiment} evaporation over lost sea ice, {label.lower()} 60-90°N')
+        for ax, ratio, ylabel in [(axes[0], e_si / e, r'$E_{S}/E$'), (axes[1], e_si / pr, r'$E_{S}/P$')]:
+            ratio = ratio.load()
+            arr = []
+            for s in libs.vars.time_slices_20y():
+                data = ratio.sel(**s['slice']).groupby('time.month').mean('time')
+                data['Ensemble mean'].attrs = { 'color': s['color'], 'label': s['label'] }
+                arr.append(data)
+
+            libs.plot.monthly_variability(
+                arr,
+                ax=ax,
+                fig=fig,
+                show_legend=False,
+                variables=['Ensemble mean'],
+                ylabel=ylabel,
+                yrange=(0, 1)
+            )
+
+        _save(fig, path)
+
+
+def _figure_monthly(outputs, experiment, text, units, variable_id):
+    series = _series_process(libs.local.get_ensemble_series(variable_id, experiment)).load()
+    time_slices = libs.vars.default_time_slices()
+
+    fig, axs = plt.subplots(1, len(time_slices), figsize=(15, 6), sharey=True)
+    fig.suptitle(f'{experiment} mean {text} 60-90°N ({units})')
+
+    for i, s in enumerate(time_slices):
+        data = series.sel(**s['slice']).groupby('time.month').mean('time')
+        libs.plot.monthly_variability(
+            libs.ensemble.calc_variable_mean(data),
+            ax=axs[i],
+            fig=fig,
+            show_legend=False,
+            ylabel=units if i == 0 else ''
+        )
+        axs[i].set_title(s['label'])
+
+    fig.tight_layout()
+    _save(fig, outputs[0])
+
+
+def _figure_prra_pr_seasonal(outputs, experiment):
+    prra = _series_process(libs.local.get_ensemble_series('prra', experiment))
+    pr = _series_process(libs.local.get_ensemble_series('pr', experiment))
+    ratio = libs.ensemble.calc_variable_mean((prra / pr).load())
+
+    arr = []
+    for s in libs.vars.time_slices_20y():
+        data = ratio.sel(**s['slice']).groupby('time.month').mean('time')
+        data['Ensemble mean'].attrs['color'] = s['color']
+        data['Ensemble mean'].attrs['label'] = s['label']
+        arr.append(data)
+
+    fig = libs.plot.monthly_variability(
+        arr,
+        legend_below=True,
+        title=f'{experiment} ensemble mean seasonal prra/pr 60-90°N',
+        variables=['Ensemble mean'],
+        ylabel='prra/pr',
+        yrange=(0, 1)
+    )
+    _save(fig, outputs[0])
+
+
+def _figure_rain_season_length(outputs, experiment):
+    prra = _series_process(libs.local.get_ensemble_series('prra', experiment)).load()
+    prsn = _series_process(libs.local.get_ensemble_series('prsn', experiment)).load()
+
+    length = libs.analysis.rain_season(prra, prra + prsn)['count']
+    length = libs.ensemble.calc_variable_mean(length, to_array='time')
+    length['Ensemble mean'] = length['Ensemble mean'].round()
+
+    fig = libs.plot.time_series_from_vars(
+        [length],
+        title=f'{experiment} rain season length 60-90°N (masked to sea ice and ocean)',
+        xattr='year',
+        ylabel='Rain season length (months)',
+        yrange=(0, 12.5)
+    )
+    _save(fig, outputs[0])
+
+
+def _figure_regions(outputs):
+    nsidc_mask = xarray.open_dataset(libs.cells.NSIDC_MASK_PATH).mask
+    nsidc_regions = [r for r in libs.vars.nsidc_regions() if len(r['values']) == 1]
+    nsidc_mask = nsidc_mask.where(nsidc_mask != 14).where(nsidc_mask > 5).where(nsidc_mask < 16)
+
+    fig, subfigs = libs.plot.nstereo(
+        [{ 'data': nsidc_mask, 'label': '' }],
+        'NSIDC Regions',
+        { 'cmap': 'rainbow', 'extend': 'neither', 'vmin': 6, 'vmax': 15, 'x': 'longitude', 'y': 'latitude' },
+        show_colorbar=False
+    )
+
+    values = [r['values'][0] for r in nsidc_regions]
+    cax = fig.colorbar(
+        subfigs[0],
+        ax=fig.axes[0],
+        location='right',
+        shrink=0.8,
+        spacing='uniform',
+        values=values
+    )
+    cax.set_ticks(values)
+    cax.set_ticklabels([r['label'] for r in nsidc_regions])
+    _save(fig, outputs[0])
+
+
+def _figure_series(outputs, experiment, text, units, variable_id):
+    series = _series_process(libs.local.get_ensemble_series(variable_id, experiment)).load()
+    annual = series.groupby('time.year').mean('time').rolling(year=5, center=True).mean('year')
+
+    fig = libs.plot.time_series_from_vars(
+        libs.ensemble.calc_variable_mean(annual),
+        title=f'{experiment} smoothed annual mean {text} 60-90°N ({units})',
+        xattr='year',
+        ylabel=units
+    )
+    _save(fig, outputs[0])
+
+
+def _figure_spatial(
+    outputs,
+    colormesh_kwargs,
+    component,
+    experiment,
+    source_id,
+    text,
+    times,
+    units,
+    variable_id
+):
+    ensemble, weight = libs.ensemble.get_and_preprocess(
+        component,
+        experiment,
+        variable_id,
+        members=[source_id],
+        **_preprocess_kwargs(variable_id)
+    )
+    cube = libs.analysis.composite_cube(libs.analysis.generate_slices(ensemble)).isel(member=0)
+
+    # Months are drawn on one figure, only redrawing the arrays of its panels
+    fig = None
+    for path, t in zip(outputs, times):
+        means = cube.sel(month=datetime.datetime.strptime(t, '%b').month)
+        arr = [{ 'data': means.sel(slice=s), 'label': str(s) } for s in means['slice'].values]
+        title = f'{source_id} {t} {experiment} {text} 60-90°N ({units})'
+
+        if fig == None:
+            fig, subfigs = libs.plot.nstereo(
+                arr,
+                title,
+                colormesh_kwargs,
+                colorbar_label=f'{text} ({units})'
+            )
+        else:
+            libs.plot.nstereo_update(fig, subfigs, arr, colormesh_kwargs, title=title)
+
+        _save(fig, path)
+
+
+def _figure_trends(
+    outputs,
+    annual_scale,
+    experiment,
+    monthly_scale,
+    obs_difference,
+    obs_offsets,
+    obs_scales,
+    obs_variable_ids,
+    title,
+    variable_ids,
+    ylabels,
+    yranges
+):
+    dashed = { 'linestyle': (0, (5, 1)) }
+    series = [_series_process(libs.local.get_ensemble_series(v, experiment)).load() for v in variable_ids]
+    for key in series[1]:
+        series[1][key].attrs['plot_kwargs'] = dashed
+
+    obs = _obs_series(obs_variable_ids, obs_scales, obs_offsets).load()
+    if obs_difference:
+        first, second = list(obs)
+        key = f'{first} - {second.split(" ")[-1]}'
+        obs[key] = obs[first] - obs[second]
+        obs[key].attrs = { **obs[first].attrs, 'label': key }
+        obs = obs.drop_vars(first)
+
+    fig, axes = plt.subplots(1, 2, figsize=(15, 6))
+    fig.suptitle(f'{experiment} {title}')
+
+    plot_arr = []
+    for i, data in enumerate(series + [obs]):
+        annual = data.groupby('time.year').mean('time') * annual_scale
+        for key in annual:
+            annual[key].attrs = data[key].attrs
+
+        plot_arr.append(libs.ensemble.calc_variable_mean(annual) if i < len(series) else annual)
+
+    plot_arr[1]['Ensemble mean'].attrs['plot_kwargs'] = dashed
+    libs.plot.time_series_from_vars(
+        plot_arr,
+        ax=axes[0],
+        fig=fig,
+        show_legend=False,
+        xattr='year',
+        variables=list(dict.fromkeys(k for data in plot_arr for k in data)),
+        ylabel=ylabels[0],
+        yrange=yranges[0]
+    )
+
+    # Seasonal cycles of the models' 20 year slices, and of the observations
+    # over the first slice
+    arr = []
+    for data in series:
+        for s in libs.vars.time_slices_20y():
+            data_slice = (data * monthly_scale).sel(**s['slice']).groupby('time.month').mean('time')
+            data_slice['Ensemble mean'].attrs = { **data['Ensemble mean'].attrs, 'color': s['color'], 'label': s['label'] }
+            arr.append(data_slice)
+
+    obs_slice = libs.vars.time_slices_20y()[0]['slice']
+    for key in obs:
+        data_slice = (obs[key] * monthly_scale).sel(**obs_slice).groupby('time.month').mean('time')
+        data_slice.attrs = { **obs[key].attrs, 'plot_kwargs': { **obs[key].attrs['plot_kwargs'], 'linewidth': 2 } }
+        # Named as the ensemble mean, to be drawn with the variables of the
+        # models' slices
+        arr.append(xarray.Dataset(data_vars={ 'Ensemble mean': data_slice }))
+
+    libs.plot.monthly_variability(
+        arr,
+        ax=axes[1],
+        fig=fig,
+        show_legend=False,
+        variables=['Ensemble mean'],
+        ylabel=ylabels[1],
+        yrange=yranges[1]
+    )
+
+    _save(fig, outputs[0])
+    _save_legends(fig, [{ 'ncol': 5, 'exclude': [] }, { 'ncol': 6, 'exclude': list(obs) }], outputs[1:])
+
+
+# Render functions of each figure type, called with the output paths and the
+# kwargs of the figure, see expand_figures()
+FIGURES = {
+    'ep_regional': _figure_ep_regional,
+    'ep_siconc_correlation': _figure_ep_siconc_correlation,
+    'evspsbl_siconc_contribution': _figure_evspsbl_siconc_contribution,
+    'monthly': _figure_monthly,
+    'prra_pr_seasonal': _figure_prra_pr_seasonal,
+    'rain_season_length': _figure_rain_season_length,
+    'regions': _figure_regions,
+    'series': _figure_series,
+    'spatial': _figure_spatial,
+    'trends': _figure_trends
+}
+
+# Modules whose code the figures depend on, i.e. every libs module this
+# module imports, directly or indirectly: figures are redrawn when any of
+# them change, as well as when their render function (or a function of this
+# module it calls) does
+CODE_MODULES = _imported_modules('libs.figures')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,423 @@
+from contextlib import contextmanager
+from pathlib import Path
+import fnmatch
+import hashlib
+import json
+import netCDF4
+import numpy as np
+import os
+import re
+import sqlite3
+
+INDEX_PATH = '_data/_cache/local_index.sqlite'
+ROOTS = ['_data/cmip6', '_data/_cache']
+
+# Horizontal grid variables hashed into grid_hash, as in libs.utils.grid_hash()
+GRID_NAMES = [
+    'lat', 'lon', 'latitude', 'longitude',
+    'lat_b', 'lon_b', 'vertices_latitude', 'vertices_longitude',
+    'mask'
+]
+
+# Columns that can be passed as facets to lookup()
+FACETS = [
+    'experiment_id',
+    'grid_label',
+    'kind',
+    'region',
+    'source_id',
+    'suffix',
+    'table_id',
+    'variable_id',
+    'variant_label'
+]
+
+_DATERANGE = re.compile(r'^(\d{6})\d{0,2}-(\d{6})\d{0,2}$')
+_SERIES = re.compile(r'^(?P<experiment_id>[^_]+)_(?P<region>.+)_(?P<start>\d{6})-(?P<end>\d{6})(?P<suffix>.*)$')
+
+
+def add(paths, path=INDEX_PATH):
+    '''
+    Function: add()
+        Add or update index records for specific files, e.g. after writing
+        them, without scanning their directories
+
+    Inputs:
+    - paths (array): file paths
+    - path (string): index path
+        default: INDEX_PATH
+    '''
+    with _connect(path) as conn:
+        for p in paths:
+            p = os.path.normpath(p)
+            if not Path(p).exists():
+                conn.execute('DELETE FROM files WHERE path = ?', (p,))
+                continue
+
+            _write(conn, p, os.stat(p))
+
+
+def cover(records, start=None, end=None):
+    '''
+    Function: cover()
+        Find the minimal set of files whose date ranges cover start-end,
+        e.g. to skip files superseded by a longer file over the same dates
+
+    Inputs:
+    - records (array): index records, see lookup()
+    - start (int or string): first month, formatted as YYYYMM
+        default: None (first month of the newest contiguous coverage of
+        records up to end, so files before a gap in the dates are ignored)
+    - end (int or string): last month, formatted as YYYYMM
+        default: None (last month of records)
+
+    Outputs:
+    - (array): records ordered by date, or [] if start-end is not fully covered
+    '''
+    records = [r for r in records if r['date_start'] != None]
+    if len(records) == 0:
+        return []
+
+    end = _months(end if end != None else max(r['date_end'] for r in records))
+    start = _months(start) if start != None else _contiguous_start(records, end)
+    records = sorted(records, key=lambda r: _months(r['date_start']))
+
+    selected = []
+    current = start
+    i = 0
+    while current <= end:
+        # Of the files starting on or before the first uncovered month, take
+        # the one reaching furthest
+        best = None
+        while i < len(records) and _months(records[i]['date_start']) <= current:
+            if best == None or _months(records[i]['date_end']) > _months(best['date_end']):
+                best = records[i]
+            i += 1
+
+        if best == None or _months(best['date_end']) < current:
+            return []
+
+        selected.append(best)
+        current = _months(best['date_end']) + 1
+
+    return selected
+
+
+def lookup(date_range=None, path=INDEX_PATH, **facets):
+    '''
+    Function: lookup()
+        Find indexed files by facet. Answered from the index only, without
+        touching the filesystem.
+
+    Inputs:
+    - date_range (tuple): (start, end) months formatted as YYYYMM, e.g.
+        ('198001', '201412'). If set, only the minimal set of files covering
+        the date range is returned
+        default: None (all matching files)
+    - path (string): index path
+        default: INDEX_PATH
+    - **facets: any of FACETS, e.g. source_id='UKESM1-0-LL', kind='processed'.
+        list values match any of the values
+
+    Outputs:
+    - (array): records ordered by date, formatted as
+        {
+            'chunks': (dict), 'date_end': (int), 'date_start': (int),
+            'experiment_id': (string), 'grid_hash': (string),
+            'grid_label': (string), 'kind': (string), 'mtime': (float),
+            'path': (string), 'region': (string), 'size': (int), 'source_id': (string),
+            'suffix': (string), 'table_id': (string), 'variable_id': (string),
+            'variant_label': (string)
+        }
+    '''
+    where = []
+    values = []
+    for k, v in facets.items():
+        if k not in FACETS:
+            raise ValueError(f'Unknown facet: {k}')
+
+        if type(v) in [list, tuple, set]:
+            where.append(f'{k} IN ({", ".join("?" * len(v))})')
+            values += list(v)
+        elif v == None:
+            where.append(f'{k} IS NULL')
+        else:
+            where.append(f'{k} = ?')
+            values.append(v)
+
+    if date_range != None:
+        where.append('date_start <= ? AND date_end >= ?')
+        values += [int(date_range[1]), int(date_range[0])]
+
+    if not Path(path).exists():
+        return []
+
+    with _connect(path) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            f'SELECT * FROM files {"WHERE " + " AND ".join(where) if len(where) else ""} ORDER BY date_start, path',
+            values
+        ).fetchall()
+
+    records = []
+    for row in rows:
+        record = dict(row)
+        record['chunks'] = json.loads(record['chunks']) if record['chunks'] != None else None
+        records.append(record)
+
+    if date_range != None:
+        return cover(records, *date_range)
+
+    return records
+
+
+def parse_filename(path):
+    '''
+    Function: parse_filename()
+        Get facets from a local file path. Supported formats:
+        `_data/cmip6/{source_id}/{var}/{var}_{table}_{source_id}_{e_id}_{variant}_{grid}[_{start}-{end}][_processed].nc`
+        `_data/_cache/{var}/{var}_{e_id}_{region}_{start}-{end}{suffix}.nc`
+        `_data/_cache/_obs/{filename}.nc`
+
+    Inputs:
+    - path (string): file path
+
+    Outputs:
+    - (dict): facets, with None for facets not in the path
+    '''
+    p = Path(path)
+    facets = { k: None for k in FACETS }
+    facets['date_start'] = None
+    facets['date_end'] = None
+    facets['kind'] = 'other'
+    stem = p.stem
+
+    if len(p.parents) > 2 and p.parents[2].name == 'cmip6':
+        processed = stem.endswith('_processed')
+        parts = stem.replace('_processed', '').split('_')
+        match = _DATERANGE.match(parts[-1])
+        if match:
+            facets['date_start'], facets['date_end'] = int(match[1]), int(match[2])
+            parts = parts[:-1]
+
+        if len(parts) < 6:
+            return facets
+
+        # Variables can contain underscores (e.g. pr_siconc), so parse from the end
+        facets.update({
+            'experiment_id': parts[-3],
+            'grid_label': parts[-1],
+            'kind': 'processed' if processed else ('raw' if match else 'fixed'),
+            'source_id': parts[-4],
+            'table_id': parts[-5],
+            'variable_id': '_'.join(parts[:-5]),
+            'variant_label': parts[-2]
+        })
+    elif p.parent.name == '_obs':
+        facets['kind'] = 'obs'
+    elif p.parent.parent.name == '_cache' and stem.startswith(f'{p.parent.name}_'):
+        match = _SERIES.match(stem[len(p.parent.name) + 1:])
+        if match:
+            facets.update({
+                'date_end': int(match['end']),
+                'date_start': int(match['start']),
+                'experiment_id': match['experiment_id'],
+                'kind': 'series',
+                'region': match['region'],
+                'suffix': match['suffix'],
+                'variable_id': p.parent.name
+            })
+
+    return facets
+
+
+def update(roots=ROOTS, path=INDEX_PATH, verbose=False, pattern=None):
+    '''
+    Function: update()
+        Incrementally update the index for all .nc files under roots. Only
+        file metadata (mtime, size) is read for unchanged files; new or
+        changed files have their headers read for grid hash and chunking,
+        and records of deleted files are removed.
+
+    Inputs:
+    - roots (array): directories to index, e.g. ['_data/cmip6/UKESM1-0-LL/pr']
+        default: ROOTS
+    - path (string): index path
+        default: INDEX_PATH
+    - verbose (bool): whether to print a summary
+        default: False
+    - pattern (string): only index files directly in roots with names
+        matching pattern (see fnmatch), e.g. 'pr_Amon_UKESM1-0-LL_*.nc',
+        rather than walking the whole of roots
+        default: None
+
+    Outputs:
+    - (dict): number of files { 'added': (int), 'removed': (int), 'unchanged': (int), 'updated': (int) }
+    '''
+    counts = { 'added': 0, 'removed': 0, 'unchanged': 0, 'updated': 0 }
+
+    with _connect(path) as conn:
+        for root in roots:
+            root = os.path.normpath(root)
+            indexed = {
+                row[0]: (row[1], row[2])
+                for row in conn.execute(
+                    'SELECT path, mtime, size FROM files WHERE path = ? OR path LIKE ?',
+                    (root, f'{root}{os.sep}%')
+                )
+            }
+            if pattern != None:
+                indexed = {
+                    p: v for p, v in indexed.items()
+                    if os.path.dirname(p) == root and fnmatch.fnmatch(os.path.basename(p), pattern)
+                }
+
+            for p, stat in _scan(root, pattern):
+                previous = indexed.pop(p, None)
+                if previous == (stat.st_mtime, stat.st_size):
+                    counts['unchanged'] += 1
+                    continue
+
+                _write(conn, p, stat)
+                counts['added' if previous == None else 'updated'] += 1
+
+            for p in indexed:
+                conn.execute('DELETE FROM files WHERE path = ?', (p,))
+                counts['removed'] += 1
+
+    verbose and print('Updated index:', *[f'-> {k}: {v}' for k, v in counts.items()], sep='\n')
+
+    return counts
+
+
+@contextmanager
+def _connect(path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                kind TEXT,
+                variable_id TEXT,
+                table_id TEXT,
+                source_id TEXT,
+                experiment_id TEXT,
+                variant_label TEXT,
+                grid_label TEXT,
+                region TEXT,
+                suffix TEXT,
+                date_start INTEGER,
+                date_end INTEGER,
+                mtime REAL,
+                size INTEGER,
+                grid_hash TEXT,
+                chunks TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS files_facets
+            ON files (source_id, variable_id, experiment_id, variant_label)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS files_series
+            ON files (variable_id, experiment_id, region)
+        ''')
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _contiguous_start(records, end):
+    # First month (in months, see _months()) from which records cover every
+    # month up to end, or end + 1 if end is not covered
+    start = end + 1
+    extended = True
+    while extended:
+        extended = False
+        for r in records:
+            if _months(r['date_start']) < start and _months(r['date_end']) >= start - 1:
+                start = _months(r['date_start'])
+                extended = True
+
+    return start
+
+
+def _months(yyyymm):
+    yyyymm = int(yyyymm)
+    return (yyyymm // 100) * 12 + yyyymm % 100 - 1
+
+
+def _read_header(path):
+    '''
+    Read grid hash and chunking of the data variables from a file header.
+    Unreadable files (e.g. still being written) are indexed without them.
+    '''
+    try:
+        dataset = netCDF4.Dataset(path)
+    except OSError:
+        return None, None
+
+    try:
+        digest = hashlib.sha1()
+        has_grid = False
+        for name in GRID_NAMES:
+            if name not in dataset.variables:
+                continue
+
+            variable = dataset.variables[name]
+            variable.set_auto_maskandscale(False)
+            values = np.ascontiguousarray(variable[:])
+            digest.update(name.encode())
+            digest.update(str(values.shape).encode())
+            digest.update(values.tobytes())
+            has_grid = True
+
+        chunks = {}
+        for name, variable in dataset.variables.items():
+            if name in dataset.dimensions or name in GRID_NAMES or len(variable.dimensions) < 2:
+                continue
+
+            chunking = variable.chunking()
+            chunks[name] = chunking if chunking == 'contiguous' else [int(c) for c in chunking]
+    finally:
+        dataset.close()
+
+    return (digest.hexdigest() if has_grid else None), chunks
+
+
+def _scan(root, pattern=None):
+    if not os.path.isdir(root):
+        return
+
+    for entry in os.scandir(root):
+        if pattern != None:
+            if entry.is_file() and fnmatch.fnmatch(entry.name, pattern):
+                yield os.path.normpath(entry.path), entry.stat()
+        elif entry.is_dir(follow_symlinks=False):
+            # Zarr stores are opened by group, see libs.store, and memoized
+            # results are not data files, see libs.memo
+            if not entry.name.endswith('.zarr') and entry.name != '_memo':
+                yield from _scan(entry.path)
+        elif entry.name.endswith('.nc'):
+            yield os.path.normpath(entry.path), entry.stat()
+
+
+def _write(conn, p, stat):
+    facets = parse_filename(p)
+    grid_hash, chunks = _read_header(p)
+
+    record = {
+        **facets,
+        'chunks': json.dumps(chunks) if chunks != None else None,
+        'grid_hash': grid_hash,
+        'mtime': stat.st_mtime,
+        'path': p,
+        'size': stat.st_size
+    }
+    keys = sorted(record)
+    conn.execute(
+        f'INSERT OR REPLACE INTO files ({", ".join(keys)}) VALUES ({", ".join("?" * len(keys))})',
+        [record[k] for k in keys]
+    )
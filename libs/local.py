@@ -1,8 +1,24 @@
 from pathlib import Path
+import libs.cells
+import libs.execution
+import libs.index
+import libs.store
 import libs.vars
 import numpy as np
 import xarray
 
+# Storage backend used by get_data(), 'netcdf' or 'zarr'
+BACKEND = 'netcdf'
+
+# Date range of processed files of each experiment, as written by
+# preprocessing/remote-download.ipynb, which is loaded if no date_range is
+# set (and historical data is always joined over)
+DATE_RANGES = {
+    'historical': ('198001', '201412'),
+    'ssp585': ('201501', '210012')
+}
+
+
 def get_data(
     component,
     experiment_id,
@@ -11,13 +27,19 @@ def get_data(
     variant_label,
     grid_label='gn',
     include_hist=False,
-    suffix=None
+    suffix=None,
+    date_range=None,
+    backend=None,
+    selection=None,
+    packed=False
 ):
     '''
     Function: get_data()
         Load a CMIP6 model output variable from a local path with xarray.
         Format:
         `_data/cmip6/{source_id}/{var}_{component}_{source_id}_{e_id}_{variant_id}_{grid_label}_{y}.nc`
+        Files are found via the local index (see libs.index), which is
+        updated for the variable directory if no files are found.
 
     Inputs:
     - component (string): model components, e.g. 'Amon', 'SImon'
@@ -27,37 +49,132 @@ def get_data(
     - variant_label (string): model realisation, e.g. 'r2i1p1f2'
     - grid_label (string): grid label, e.g. 'gn', 'gr'
         default: 'gn'
-    - include_hist (bool): whether to join historical data (suffix '_198001-201412_processed')
+    - include_hist (bool): whether to join historical processed data
         default: False
-    - suffix (string): filename suffix, e.g. '_201501-210012_processed'
+    - suffix (string): exact filename suffix, e.g. '_201501-210012_processed'
+        default: None (use processed files from the index)
+    - date_range (tuple): (start, end) months of experiment_id formatted as
+        YYYYMM, e.g. ('201501', '210012'), only used if suffix is None.
+        Files (or Zarr groups) covering it are loaded and the data is
+        trimmed to it, the same for both backends. Historical data
+        (include_hist) is joined over its DATE_RANGES range
+        default: None (the DATE_RANGES range of experiment_id if its files
+        cover it, otherwise the newest contiguous dates of its files)
+    - backend (string): 'netcdf', or 'zarr' to read from the model's Zarr
+        store (see libs.store), only used if suffix is None
+        default: None (BACKEND)
+    - selection (dict): positional selection the data will be read with,
+        e.g. { 'j': slice(250, 330) }, used to choose the chunk layout of
+        Zarr stores (see libs.store.choose_layout())
         default: None
+    - packed (bool): whether to keep only the Arctic NSIDC cells, along a 1D
+        'cell' dimension (see libs.cells.pack()). Packed Zarr copies (see
+        libs.store.pack_group()) are read if they exist, otherwise the data
+        is packed after opening
+        default: False
 
     Outputs:
     - (xarray): loaded data
     '''
-    if suffix == None:
-        suffix = '' if variable_id in ['areacella', 'areacello'] else '_201501-210012_processed'
+    backend = backend or BACKEND
+    experiments = [experiment_id, 'historical'] if include_hist else [experiment_id]
 
-    basepath = f'_data/cmip6/{source_id}/{variable_id}/'
-    filename = f'{variable_id}_{component}_{source_id}_{experiment_id}_{variant_label}_{grid_label}{suffix}.nc'
-    filepaths = [f'{basepath}{filename}']
+    if suffix == None and backend == 'zarr':
+        store = libs.store.store_path(source_id, variable_id)
+        groups = [libs.store.group_name(component, e, variant_label, grid_label) for e in experiments]
+        packed_groups = [libs.store.layout_group(g, 'cells') for g in groups]
 
-    if include_hist:
-        experiment_id = 'historical'
-        suffix = '_198001-201412_processed'
+        # Dates are resolved as for netCDF files, each group over its own
+        date_ranges = _group_date_ranges(store, groups, experiments, date_range)
+        if date_ranges == None:
+            return None
 
-        filename = f'{variable_id}_{component}_{source_id}_{experiment_id}_{variant_label}_{grid_label}{suffix}.nc'
-        filepaths.append(f'{basepath}{filename}')
+        if packed and all(Path(store, g).exists() for g in packed_groups):
+            return libs.store.open_groups(
+                store,
+                packed_groups,
+                chunks=libs.execution.chunks_for(component),
+                date_range=date_ranges
+            )
+
+        data = libs.store.open_groups(
+            store,
+            groups,
+            chunks=libs.execution.chunks_for(component),
+            date_range=date_ranges,
+            selection=selection
+        )
+
+        return libs.cells.pack(data) if packed and type(data) == xarray.Dataset else data
+
+    found = _get_paths(
+        component,
+        experiment_id,
+        source_id,
+        variable_id,
+        variant_label,
+        grid_label,
+        include_hist,
+        suffix,
+        date_range
+    )
+    if found == None:
+        return None
+
+    filepaths, date_ranges = found
+    data = xarray.open_mfdataset(
+        paths=filepaths,
+        chunks=libs.execution.chunks_for(component),
+        combine='by_coords',
+        use_cftime=True
+    )
+
+    # Files may extend beyond the dates resolved, e.g. a longer file
+    # overlapping them
+    if date_ranges != None:
+        data = _select_date_ranges(data, date_ranges)
+
+    return libs.cells.pack(data) if packed else data
 
-    for filepath in filepaths:
-        if not Path(filepath).exists():
-            print('Error 404', f'-> {filepath}', sep='\n')
-            return None
 
-    return xarray.open_mfdataset(paths=filepaths, combine='by_coords', use_cftime=True)
+def get_paths(
+    component,
+    experiment_id,
+    source_id,
+    variable_id,
+    variant_label,
+    grid_label='gn',
+    include_hist=False,
+    suffix=None,
+    date_range=None
+):
+    '''
+    Function: get_paths()
+        Get the netCDF file paths get_data() opens, without opening them
+
+    Inputs:
+    - component, experiment_id, source_id, variable_id, variant_label,
+        grid_label, include_hist, suffix, date_range: see get_data()
+
+    Outputs:
+    - (array): file paths, or None if any are missing
+    '''
+    found = _get_paths(
+        component,
+        experiment_id,
+        source_id,
+        variable_id,
+        variant_label,
+        grid_label,
+        include_hist,
+        suffix,
+        date_range
+    )
 
+    return found[0] if found != None else None
 
-def get_obs(filename, source_id, variable_id, color='#8e8e8e', mask=True):
+
+def get_obs(filename, source_id, variable_id, color='#8e8e8e', mask=True, packed=False):
     filepath = f'_data/_cache/_obs/{filename}'
 
     if not Path(filepath).exists():
@@ -66,6 +183,7 @@ def get_obs(filename, source_id, variable_id, color='#8e8e8e', mask=True):
 
     obs_data = xarray.open_mfdataset(
         paths=filepath,
+        chunks=libs.execution.chunks_for('obs'),
         combine='by_coords',
         use_cftime=True
     )[variable_id]
@@ -74,6 +192,10 @@ def get_obs(filename, source_id, variable_id, color='#8e8e8e', mask=True):
     obs_data.attrs['color'] = color
     obs_data.attrs['plot_kwargs'] = { 'linestyle': (0, (5, 1)), 'linewidth': 2 }
 
+    if packed:
+        # Only the cells left unmasked below are kept
+        return libs.cells.pack(obs_data)
+
     if not mask:
         return obs_data
 
@@ -104,10 +226,144 @@ def get_ensemble_series(variable_id, experiment, region='All', suffix=''):
     time_series_filename = f'{variable_id}_{experiment}_{region}_198001-210012{suffix}.nc'
     time_series_path = f'_data/_cache/{variable_id}/{time_series_filename}'
 
-    data = xarray.open_mfdataset(paths=time_series_path, combine='by_coords', use_cftime=True)
+    data = xarray.open_mfdataset(
+        paths=time_series_path,
+        chunks=libs.execution.chunks_for('series'),
+        combine='by_coords',
+        use_cftime=True
+    )
 
     for variable in list(data):
         if 'label' not in data[variable].attrs:
             data[variable].attrs['label'] = variable
 
     return data
+
+
+def _cover(records, experiment_id, date_range):
+    # Files covering date_range, or if not set the DATE_RANGES range of the
+    # experiment if covered, or otherwise the newest contiguous coverage of
+    # the files. Returns the files and the (start, end) months resolved
+    requested = date_range or DATE_RANGES.get(experiment_id)
+    if requested != None:
+        selected = libs.index.cover(records, *requested)
+        if len(selected) > 0 or date_range != None:
+            return selected, tuple(str(d) for d in requested)
+
+    selected = libs.index.cover(records)
+    if len(selected) == 0:
+        return [], None
+
+    return selected, (str(selected[0]['date_start']), str(max(r['date_end'] for r in selected)))
+
+
+def _get_paths(
+    component,
+    experiment_id,
+    source_id,
+    variable_id,
+    variant_label,
+    grid_label,
+    include_hist,
+    suffix,
+    date_range
+):
+    # File paths and the (start, end) months resolved for each experiment
+    # (None if suffix is set), or None if any files are missing
+    basepath = f'_data/cmip6/{source_id}/{variable_id}/'
+    experiments = [experiment_id, 'historical'] if include_hist else [experiment_id]
+
+    if suffix != None:
+        filepaths = [
+            f'{basepath}{variable_id}_{component}_{source_id}_{e}_{variant_label}_{grid_label}{suffix}.nc'
+            for e in experiments
+        ]
+        date_ranges = None
+    else:
+        facets = {
+            'grid_label': grid_label,
+            'kind': 'fixed' if variable_id in ['areacella', 'areacello'] else 'processed',
+            'source_id': source_id,
+            'table_id': component,
+            'variable_id': variable_id,
+            'variant_label': variant_label
+        }
+
+        found = _lookup_files(basepath, experiments, date_range, facets)
+        if found == None:
+            # Files added or removed since the index was last updated, so
+            # re-index this model run's files rather than walking basepath
+            pattern = f'{variable_id}_{component}_{source_id}_*_{variant_label}_{grid_label}*.nc'
+            libs.index.update([basepath], pattern=pattern)
+            found = _lookup_files(basepath, experiments, date_range, facets)
+
+        if found == None:
+            print('Error 404', f'-> {basepath}', f'-> {facets}', sep='\n')
+            return None
+
+        filepaths, date_ranges = found
+
+    for filepath in filepaths:
+        if not Path(filepath).exists():
+            print('Error 404', f'-> {filepath}', sep='\n')
+            return None
+
+    return filepaths, date_ranges
+
+
+def _group_date_ranges(store, groups, experiments, date_range):
+    # (start, end) months each Zarr group is trimmed to, as _cover() resolves
+    # the dates of netCDF files: date_range for the first experiment, or the
+    # DATE_RANGES range of each experiment if the group covers it, otherwise
+    # the whole group. None if the group does not cover date_range
+    date_ranges = []
+    for group, experiment_id in zip(groups, experiments):
+        explicit = date_range != None and experiment_id == experiments[0]
+        requested = date_range if explicit else DATE_RANGES.get(experiment_id)
+        extent = libs.store.time_range(store, group)
+        covered = extent != None and requested != None and \
+            int(requested[0]) >= extent[0] and int(requested[1]) <= extent[1]
+
+        if explicit and not covered:
+            print('Error 404', f'-> {Path(store, group)}', f'-> {date_range}', sep='\n')
+            return None
+
+        date_ranges.append(tuple(str(d) for d in requested) if covered else None)
+
+    return date_ranges
+
+
+def _lookup_files(basepath, experiments, date_range, facets):
+    filepaths = []
+    date_ranges = []
+    for experiment_id in experiments:
+        records = libs.index.lookup(experiment_id=experiment_id, **facets)
+        if facets['kind'] != 'fixed':
+            # Historical data is joined over its own date range
+            records, experiment_range = _cover(
+                records,
+                experiment_id,
+                date_range if experiment_id == experiments[0] else None
+            )
+            date_ranges.append(experiment_range)
+
+        if len(records) == 0 or not all(Path(r['path']).exists() for r in records):
+            return None
+
+        filepaths += [r['path'] for r in records]
+
+    return filepaths, (date_ranges if facets['kind'] != 'fixed' else None)
+
+
+def _select_date_ranges(data, date_ranges):
+    # Keep the time steps within any of date_ranges, (start, end) months
+    # formatted as YYYYMM
+    if 'time' not in data.dims:
+        return data
+
+    months = (data.time.dt.year * 100 + data.time.dt.month).values
+    keep = np.zeros(len(months), dtype=bool)
+    for start, end in date_ranges:
+        keep |= (months >= int(start)) & (months <= int(end))
+
+    return data if keep.all() else data.isel(time=keep)
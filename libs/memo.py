@@ -0,0 +1,221 @@
+from dask.base import tokenize
+from pathlib import Path
+import functools
+import hashlib
+import json
+import os
+import sys
+import xarray
+
+CACHE_DIR = '_data/_cache/_memo'
+
+# Maximum size of CACHE_DIR, least recently used results are evicted first
+MAX_BYTES = 5 * 1024 ** 3
+
+# Whether memoize() caches results, e.g. set False to always recompute
+ENABLED = True
+
+_stats = { 'evictions': 0, 'hits': 0, 'misses': 0 }
+
+# Content hashes of source files, by path, rehashed when their mtime or size
+# change
+_sources = {}
+
+
+def clear():
+    '''
+    Function: clear()
+        Delete all cached results and reset statistics
+    '''
+    for path in Path(CACHE_DIR).glob('*.nc'):
+        path.unlink()
+
+    for k in _stats:
+        _stats[k] = 0
+
+
+def memoize(function):
+    '''
+    Function: memoize()
+        Decorator caching the DataArray results of a function on disk, as
+        compressed netCDF in CACHE_DIR. Results are keyed on the function's
+        code (with the source of its module and of the modules it calls
+        into) and a content hash of its arguments: for data opened lazily
+        from files, the hash covers the file identity (path and mtime) and
+        every selection/operation applied since, so no data is read to
+        check the cache. Calls without lazily loaded data are cheap to
+        recompute, so are not cached. Cached results are returned loaded.
+
+    Inputs:
+    - function (function): function to cache
+
+    Outputs:
+    - (function): decorated function
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not ENABLED or not _has_lazy_data([args, kwargs]):
+            return function(*args, **kwargs)
+
+        key = tokenize(_code_id(function), args, sorted(kwargs.items()))
+        path = Path(CACHE_DIR, f'{function.__name__}-{key}.nc')
+
+        if path.exists():
+            try:
+                result = _load(path)
+                os.utime(path)
+                _stats['hits'] += 1
+                return result
+            except (OSError, ValueError):
+                # Partially written or corrupt, recompute
+                path.unlink(missing_ok=True)
+
+        _stats['misses'] += 1
+        result = function(*args, **kwargs)
+        if type(result) != xarray.DataArray:
+            return result
+
+        result = result.load()
+        _store(result, path)
+        _evict()
+
+        return result
+
+    return wrapper
+
+
+def stats():
+    '''
+    Function: stats()
+        Get cache statistics since the kernel started (or clear())
+
+    Outputs:
+    - (dict): {
+            'bytes': (int), 'evictions': (int), 'files': (int),
+            'hit_rate': (float), 'hits': (int), 'misses': (int)
+        }
+    '''
+    files = list(Path(CACHE_DIR).glob('*.nc'))
+    calls = _stats['hits'] + _stats['misses']
+
+    return {
+        **_stats,
+        'bytes': sum(f.stat().st_size for f in files),
+        'files': len(files),
+        'hit_rate': _stats['hits'] / calls if calls > 0 else 0
+    }
+
+
+def _code_id(function):
+    # Code changes invalidate cached results: the function's own code, the
+    # source of its module (e.g. private helpers it calls) and of modules of
+    # its package it calls into (e.g. libs.comoments)
+    code = function.__code__
+    digest = hashlib.sha1(code.co_code)
+    digest.update(repr([c for c in code.co_consts if not hasattr(c, 'co_code')]).encode())
+    for path in _code_files(function):
+        digest.update(_source_hash(path).encode())
+
+    return f'{function.__module__}.{function.__qualname__}:{digest.hexdigest()}'
+
+
+def _code_files(function):
+    # Source files of the module of function, and of the modules of its
+    # package named in its code, e.g. `comoments` of libs.comoments.f(), or of
+    # functions it calls imported from them
+    module = sys.modules.get(function.__module__)
+    package = function.__module__.split('.')[0]
+    names = set()
+
+    def collect(code):
+        names.update(code.co_names)
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                collect(const)
+
+    collect(function.__code__)
+
+    modules = [module]
+    for name in names:
+        modules.append(sys.modules.get(f'{package}.{name}'))
+        value = getattr(module, name, None)
+        if callable(value) and getattr(value, '__module__', None) != None and value.__module__.split('.')[0] == package:
+            modules.append(sys.modules.get(value.__module__))
+
+    return sorted(set(
+        m.__file__ for m in modules
+        if m != None and getattr(m, '__file__', None) != None
+    ))
+
+
+def _evict():
+    files = sorted(Path(CACHE_DIR).glob('*.nc'), key=lambda f: f.stat().st_mtime)
+    total = sum(f.stat().st_size for f in files)
+
+    for f in files:
+        if total <= MAX_BYTES:
+            break
+
+        total -= f.stat().st_size
+        f.unlink()
+        _stats['evictions'] += 1
+
+
+def _has_lazy_data(value):
+    if type(value) in [xarray.DataArray, xarray.Dataset]:
+        return value.chunks != None and len(value.chunks) > 0
+
+    if type(value) in [list, tuple]:
+        return any(_has_lazy_data(v) for v in value)
+
+    if type(value) == dict:
+        return any(_has_lazy_data(v) for v in value.values())
+
+    return False
+
+
+def _load(path):
+    with xarray.open_dataarray(path, use_cftime=True) as data:
+        data = data.load()
+
+    attrs = json.loads(data.attrs.pop('_memo_attrs', '{}'))
+    data.attrs = attrs
+    if data.name == '_memo_unnamed':
+        data.name = None
+
+    return data
+
+
+def _store(data, path):
+    attrs = json.dumps(data.attrs, default=str)
+    name = data.name if data.name != None else '_memo_unnamed'
+    data = data.copy(deep=False).to_dataset(name=name)
+
+    for variable in data.variables.values():
+        variable.encoding = {}
+        variable.attrs = { k: v for k, v in variable.attrs.items() if type(v) in [str, int, float] }
+
+    # netCDF attributes can only be strings/numbers, so attrs of the result
+    # (e.g. plot_kwargs) are kept as JSON
+    data[name].attrs = { '_memo_attrs': attrs }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Per process, so concurrent writers of the same result don't collide
+    path_tmp = Path(path.parent, f'{path.stem}.{os.getpid()}.tmp')
+    data.to_netcdf(
+        path_tmp,
+        engine='netcdf4',
+        encoding={ name: { 'zlib': True, 'complevel': 4 } }
+    )
+    os.replace(path_tmp, path)
+
+
+def _source_hash(path):
+    stat = os.stat(path)
+    record = _sources.get(path)
+    if record == None or record['mtime'] != stat.st_mtime or record['size'] != stat.st_size:
+        with open(path, 'rb') as f:
+            record = { 'mtime': stat.st_mtime, 'sha1': hashlib.sha1(f.read()).hexdigest(), 'size': stat.st_size }
+        _sources[path] = record
+
+    return record['sha1']
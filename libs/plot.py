@@ -1,14 +1,29 @@
 # -*- coding: utf-8 -*-
 import cartopy.crs as ccrs
+import cartopy.feature
+import hashlib
 import cftime
 import datetime
 import libs.analysis
+import libs.cells
 import libs.vars
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import xarray
 
+STEREO = ccrs.Stereographic(central_latitude=90.0)
+
+# Keys of pcolormesh kwargs which determine colors (as in xarray)
+CMAP_KWARGS = ['center', 'cmap', 'extend', 'levels', 'norm', 'robust', 'vmax', 'vmin']
+
+# Percentiles of data to the colormap limits of robust colors (as in xarray)
+ROBUST_PERCENTILE = 2.0
+
+# Projected meshes of each grid, and map decorations, shared by every panel
+# of nstereo()
+_stereo_cache = {}
+
 def calendar_division_spatial(
     time_slices,
     colormesh_kwargs,
@@ -23,7 +38,9 @@ def calendar_division_spatial(
     '''
     Function: calendar_division_spatial()
         Calculate monthly means for time slices and plot on a north stereographic
-        projection (60-90°N)
+        projection (60-90°N). Means are indexed from a cube of all slices,
+        months/seasons and members (see libs.analysis.composite_cube()), so
+        plotting each month in turn only computes it once.
 
     Inputs:
     - arr (array): array of data to plot
@@ -63,33 +80,32 @@ def calendar_division_spatial(
 
     Outputs: None
     '''
-    rows = time_slices
-    if col_var == 'time_slices':
-        rows = []
-        for i, item in enumerate(time_slices[0]['ensemble']):
-            row = [{
-                'data': s['ensemble'][i]['data'],
-                'label': s['label']
-            } for s in time_slices]
-
-            rows.append({
-                'time_slices': row,
-                'label': item['label']
-            })
-
+    # Means of every slice, month/season and member, computed once
+    cube = libs.analysis.composite_cube(time_slices, division)
+    key = datetime.datetime.strptime(time, '%b').month if division == 'month' else time
+    means = cube.sel({ division: key })
+    slices = [{ 'label': str(s), 'slice': s } for s in means['slice'].values]
+    members = [{
+        'label': str(means['label'].sel(member=member).values),
+        'member': member
+    } for member in means['member'].values]
+
+    rows = slices if col_var == 'ensemble' else members
     for r in rows:
-        label = r['label']
         cols = [{
-            'data': libs.analysis.calendar_division_mean(item['data'], time, division),
-            'label': item['label']
-        } for item in r[col_var]]
+            'data': means.sel(slice=r['slice'], member=c['member']),
+            'label': c['label']
+        } for c in members] if col_var == 'ensemble' else [{
+            'data': means.sel(slice=c['slice'], member=r['member']),
+            'label': c['label']
+        } for c in slices]
 
         nstereo(
             cols,
             colorbar_label=f'{text} ({units})',
             colormesh_kwargs=colormesh_kwargs,
             shape=shape,
-            title=title.format(label=label, text=text, time=time, units=units)
+            title=title.format(label=r['label'], text=text, time=time, units=units)
         )
 
 
@@ -257,11 +273,17 @@ def nstereo(
 ):
     '''
     Function: nstereo()
-        Create a set of subplots on a north stereographic projection (60-90N)
+        Create a set of subplots on a north stereographic projection (60-90N).
+        The grid of the data is projected once and cached (see
+        _stereo_mesh()), and map decorations are built from cached
+        geometries, so each panel only draws its array. See nstereo_update()
+        to redraw a figure with new data.
 
     Inputs:
     - arr (array): array of data to plot
         format: [{ 'data': (xarray), 'label': (string) }]
+        data can be packed (see libs.cells.pack()), in which case it is
+        unpacked onto the 2D grid for plotting
     - title (string): title of plot
     - colorbar_label (string): colorbar label
     - colormesh_kwargs (dict): kwargs to pass to pcolormesh
@@ -274,6 +296,8 @@ def nstereo(
             'x': 'longitude',
             'y': 'latitude'
         }
+        Colors are determined as by xarray. Cell corners are inferred from
+        the projected grid, so 'shading' is ignored.
         See:
         - https://xarray.pydata.org/en/stable/generated/xarray.plot.pcolormesh.html
         - https://matplotlib.org/stable/gallery/color/colormap_reference.html
@@ -288,11 +312,10 @@ def nstereo(
         *shape,
         figsize=(5 * shape[1], 6 * shape[0]),
         subplot_kw={
-            'projection': ccrs.Stereographic(central_latitude=90.0)
+            'projection': STEREO
         }
     )
     fig.suptitle(title)
-    transform = ccrs.PlateCarree()
     axs = axs.flatten() if len(arr) > 1 else [axs]
 
     subfigs = []
@@ -300,23 +323,19 @@ def nstereo(
         if i >= len(arr):
             continue
 
-        ax.coastlines(resolution='110m', linewidth=0.5)
-        ax.set_extent([-180, 180, 60, 90], transform)
-        gl = ax.gridlines()
-        gl.ylocator = matplotlib.ticker.LinearLocator(4)
-
-        # Crop to circle
-        theta = np.linspace(0, 2 * np.pi, 100)
-        center, radius = [0.5, 0.5], 0.5
-        verts = np.vstack([np.sin(theta), np.cos(theta)]).T
-        circle = matplotlib.path.Path(verts * radius + center)
-        ax.set_boundary(circle, transform=ax.transAxes)
-
-        subfig = arr[i]['data'].plot.pcolormesh(
-            add_colorbar=False,
-            ax=ax,
-            transform=transform,
-            **colormesh_kwargs
+        _stereo_axes(ax)
+        panel = _stereo_panel(arr[i]['data'], colormesh_kwargs)
+        kwargs = { k: v for k, v in colormesh_kwargs.items() if k not in CMAP_KWARGS + ['shading', 'x', 'y'] }
+
+        # Plotted in projected coordinates, so cartopy does not reproject
+        # (or check for wrapped cells) again
+        subfig = matplotlib.axes.Axes.pcolormesh(
+            ax,
+            panel['mesh']['x'],
+            panel['mesh']['y'],
+            panel['values'],
+            **panel['cmap'],
+            **kwargs
         )
         ax.set_title(arr[i]['label'])
         subfigs.append(subfig)
@@ -337,6 +356,43 @@ def nstereo(
     return fig, subfigs
 
 
+def nstereo_update(fig, subfigs, arr, colormesh_kwargs, title=None):
+    '''
+    Function: nstereo_update()
+        Redraw a figure created by nstereo() with new data on the same grid,
+        e.g. the next month of a set of figures, updating only the array and
+        title of each panel
+
+    Inputs:
+    - fig (matplotlib.figure.Figure): figure, from nstereo()
+    - subfigs (array): panels, from nstereo()
+    - arr (array): array of data to plot, in the same order as nstereo()
+        format: [{ 'data': (xarray), 'label': (string) }]
+    - colormesh_kwargs (dict): kwargs passed to nstereo()
+    - title (string): title of plot
+        default: None (unchanged)
+
+    Outputs:
+    - (tuple): fig, subfigs
+    '''
+    if title != None:
+        fig.suptitle(title)
+
+    for i, subfig in enumerate(subfigs):
+        panel = _stereo_panel(arr[i]['data'], colormesh_kwargs)
+        cmap = panel['cmap']
+        subfig.set_array(panel['values'])
+        subfig.set_cmap(cmap['cmap'])
+        if cmap['norm'] != None:
+            subfig.set_norm(cmap['norm'])
+        else:
+            subfig.set_clim(cmap['vmin'], cmap['vmax'])
+
+        subfig.axes.set_title(arr[i]['label'])
+
+    return fig, subfigs
+
+
 def place_legend(fig, ax, data_size, cols=None, force_below=False):
     '''
     Function: place_legend()
@@ -514,3 +570,193 @@ def time_series_from_vars(
     show_legend and place_legend(fig, ax, len(variables))
 
     return fig
+
+
+def _interval_breaks(values, axis):
+    # Cell edges along axis, half way between centres and extrapolated at
+    # the ends (as xarray infers them for pcolormesh)
+    deltas = np.diff(values, axis=axis) / 2
+    first = np.take(values, [0], axis) - np.take(deltas, [0], axis)
+    last = np.take(values, [-1], axis) + np.take(deltas, [-1], axis)
+
+    return np.concatenate([first, np.take(values, range(values.shape[axis] - 1), axis) + deltas, last], axis=axis)
+
+
+def _stereo_axes(ax):
+    # Coastlines, gridlines, extent and circular boundary, all projected
+    # once
+    if 'decorations' not in _stereo_cache:
+        plate_carree = ccrs.PlateCarree()
+        parallels = [
+            STEREO.transform_points(plate_carree, np.linspace(-180, 180, 361), np.full(361, lat))[:, :2]
+            for lat in [60, 70, 80]
+        ]
+        meridians = [
+            STEREO.transform_points(plate_carree, np.full(31, lon), np.linspace(60, 90, 31))[:, :2]
+            for lon in range(-180, 180, 60)
+        ]
+        theta = np.linspace(0, 2 * np.pi, 100)
+        center, radius = [0.5, 0.5], 0.5
+        verts = np.vstack([np.sin(theta), np.cos(theta)]).T
+        _stereo_cache['decorations'] = {
+            'boundary': matplotlib.path.Path(verts * radius + center),
+            'coastlines': _stereo_coastlines(),
+            'gridlines': parallels + meridians,
+            'limit': np.abs(parallels[0]).max()
+        }
+
+    decorations = _stereo_cache['decorations']
+    ax.add_collection(matplotlib.collections.LineCollection(
+        decorations['coastlines'],
+        color='black',
+        linewidth=0.5,
+        zorder=3
+    ))
+    ax.add_collection(matplotlib.collections.LineCollection(
+        decorations['gridlines'],
+        color=matplotlib.rcParams['grid.color'],
+        linestyle=matplotlib.rcParams['grid.linestyle'],
+        linewidth=matplotlib.rcParams['grid.linewidth'],
+        zorder=2
+    ))
+    ax.set_xlim(-decorations['limit'], decorations['limit'])
+    ax.set_ylim(-decorations['limit'], decorations['limit'])
+    ax.set_boundary(decorations['boundary'], transform=ax.transAxes)
+
+
+def _stereo_colors(values, colormesh_kwargs):
+    # Colormap, norm and limits of values, following the rules of
+    # xarray.plot.pcolormesh(): limits from vmin/vmax or the (robust)
+    # data, symmetric about center for divergent data, and discrete
+    # colors for levels (linearly spaced between given limits, otherwise
+    # rounded by MaxNLocator), extended where data is out of range
+    kwargs = { k: v for k, v in colormesh_kwargs.items() if k in CMAP_KWARGS }
+    vmin = kwargs.get('vmin')
+    vmax = kwargs.get('vmax')
+    center = kwargs.get('center')
+    levels = kwargs.get('levels')
+    norm = kwargs.get('norm')
+
+    finite = values[np.isfinite(values)]
+    finite = finite if finite.size > 0 else np.array([0.0])
+    robust = kwargs.get('robust', False)
+
+    # Setting both vmin and vmax, or center=False, gives sequential colors
+    possibly_divergent = center is not False and (vmin == None or vmax == None)
+    user_limits = vmin != None or vmax != None
+    limit = None
+    if vmin == None:
+        vmin = np.percentile(finite, ROBUST_PERCENTILE) if robust else finite.min()
+    elif possibly_divergent:
+        limit = abs(vmin - (center or 0))
+
+    if vmax == None:
+        vmax = np.percentile(finite, 100 - ROBUST_PERCENTILE) if robust else finite.max()
+    elif possibly_divergent:
+        limit = abs(vmax - (center or 0))
+
+    divergent = possibly_divergent and (
+        vmin < 0 < vmax
+        or center != None
+        or (np.ndim(levels) == 1 and levels[0] * levels[-1] < 0)
+    )
+    if divergent:
+        center = center or 0
+        limit = limit if limit != None else max(abs(vmin - center), abs(vmax - center))
+        vmin, vmax = center - limit, center + limit
+
+    cmap = kwargs.get('cmap', 'RdBu_r' if divergent else 'viridis')
+    cmap = plt.get_cmap(cmap) if type(cmap) == str else cmap
+
+    if levels is not None:
+        if np.ndim(levels) == 0:
+            levels = np.linspace(vmin, vmax, levels) if user_limits\
+                else matplotlib.ticker.MaxNLocator(levels - 1).tick_values(vmin, vmax)
+        vmin, vmax = levels[0], levels[-1]
+
+    if vmin == vmax:
+        vmin, vmax = matplotlib.ticker.LinearLocator(2).tick_values(vmin, vmax)
+
+    extend = kwargs.get('extend')
+    if extend == None:
+        below, above = finite.min() < vmin, finite.max() > vmax
+        extend = 'both' if below and above else 'min' if below else 'max' if above else 'neither'
+
+    if levels is not None and norm == None:
+        norm = matplotlib.colors.BoundaryNorm(levels, ncolors=cmap.N, extend=extend)
+        # Values out of range on sides that aren't extended are not drawn
+        cmap = cmap.with_extremes(
+            under=None if extend in ['both', 'min'] else (0, 0, 0, 0),
+            over=None if extend in ['both', 'max'] else (0, 0, 0, 0)
+        )
+
+    if norm != None:
+        return { 'cmap': cmap, 'norm': norm, 'vmax': None, 'vmin': None }
+
+    return { 'cmap': cmap, 'norm': None, 'vmax': vmax, 'vmin': vmin }
+
+
+def _stereo_coastlines():
+    # Natural Earth 110m coastlines (as ax.coastlines()) in north
+    # stereographic coordinates, with points south of 40N left out
+    plate_carree = ccrs.PlateCarree()
+    feature = cartopy.feature.NaturalEarthFeature('physical', 'coastline', '110m')
+    lines = []
+    for geometry in feature.geometries():
+        for line in getattr(geometry, 'geoms', [geometry]):
+            coords = np.asarray(line.coords)
+            if not (coords[:, 1] > 40).any():
+                continue
+
+            points = STEREO.transform_points(plate_carree, coords[:, 0], coords[:, 1])[:, :2]
+            points[coords[:, 1] <= 40] = np.nan
+            lines.append(points)
+
+    return lines
+
+
+def _stereo_mesh(data, x, y):
+    # Grid of data projected to north stereographic coordinates, with cell
+    # corners, cropped to the rows reaching north of 55N. Rows are along
+    # the dimension latitude varies most along, by name, so data and
+    # coordinates can be in any order. Cached by a hash of the grid, so
+    # each grid is only projected once.
+    dims = data[y].dims if data[y].ndim == 2 else (data[y].dims[0], data[x].dims[0])
+    row_dim = max(dims, key=lambda d: float(np.abs(data[y].broadcast_like(data[x]).diff(d)).mean()))
+    dims = (row_dim,) + tuple(d for d in dims if d != row_dim)
+    longitude = data[x].broadcast_like(data[y]).transpose(*dims).values
+    latitude = data[y].broadcast_like(data[x]).transpose(*dims).values
+    key = hashlib.sha1(str(dims).encode() + longitude.tobytes() + latitude.tobytes()).hexdigest()
+
+    if key not in _stereo_cache:
+        rows = np.nonzero((latitude > 55).any(axis=1))[0]
+        rows = slice(rows.min(), rows.max() + 1)
+        points = STEREO.transform_points(ccrs.PlateCarree(), longitude[rows], latitude[rows])
+        corners = [
+            _interval_breaks(_interval_breaks(points[..., k], 1), 0)
+            for k in [0, 1]
+        ]
+        _stereo_cache[key] = {
+            'crop': { dims[0]: rows },
+            'dims': dims,
+            'x': corners[0],
+            'y': corners[1]
+        }
+
+    return _stereo_cache[key]
+
+
+def _stereo_panel(data, colormesh_kwargs):
+    # Values of data on the cropped, projected mesh of its grid, and colors
+    # as xarray.plot.pcolormesh() determines them (from all values)
+    if 'cell' in data.dims:
+        data = libs.cells.unpack(data)
+
+    mesh = _stereo_mesh(data, colormesh_kwargs.get('x', 'longitude'), colormesh_kwargs.get('y', 'latitude'))
+    values = data.transpose(*mesh['dims']).values
+
+    return {
+        'cmap': _stereo_colors(values, colormesh_kwargs),
+        'mesh': mesh,
+        'values': np.ma.masked_invalid(data.isel(mesh['crop']).transpose(*mesh['dims']).values)
+    }
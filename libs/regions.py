@@ -0,0 +1,132 @@
+import libs.cells
+import libs.vars
+import numpy as np
+import scipy.sparse
+import xarray
+
+
+def reduce(data, matrix, method='mean'):
+    '''
+    Function: reduce()
+        Calculate the weighted sum or mean of data over every region of a
+        weight matrix in a single pass over each chunk, as
+        `data.where(in_region).weighted(weight).sum/mean(skipna=True)` for
+        each region in turn
+
+    Inputs:
+    - data (xarray.DataArray): data on the grid (or packed cells) of matrix
+    - matrix (dict): see weight_matrix()
+    - method (string): whether to calculate mean or sum
+        allowed values: 'sum', 'mean'
+        default: 'mean'
+
+    Outputs:
+    - (xarray.DataArray): reduced data, with the spatial dimensions replaced
+        by a 'region' dimension
+    '''
+    if method not in ['sum', 'mean']:
+        raise ValueError(f'`method` should be either `sum` or `mean`, got {method}')
+
+    dims = matrix['dims']
+    weights = matrix['matrix']
+    n_cells = weights.shape[1]
+
+    def _reduce(values):
+        leading = values.shape[:-len(dims)]
+        values = values.reshape(-1, n_cells)
+        valid = ~np.isnan(values)
+        # (regions x cells) @ (cells x n), so the result is (regions x n)
+        reduced = weights @ np.where(valid, values, 0).T
+
+        if method == 'mean':
+            sum_of_weights = weights @ valid.T.astype(values.dtype)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                reduced = np.where(sum_of_weights != 0, reduced / sum_of_weights, np.nan)
+
+        return np.asarray(reduced).T.reshape(leading + (weights.shape[0],))
+
+    if data.chunks != None:
+        # Each block needs whole spatial dimensions
+        data = data.chunk({ d: -1 for d in dims })
+
+    reduced = xarray.apply_ufunc(
+        _reduce,
+        data,
+        input_core_dims=[list(dims)],
+        output_core_dims=[['region']],
+        dask='parallelized',
+        dask_gufunc_kwargs={ 'output_sizes': { 'region': weights.shape[0] } },
+        output_dtypes=[np.result_type(data.dtype, np.float32)],
+        keep_attrs=True
+    )
+
+    return reduced.assign_coords(region=matrix['labels'])
+
+
+def weight_matrix(
+    weight,
+    regions=libs.vars.nsidc_regions(),
+    mask_path=libs.cells.NSIDC_MASK_PATH,
+    min_latitude=60
+):
+    '''
+    Function: weight_matrix()
+        Build a sparse region x cell weight matrix from the NSIDC region
+        mask, holding the weight of each cell in each region it belongs to.
+        Regions can overlap (e.g. 'Arctic Ocean' and 'Barents Sea'), as each
+        is a row of its own.
+
+    Inputs:
+    - weight (xarray.DataArray): weight of each cell (e.g. areacello), on
+        the whole grid of the mask or packed (see libs.cells.pack())
+    - regions (array): regions, see libs.vars.nsidc_regions()
+        default: libs.vars.nsidc_regions()
+    - mask_path (string): NSIDC region mask, regridded to the grid of weight
+        default: libs.cells.NSIDC_MASK_PATH
+    - min_latitude (float): minimum latitude of cells
+        default: 60
+
+    Outputs:
+    - (dict): matrix, formatted as
+        {
+            'dims': (tuple), 'labels': (array),
+            'matrix': (scipy.sparse.csr_matrix)
+        }
+        where 'dims' are the spatial dimensions of weight and 'labels' the
+        region of each row
+    '''
+    with xarray.open_dataset(mask_path) as mask:
+        mask_values = mask.mask.values
+
+    if 'cell' in weight.dims:
+        index = libs.cells.get_index(weight)
+        mask_values = mask_values[index['j'], index['i']]
+        latitude = index['latitude'][index['j'], index['i']]
+    else:
+        if mask_values.shape != weight.shape:
+            raise ValueError(f'Weight {weight.shape} is not on the grid of the mask {mask_values.shape}, e.g. cropped')
+
+        mask_values = mask_values.ravel()
+        latitude = weight.latitude.transpose(*weight.dims).values.ravel()
+
+    weight_values = np.nan_to_num(weight.values).ravel()
+    in_latitude = latitude > min_latitude
+
+    rows = []
+    cols = []
+    for r, region in enumerate(regions):
+        cells = np.nonzero(np.isin(mask_values, region['values']) & in_latitude)[0]
+        rows.append(np.full(len(cells), r))
+        cols.append(cells)
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+
+    return {
+        'dims': tuple(weight.dims),
+        'labels': [region['label'] for region in regions],
+        'matrix': scipy.sparse.csr_matrix(
+            (weight_values[cols], (rows, cols)),
+            shape=(len(regions), len(weight_values))
+        )
+    }
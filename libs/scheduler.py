@@ -0,0 +1,405 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dask.base import tokenize
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import libs.catalog
+import libs.utils
+import multiprocessing
+import time
+import traceback
+import xarray
+
+JOURNAL_PATH = '_data/_cache/_jobs/remote-download.jsonl'
+
+# Maximum number of tasks that can be in each stage at once, across all
+# worker processes. Network, NCO subprocesses and regridding need different caps
+STAGE_LIMITS = {
+    'query': 4,
+    'download': 4,
+    'regrid': 2,
+    'write': 2
+}
+
+# Set in each worker process by _init_worker()
+_journal_lock = None
+_semaphores = {}
+
+
+def expand_tasks(
+    experiments,
+    variables,
+    ensemble,
+    force_write=False,
+    process_files=True,
+    save_to_local=True
+):
+    '''
+    Function: expand_tasks()
+        Expand an experiments x variables x ensemble matrix into download
+        tasks. Per-variable overrides in ensemble items (e.g.
+        'pr': { 'grid_label': 'gr' }) are applied, as in get_and_preprocess()
+
+    Inputs:
+    - experiments (array): e.g.
+        [{ 'experiment_id': 'ssp585', 'time_slice': slice('2015-01-01', '2101-01-01') }]
+    - variables (array): e.g.
+        [{ 'variable_id': 'pr', 'frequency': 'mon', 'regrid_kwargs': {...}, 'table_id': 'Amon' }]
+    - ensemble (array): ensemble members, see libs.vars.ensemble()
+    - force_write (bool): see libs.utils.download_variable()
+        default: False
+    - process_files (bool): see libs.utils.download_variable()
+        default: True
+    - save_to_local (bool): see libs.utils.download_variable()
+        default: True
+
+    Outputs:
+    - (array): tasks, formatted as { 'id': (string), 'params': (dict) }
+    '''
+    tasks = []
+    for e in experiments:
+        for v in variables:
+            for item in ensemble:
+                params = {
+                    **e,
+                    **v,
+                    'force_write': force_write,
+                    'process_files': process_files,
+                    'save_to_local': save_to_local,
+                    'source_id': item['source_id'],
+                    'variant_label': item['variant_label']
+                }
+
+                if v['variable_id'] in item:
+                    params = { **params, **item[v['variable_id']] }
+
+                tasks.append({
+                    'id': '/'.join([
+                        params['experiment_id'],
+                        params['variable_id'],
+                        params['source_id'],
+                        params['variant_label']
+                    ]),
+                    'params': params
+                })
+
+    return tasks
+
+
+def read_journal(path=JOURNAL_PATH):
+    '''
+    Function: read_journal()
+        Read the latest journal record of each task stage
+
+    Inputs:
+    - path (string): journal path
+        default: JOURNAL_PATH
+
+    Outputs:
+    - (dict): records keyed by task id, then stage
+    '''
+    records = {}
+    if not Path(path).exists():
+        return records
+
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written line from an interrupted run
+                continue
+
+            records.setdefault(record['task'], {})[record['stage']] = record
+
+    return records
+
+
+def run(
+    tasks,
+    journal_path=JOURNAL_PATH,
+    limits=STAGE_LIMITS,
+    max_workers=4,
+    force=False
+):
+    '''
+    Function: run()
+        Run tasks on a process pool. Each task runs the stages
+        query -> download -> regrid -> write, and every
+        completed stage is appended to a journal. Stages are skipped when
+        their journal record has the same parameters and their outputs
+        exist and are newer than their inputs, so an interrupted run
+        resumes where it stopped. Stages that found nothing (no search
+        results or files) are journaled as empty and run again.
+
+    Inputs:
+    - tasks (array): tasks from expand_tasks()
+    - journal_path (string): journal path
+        default: JOURNAL_PATH
+    - limits (dict): maximum concurrent tasks per stage
+        default: STAGE_LIMITS
+    - max_workers (int): number of worker processes
+        default: 4
+    - force (bool): whether to ignore the journal and re-run every stage
+        default: False
+
+    Outputs:
+    - (dict): result of each task keyed by task id, formatted as
+        {
+            'empty': (string or None, stage that found nothing),
+            'error': (string or None),
+            'output': (string or None),
+            'ran': (array),
+            'skipped': (array)
+        }
+    '''
+    Path(journal_path).parent.mkdir(parents=True, exist_ok=True)
+    journal = {} if force else read_journal(journal_path)
+    journal_lock = multiprocessing.Lock()
+    semaphores = { stage: multiprocessing.BoundedSemaphore(limit) for stage, limit in limits.items() }
+
+    results = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(journal_lock, semaphores)
+    ) as executor:
+        futures = {
+            executor.submit(_run_task, task, journal.get(task['id'], {}), journal_path): task
+            for task in tasks
+        }
+
+        for future in as_completed(futures):
+            task = futures[future]
+            result = future.result()
+            results[task['id']] = result
+
+            status = 'failed' if result['error'] != None else 'empty' if result['empty'] != None else 'done'
+            print(f'[{status}] {task["id"]}', f'-> ran: {result["ran"]}', f'-> skipped: {result["skipped"]}', sep='\n')
+            result['error'] != None and print(result['error'])
+
+    return results
+
+
+def stages_for(params):
+    '''
+    Function: stages_for()
+        Get the stages a task needs to run, based on its parameters
+
+    Inputs:
+    - params (dict): task parameters
+
+    Outputs:
+    - (array): stage names
+    '''
+    if not params.get('save_to_local'):
+        return ['query']
+
+    if not params.get('process_files'):
+        return ['query', 'download']
+
+    return ['query', 'download', 'regrid', 'write']
+
+
+def _init_worker(journal_lock, semaphores):
+    global _journal_lock, _semaphores
+    _journal_lock = journal_lock
+    _semaphores = semaphores
+
+
+def _is_up_to_date(stage, records, params_hash, stages):
+    record = records.get(stage)
+    if record == None or record['status'] != 'done' or record['params'] != params_hash:
+        return False
+
+    # Journals written before stages that found nothing were recorded as
+    # 'empty' have them as 'done' without a result
+    if record['result'] == None:
+        return False
+
+    if STAGES[stage]['ephemeral']:
+        return False
+
+    outputs = [Path(o) for o in record['outputs']]
+    if not all(o.exists() for o in outputs):
+        return False
+
+    if len(outputs) == 0:
+        return True
+
+    # Outputs must be newer than any inputs from earlier stages that still
+    # exist (e.g. source files may have been deleted after processing)
+    oldest_output = min(o.stat().st_mtime for o in outputs)
+    for s in stages[:stages.index(stage)]:
+        for i in records.get(s, {}).get('outputs', []):
+            if Path(i).exists() and Path(i).stat().st_mtime > oldest_output:
+                return False
+
+    return True
+
+
+def _journal(path, task_id, stage, status, params_hash, outputs=[], result=None):
+    record = {
+        'outputs': [str(o) for o in outputs],
+        'params': params_hash,
+        'result': result,
+        'stage': stage,
+        'status': status,
+        'task': task_id,
+        'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    }
+
+    with _journal_lock:
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def _run_task(task, records, journal_path):
+    params = task['params']
+    params_hash = tokenize(params)
+    stages = stages_for(params)
+    result = { 'empty': None, 'error': None, 'output': None, 'ran': [], 'skipped': [] }
+
+    # Resume after the last stage that is still up to date
+    start = 0
+    state = None
+    for i in reversed(range(len(stages))):
+        if _is_up_to_date(stages[i], records, params_hash, stages):
+            start = i + 1
+            state = records[stages[i]]['result']
+            break
+
+    result['skipped'] = stages[:start]
+
+    # Processed files written by a previous run are out of date if the write
+    # stage is re-run, so overwrite them rather than keeping the existing
+    # file. A query that found nothing before is searched again, rather than
+    # answered from the catalog
+    run_params = {
+        **params,
+        'force_write': params.get('force_write') or 'write' in records,
+        'refresh_query': records.get('query', {}).get('status') == 'empty'
+    }
+
+    for stage in stages[start:]:
+        t0 = time.time()
+        try:
+            with _semaphores[stage]:
+                state, outputs = STAGES[stage]['run'](run_params, state)
+        except Exception:
+            result['error'] = traceback.format_exc()
+            _journal(journal_path, task['id'], stage, 'failed', params_hash)
+            return result
+
+        # Nothing further to do if no results or files were found. The stage
+        # is journaled as empty so it is run again next time
+        _journal(
+            journal_path,
+            task['id'],
+            stage,
+            'empty' if state == None else 'done',
+            params_hash,
+            outputs=outputs,
+            result=None if STAGES[stage]['ephemeral'] else state
+        )
+        result['ran'].append(f'{stage} ({time.time() - t0:.1f}s)')
+
+        if state == None:
+            result['empty'] = stage
+            break
+
+    if type(state) == dict:
+        result['output'] = state.get('processed') or state.get('files')
+
+    return result
+
+
+def _stage_query(params, state):
+    query = libs.utils.esgf_query(
+        params['experiment_id'],
+        params['source_id'],
+        params['variable_id'],
+        frequency=params.get('frequency'),
+        grid_label=params.get('grid_label', 'gn'),
+        table_id=params.get('table_id'),
+        variant_label=params.get('variant_label')
+    )
+    results = libs.catalog.search(
+        query,
+        headers=libs.utils.ESGF_HEADERS,
+        refresh=params.get('refresh_query', False)
+    )
+
+    time_slice = params.get('time_slice')
+    items = []
+    for item in results:
+        if time_slice != None and libs.utils.test_date_bounds(
+            time_slice,
+            test_start=datetime.strptime(item['datetime_start'], '%Y-%m-%dT%H:%M:%SZ'),
+            test_stop=datetime.strptime(item['datetime_stop'], '%Y-%m-%dT%H:%M:%SZ')
+        ):
+            continue
+
+        items.append(item)
+
+    return ({ 'items': items } if len(items) > 0 else None), []
+
+
+def _stage_download(params, state):
+    time_slice = params.get('time_slice')
+    for item in state['items']:
+        local_path = f'_data/cmip6/{item["source_id"][0]}/{params["variable_id"]}'
+        try:
+            files = libs.utils.download_remote_files(item, local_path, libs.utils.ESGF_HEADERS, time_slice)
+        except Exception as e:
+            print('An error occurred downloading remote files', e, sep='\n')
+            print('Attempting to retrieve from local...')
+            files = libs.utils.get_local_files(item, local_path, libs.utils.ESGF_HEADERS, time_slice)
+
+        if len(files) > 0:
+            return { 'files': files, 'local_path': local_path }, files
+
+    return None, []
+
+
+def _stage_regrid(params, state):
+    # Source files are streamed directly, without an intermediate merged file
+    data = xarray.open_mfdataset(
+        paths=state['files'],
+        combine='by_coords',
+        autoclose=True,
+        use_cftime=True
+    )
+    data = libs.utils.process_merged(
+        data,
+        params.get('frequency'),
+        params.get('time_slice'),
+        params.get('regrid_kwargs')
+    )
+
+    return { **state, 'data': data }, []
+
+
+def _stage_write(params, state):
+    data = state.pop('data')
+    processed = str(libs.utils.write_ingested(
+        data,
+        state['files'][0],
+        state['local_path'],
+        params['variable_id'],
+        backend=params.get('backend', 'netcdf'),
+        force_write=params.get('force_write', False)
+    ))
+    data.close()
+
+    return { **state, 'processed': processed }, [processed]
+
+
+STAGES = {
+    'query': { 'ephemeral': False, 'run': _stage_query },
+    'download': { 'ephemeral': False, 'run': _stage_download },
+    # The regridded dataset only exists in memory, so this stage always
+    # re-runs when the write stage needs to
+    'regrid': { 'ephemeral': True, 'run': _stage_regrid },
+    'write': { 'ephemeral': False, 'run': _stage_write }
+}
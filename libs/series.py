@@ -0,0 +1,304 @@
+from pathlib import Path
+import hashlib
+import json
+import libs.cells
+import libs.ensemble
+import libs.index
+import libs.local
+import libs.vars
+import numpy as np
+import os
+import xarray
+
+# Date range of every cached series, see libs.local.get_ensemble_series()
+SERIES_DATES = '198001-210012'
+
+# Statistics cached for each region (see libs.ensemble.STATISTICS), with
+# their filename suffixes
+SUFFIXES = {
+    'delta': '_delta_1980-2010',
+    'raw': '',
+    'smoothed': '_smooth'
+}
+
+
+def file_record(path, previous=None):
+    '''
+    Function: file_record()
+        Get the content hash of a file. Files are only hashed again if their
+        mtime or size changed since a previous record, so unchanged inputs
+        cost a stat.
+
+    Inputs:
+    - path (string): file path
+    - previous (dict): record of the file from an earlier file_record() call
+        default: None
+
+    Outputs:
+    - (dict): record, formatted as { 'mtime': (float), 'sha1': (string), 'size': (int) }
+    '''
+    stat = os.stat(path)
+    if previous != None and previous['mtime'] == stat.st_mtime and previous['size'] == stat.st_size:
+        return previous
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            digest.update(block)
+
+    return { 'mtime': stat.st_mtime, 'sha1': digest.hexdigest(), 'size': stat.st_size }
+
+
+def function_id(function):
+    '''
+    Function: function_id()
+        Identify a function by its code (bytecode, constants, names,
+        defaults and closure), so series are only recomputed when the code
+        of a preprocess/weighting function changes, not when it is moved
+
+    Inputs:
+    - function (function): function, e.g. a lambda from libs.vars.variables()
+
+    Outputs:
+    - (string): hex digest, or None if function is None
+    '''
+    if function == None:
+        return None
+
+    digest = hashlib.sha1()
+
+    def update(code):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                update(const)
+            else:
+                digest.update(repr(const).encode())
+
+    update(function.__code__)
+    digest.update(repr(function.__defaults__).encode())
+    for cell in function.__closure__ or []:
+        contents = cell.cell_contents
+        digest.update((function_id(contents) if callable(contents) else repr(contents)).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def series_path(variable_id, experiment, region, suffix=''):
+    '''
+    Function: series_path()
+        Get the path of a cached regional series, format:
+        `_data/_cache/{variable_id}/{variable_id}_{experiment}_{region}_198001-210012{suffix}.nc`
+
+    Inputs:
+    - variable_id (string): variable, e.g. 'pr'
+    - experiment (string): model experiment, e.g. 'ssp585'
+    - region (string): label of region in libs.vars.nsidc_regions()
+    - suffix (string): filename suffix, see SUFFIXES
+        default: ''
+
+    Outputs:
+    - (string): file path
+    '''
+    region_slug = region.replace(' ', '_')
+
+    return f'_data/_cache/{variable_id}/{variable_id}_{experiment}_{region_slug}_{SERIES_DATES}{suffix}.nc'
+
+
+def update_series(
+    variable,
+    experiment,
+    regions=libs.vars.nsidc_regions(),
+    mask_path=libs.cells.NSIDC_MASK_PATH,
+    force=False
+):
+    '''
+    Function: update_series()
+        Incrementally regenerate the cached regional series of a variable.
+        Each member variable of a series carries its provenance: hashes of
+        its input files (including areacello), the identity of the
+        preprocess and weighting functions, and the version of its region
+        mask. Only members whose provenance changed (or that were added to
+        libs.vars.ensemble()) are loaded and reduced, and only over the
+        regions affected. Just those variables are rewritten, members no
+        longer in the ensemble are dropped, and the 'Ensemble mean' is
+        recalculated from the cached member series.
+
+    Inputs:
+    - variable (dict): variable, see libs.vars.variables()
+    - experiment (string): model experiment, e.g. 'ssp585'
+    - regions (array): regions, see libs.vars.nsidc_regions()
+        default: libs.vars.nsidc_regions()
+    - mask_path (string): NSIDC region mask
+        default: libs.cells.NSIDC_MASK_PATH
+    - force (bool): whether to recompute every member and region
+        default: False
+
+    Outputs:
+    - (dict): { 'members': (array), 'written': (array) }, the members
+        recomputed and the files written
+    '''
+    variable_id = variable['variable_id']
+    component = variable['component']
+    ensemble = libs.vars.ensemble()
+    labels = [item['source_id'] for item in ensemble]
+
+    with xarray.open_dataset(mask_path) as mask:
+        mask_values = mask.mask.values
+
+    mask_ids = {
+        r['label']: hashlib.sha1(np.packbits(np.isin(mask_values, r['values']))).hexdigest()[:16]
+        for r in regions
+    }
+    functions = {
+        'preprocess': function_id(variable.get('preprocess')),
+        'weighting': f'{variable["weighting_method"]}:{function_id(variable["weighting_process"])}'
+    }
+
+    # Cached series, and the provenance of each member in each region
+    cached = {}
+    stored = {}
+    for r in regions:
+        for statistic, suffix in SUFFIXES.items():
+            path = Path(series_path(variable_id, experiment, r['label'], suffix))
+            cached[(r['label'], statistic)] = None
+            if path.exists():
+                with xarray.open_dataset(path, use_cftime=True) as data:
+                    cached[(r['label'], statistic)] = data.load()
+
+        raw = cached[(r['label'], 'raw')]
+        for label in labels:
+            complete = all(
+                type(cached[(r['label'], s)]) == xarray.Dataset and label in cached[(r['label'], s)]
+                for s in SUFFIXES
+            )
+            stored[(r['label'], label)] = json.loads(raw[label].attrs['provenance'])\
+                if complete and 'provenance' in raw[label].attrs else None
+
+    areacello_paths = libs.local.get_paths('Ofx', 'piControl', 'UKESM1-0-LL', 'areacello', 'r1i1p1f2')
+
+    # Members (and their regions) whose provenance changed
+    stale = {}
+    provenance = {}
+    for item in ensemble:
+        label = item['source_id']
+        paths = libs.local.get_paths(
+            component,
+            experiment,
+            label,
+            variable_id,
+            item['variant_label'],
+            include_hist=True,
+            **item.get(variable_id, {})
+        )
+        if paths == None or areacello_paths == None:
+            continue
+
+        previous = {}
+        for r in regions:
+            if stored[(r['label'], label)] != None:
+                previous.update(stored[(r['label'], label)]['inputs'])
+
+        inputs = { p: file_record(p, previous.get(p)) for p in paths + areacello_paths }
+        for r in regions:
+            provenance[(r['label'], label)] = { **functions, 'inputs': inputs, 'mask': mask_ids[r['label']] }
+            if force or not _is_current(stored[(r['label'], label)], provenance[(r['label'], label)]):
+                stale.setdefault(label, []).append(r['label'])
+
+    written = []
+    recomputed = {}
+    if len(stale):
+        kwargs = { 'preprocess': variable['preprocess'] } if 'preprocess' in variable else {}
+        ensemble_data, weight = libs.ensemble.get_and_preprocess(
+            component,
+            experiment,
+            variable_id,
+            members=list(stale),
+            **kwargs
+        )
+        stale_regions = [r for r in regions if any(r['label'] in v for v in stale.values())]
+        recomputed = libs.ensemble.time_series_regional(
+            ensemble_data,
+            weight,
+            weighting_method=variable['weighting_method'],
+            weighting_process=variable['weighting_process'],
+            regions=stale_regions,
+            statistics=list(SUFFIXES)
+        )
+
+    for r in regions:
+        region_name = r['label']
+        for statistic, suffix in SUFFIXES.items():
+            data = cached[(region_name, statistic)]
+            data_vars = {} if type(data) != xarray.Dataset else {
+                v: data[v] for v in data.data_vars if v in labels
+            }
+            removed = type(data) == xarray.Dataset and any(v not in labels + ['Ensemble mean'] for v in data.data_vars)
+
+            changed = False
+            for item in recomputed.get(statistic, []):
+                if region_name not in stale[item['label']]:
+                    continue
+
+                member_data = item['data'].sel(region=region_name, drop=True)\
+                    .drop_vars('height', errors='ignore')
+                member_data.attrs = {
+                    'color': item['color'],
+                    'label': item['label'],
+                    'provenance': json.dumps(provenance[(region_name, item['label'])], sort_keys=True)
+                }
+                data_vars[item['label']] = member_data
+                changed = True
+
+            if not (changed or removed) or len(data_vars) == 0:
+                continue
+
+            first = next(iter(data_vars.values()))
+            data = xarray.Dataset(
+                data_vars=data_vars,
+                coords=first.coords,
+                attrs={
+                    'description': f'Monthly {variable["text"]} in {region_name}',
+                    'units': variable['units'],
+                    'region': region_name,
+                    'variable_id': variable_id
+                }
+            )
+
+            # Members are ordered as in libs.vars.ensemble()
+            data = libs.ensemble.calc_variable_mean(data[[v for v in labels if v in data_vars]])
+            written.append(_write(data, series_path(variable_id, experiment, region_name, suffix)))
+
+    print(
+        f'Updated {variable_id} {experiment} series:',
+        f'-> recomputed: {", ".join(stale) or "none"}',
+        f'-> written: {len(written)} files',
+        sep='\n'
+    )
+
+    return { 'members': list(stale), 'written': written }
+
+
+def _is_current(stored, current):
+    if stored == None:
+        return False
+
+    if any(stored.get(k) != current[k] for k in ['mask', 'preprocess', 'weighting']):
+        return False
+
+    # Inputs are compared by content, so touched files are not recomputed
+    return { p: r['sha1'] for p, r in stored['inputs'].items() } ==\
+        { p: r['sha1'] for p, r in current['inputs'].items() }
+
+
+def _write(data, path):
+    # Written to a temporary file first, so readers never see a partial file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_suffix('.tmp.nc')
+    data.to_netcdf(path_tmp, engine='netcdf4', unlimited_dims=['time'])
+    os.replace(path_tmp, path)
+    libs.index.add([str(path)])
+
+    return str(path)
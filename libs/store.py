@@ -0,0 +1,583 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import libs.cells
+import libs.index
+import multiprocessing
+import os
+import shutil
+import time
+import xarray
+
+# Chunk layouts of each group. 'time' chunks (the layout written by write()
+# and convert()) hold a few time steps of the whole grid, for maps. 'space'
+# chunks hold every time step of a spatial tile, for regional time series.
+# Packed copies of the Arctic cells only (see pack_group()) are not a chunk
+# layout, as their dimensions differ, so are opened explicitly
+LAYOUTS = {
+    'space': { 'space': 64, 'time': None },
+    'time': { 'space': None, 'time': 12 }
+}
+
+# Encoding kept from source variables, see libs.utils.ingest_encoding()
+_KEEP_ENCODING = ['_FillValue', 'calendar', 'dtype', 'units']
+
+
+def choose_layout(store, group, selection={}):
+    '''
+    Function: choose_layout()
+        Choose the layout of a group (see LAYOUTS) that needs the fewest
+        chunks to be read for a selection, from the consolidated metadata of
+        each available copy. Ties are broken by the number of bytes read.
+
+    Inputs:
+    - store (string): Zarr store path
+    - group (string): group name, see group_name()
+    - selection (dict): positional selection, as data.isel(), e.g.
+        { 'j': slice(250, 330) } for all time steps of a region, or
+        { 'time': slice(0, 240) } for 20 years of the whole grid
+        default: {} (everything)
+
+    Outputs:
+    - (string): layout name
+    '''
+    costs = {}
+    for layout in LAYOUTS:
+        group_path = Path(store, layout_group(group, layout))
+        if not group_path.exists():
+            continue
+
+        with xarray.open_zarr(group_path, consolidated=True, decode_times=False) as data:
+            v = data[_main_variable(data)]
+            chunks = 1
+            nbytes = v.dtype.itemsize
+            for dim, size, dim_chunks in zip(v.dims, v.shape, v.encoding.get('chunks', v.shape)):
+                start, stop, step = selection.get(dim, slice(None)).indices(size)
+                first, last = start // dim_chunks, (max(stop, start + 1) - 1) // dim_chunks
+                chunks *= last - first + 1
+                nbytes *= min((last - first + 1) * dim_chunks, size)
+
+        costs[layout] = (chunks, nbytes)
+
+    return min(costs, key=lambda layout: costs[layout]) if len(costs) else 'time'
+
+
+def compare_read(path, repeats=3):
+    '''
+    Function: compare_read()
+        Compare open time and read throughput of a processed netCDF file and
+        its copy in a Zarr store (see convert())
+
+    Inputs:
+    - path (string): processed netCDF file path
+    - repeats (int): number of times to open and read each copy
+        default: 3
+
+    Outputs:
+    - (dict): best timings for each backend, formatted as
+        { 'netcdf': { 'open': (float), 'read': (float), 'MB/s': (float) }, 'zarr': {...} }
+    '''
+    facets = libs.index.parse_filename(path)
+    store = store_path(facets['source_id'], facets['variable_id'])
+    group = group_name(facets['table_id'], facets['experiment_id'], facets['variant_label'], facets['grid_label'])
+
+    openers = {
+        'netcdf': lambda: xarray.open_mfdataset(paths=[path], combine='by_coords', decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True)),
+        'zarr': lambda: open_groups(store, [group])
+    }
+
+    results = {}
+    for backend, opener in openers.items():
+        timings = []
+        for i in range(repeats):
+            t0 = time.perf_counter()
+            data = opener()
+            t1 = time.perf_counter()
+            nbytes = data[facets['variable_id']].load().nbytes
+            t2 = time.perf_counter()
+            data.close()
+            timings.append((t1 - t0, t2 - t1))
+
+        open_time = min(t[0] for t in timings)
+        read_time = min(t[1] for t in timings)
+        results[backend] = {
+            'MB/s': nbytes / 1e6 / read_time,
+            'open': open_time,
+            'read': read_time
+        }
+
+    print(
+        f'Read comparison: {Path(path).name}',
+        *[f'-> {k}: open {v["open"]:.3f}s, read {v["read"]:.3f}s ({v["MB/s"]:.0f} MB/s)' for k, v in results.items()],
+        sep='\n'
+    )
+
+    return results
+
+
+def convert(paths=None, max_workers=4, time_chunk=12, region_size=120, force=False, layouts=['time']):
+    '''
+    Function: convert()
+        Copy processed netCDF files into Zarr stores, one store per model and
+        variable (see store_path()) with one group per file. Each group is
+        initialised with consolidated metadata, then its time regions are
+        written in parallel by a process pool.
+
+    Inputs:
+    - paths (array): processed netCDF file paths
+        default: None (all processed and fixed files in the local index)
+    - max_workers (int): number of worker processes
+        default: 4
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+    - region_size (int): number of time steps written by each task, rounded
+        up to a multiple of time_chunk
+        default: 120
+    - force (bool): whether to overwrite groups newer than their source file
+        default: False
+    - layouts (array): layouts to write (see LAYOUTS), other than 'time' are
+        written by rechunk(), or 'cells' for a packed copy (see pack_group())
+        default: ['time']
+
+    Outputs:
+    - (array): group paths written
+    '''
+    if paths == None:
+        libs.index.update([libs.index.ROOTS[0]])
+        paths = [r['path'] for r in libs.index.lookup(kind=['fixed', 'processed'])]
+
+    region_size = -(-region_size // time_chunk) * time_chunk
+    tasks = []
+    written = []
+
+    for path in paths:
+        facets = libs.index.parse_filename(path)
+        store = store_path(facets['source_id'], facets['variable_id'])
+        group = group_name(facets['table_id'], facets['experiment_id'], facets['variant_label'], facets['grid_label'])
+        group_path = Path(store, group)
+
+        if not force and group_path.exists() and group_path.stat().st_mtime > Path(path).stat().st_mtime:
+            print(f'   -> Already converted, skipping: {path}')
+            continue
+
+        with xarray.open_dataset(path, chunks={}, decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True)) as data:
+            initialize(data, store, group, time_chunk=time_chunk)
+            size = data.sizes.get('time', 0)
+
+        tasks += [
+            (path, store, group, { 'time': slice(i, min(i + region_size, size)) })
+            for i in range(0, size, region_size)
+        ]
+        written.append(str(group_path))
+
+    # Forked workers can inherit HDF5 locks held by this process, so spawn them
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_write_region_from_file, *task) for task in tasks]
+        for future in as_completed(futures):
+            future.result()
+
+    for group_path in written:
+        for layout in layouts:
+            if layout == 'cells':
+                pack_group(Path(group_path).parent, Path(group_path).name, force=True)
+            elif layout != 'time':
+                rechunk(Path(group_path).parent, Path(group_path).name, layout, force=True)
+
+    print(f'Converted {len(written)} files ({len(tasks)} regions)')
+
+    return written
+
+
+def group_name(component, experiment_id, variant_label, grid_label):
+    '''
+    Function: group_name()
+        Get the group of a model run within a Zarr store
+
+    Inputs:
+    - component (string): model component, e.g. 'Amon', 'SImon'
+    - experiment_id (string): model experiment, e.g. 'historical', 'ssp585'
+    - variant_label (string): model realisation, e.g. 'r2i1p1f2'
+    - grid_label (string): grid label, e.g. 'gn', 'gr'
+
+    Outputs:
+    - (string): group name
+    '''
+    return f'{component}_{experiment_id}_{variant_label}_{grid_label}'
+
+
+def initialize(data, store, group, time_chunk=12, chunks=None, region_dim='time'):
+    '''
+    Function: initialize()
+        Create a group with its consolidated metadata, coordinates and any
+        variables without region_dim, ready for parallel write_region()
+        calls. Any existing group is replaced.
+
+    Inputs:
+    - data (xarray.Dataset): data, or a lazy template of it
+    - store (string): Zarr store path
+    - group (string): group name, see group_name()
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+    - chunks (dict): chunk size of each dimension, overrides time_chunk
+        default: None ({ 'time': time_chunk }, other dimensions whole)
+    - region_dim (string): dimension that regions will be written along
+        default: 'time'
+    '''
+    data, encoding = _prepare(data, chunks or { 'time': time_chunk })
+    group_path = Path(store, group)
+    if group_path.exists():
+        shutil.rmtree(group_path)
+
+    data.to_zarr(
+        group_path,
+        mode='w',
+        compute=False,
+        consolidated=True,
+        encoding=encoding
+    )
+
+    # Variables without region_dim (e.g. 2D latitude/longitude when writing
+    # time regions) are not written by write_region()
+    static = data.drop_vars([v for v in data.variables if region_dim in data[v].dims])
+    if region_dim in data.dims and len(static.variables) > 0:
+        static.to_zarr(group_path, mode='a', consolidated=True)
+
+
+def layout_group(group, layout):
+    '''
+    Function: layout_group()
+        Get the group holding a layout of a group (see LAYOUTS)
+
+    Inputs:
+    - group (string): group name, see group_name()
+    - layout (string): layout name, e.g. 'time', 'space', or 'cells' (see
+        pack_group())
+
+    Outputs:
+    - (string): group name
+    '''
+    return group if layout == 'time' else f'{group}.{layout}'
+
+
+def open_groups(store, groups, chunks=None, date_range=None, selection=None):
+    '''
+    Function: open_groups()
+        Open groups of a Zarr store from their consolidated metadata and
+        combine them by coordinates, as open_mfdataset(combine='by_coords'),
+        keeping the global attributes of the first group
+
+    Inputs:
+    - store (string): Zarr store path
+    - groups (array): group names, see group_name()
+    - chunks (dict): dask chunks, e.g. { 'time': 120 }. Stored chunks are
+        only ever combined, never split, so each is read once
+        default: None (stored chunks)
+    - date_range (tuple or array): (start, end) months formatted as YYYYMM
+        each group is trimmed to, or an array of them (or None), one per
+        group, e.g. to join historical data over its own dates
+        default: None
+    - selection (dict): positional selection the data will be read with,
+        used to open the layout of each group with the fewest chunks to read
+        (see choose_layout()). The selection itself is not applied
+        default: None (the 'time' layout)
+
+    Outputs:
+    - (xarray.Dataset): data, or None if any group does not exist
+    '''
+    for group in groups:
+        if not Path(store, group).exists():
+            print('Error 404', f'-> {Path(store, group)}', sep='\n')
+            return None
+
+    if selection != None:
+        groups = [layout_group(group, choose_layout(store, group, selection)) for group in groups]
+
+    datasets = [
+        xarray.open_zarr(Path(store, group), consolidated=True, decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True))
+        for group in groups
+    ]
+    if chunks != None:
+        datasets = [_combine_chunks(d, chunks) for d in datasets]
+
+    date_ranges = date_range if type(date_range) == list else [date_range] * len(datasets)
+    for i, r in enumerate(date_ranges):
+        if r != None and 'time' in datasets[i].dims:
+            start, end = [str(d) for d in r]
+            datasets[i] = datasets[i].sel(time=slice(f'{start[:4]}-{start[4:6]}', f'{end[:4]}-{end[4:6]}'))
+
+    # Groups of different experiments have different global attributes
+    if len(datasets) == 1:
+        return datasets[0]
+
+    return xarray.combine_by_coords(datasets, combine_attrs='override')
+
+
+def pack_group(store, group, index=None, time_chunk=120, max_mem=512 * 1024 ** 2, force=False):
+    '''
+    Function: pack_group()
+        Write a copy of a group with only the Arctic NSIDC cells, along a 1D
+        'cell' dimension (see libs.cells.pack()), as group '{group}.cells'.
+        The cells are ~10% of the ORCA1 grid, so reading the copy reads an
+        order of magnitude fewer bytes. The copy is built in bands of time
+        steps, so memory use is bounded independently of the size of the
+        group.
+
+    Inputs:
+    - store (string): Zarr store path
+    - group (string): group name in the 'time' layout, see group_name()
+    - index (dict): cells to keep, see libs.cells.cell_index()
+        default: None (NSIDC 'All' cells of the group's latitude)
+    - time_chunk (int): number of time steps per chunk
+        default: 120
+    - max_mem (int): maximum number of bytes of the group to hold in memory
+        at once
+        default: 512 MiB
+    - force (bool): whether to overwrite a copy newer than group
+        default: False
+
+    Outputs:
+    - (Path): group path of the copy
+    '''
+    source_path = Path(store, group)
+    target = layout_group(group, 'cells')
+    target_path = Path(store, target)
+    if not force and target_path.exists() and target_path.stat().st_mtime > source_path.stat().st_mtime:
+        return target_path
+
+    data = xarray.open_zarr(source_path, consolidated=True, decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True))
+    packed = libs.cells.pack(data, index)
+
+    if 'time' not in packed.dims:
+        write(packed.load(), store, target)
+        data.close()
+        return target_path
+
+    initialize(packed, store, target, time_chunk=time_chunk)
+
+    # Time steps per band, rounded down to whole chunks so bands can be written as regions
+    step_bytes = sum(
+        v.nbytes // data.sizes['time'] for v in data.data_vars.values() if 'time' in v.dims
+    )
+    band = max(1, max_mem // max(step_bytes, 1) // time_chunk) * time_chunk
+
+    for start in range(0, packed.sizes['time'], band):
+        region = { 'time': slice(start, min(start + band, packed.sizes['time'])) }
+        write_region(packed.isel(region).load(), store, target, region, isel=False)
+        print(f'   -> Packed {region["time"].stop}/{packed.sizes["time"]} time')
+
+    data.close()
+
+    return target_path
+
+
+def rechunk(store, group, layout='space', max_mem=512 * 1024 ** 2, force=False):
+    '''
+    Function: rechunk()
+        Write a copy of a group in another layout (see LAYOUTS), for
+        open_groups() to choose from. The copy is built in bands along the
+        first spatial dimension, each holding every time step of as many
+        rows as fit in max_mem, so memory use is bounded independently of
+        the size of the group.
+
+    Inputs:
+    - store (string): Zarr store path
+    - group (string): group name in the 'time' layout, see group_name()
+    - layout (string): layout to write
+        default: 'space'
+    - max_mem (int): maximum number of bytes to hold in memory at once
+        default: 512 MiB
+    - force (bool): whether to overwrite a copy newer than group
+        default: False
+
+    Outputs:
+    - (Path): group path of the copy
+    '''
+    source_path = Path(store, group)
+    target = layout_group(group, layout)
+    target_path = Path(store, target)
+    if not force and target_path.exists() and target_path.stat().st_mtime > source_path.stat().st_mtime:
+        return target_path
+
+    data = xarray.open_zarr(source_path, consolidated=True, decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True))
+    dims = [d for d in data[_main_variable(data)].dims if d != 'time']
+    chunks = {
+        d: LAYOUTS[layout]['space'] or data.sizes[d] for d in dims
+    }
+    chunks['time'] = LAYOUTS[layout]['time'] or data.sizes['time']
+    initialize(data, store, target, chunks=chunks, region_dim=dims[0])
+
+    # Rows per band, rounded down to whole chunks so bands can be written as regions
+    row_bytes = sum(
+        v.nbytes // data.sizes[dims[0]] for v in data.data_vars.values() if dims[0] in v.dims
+    )
+    band = max(1, max_mem // max(row_bytes, 1) // chunks[dims[0]]) * chunks[dims[0]]
+
+    for start in range(0, data.sizes[dims[0]], band):
+        region = { dims[0]: slice(start, min(start + band, data.sizes[dims[0]])) }
+        write_region(data.isel(region).load(), store, target, region, isel=False)
+        print(f'   -> Rechunked {region[dims[0]].stop}/{data.sizes[dims[0]]} {dims[0]}')
+
+    data.close()
+
+    return target_path
+
+
+def store_path(source_id, variable_id):
+    '''
+    Function: store_path()
+        Get the Zarr store path of a model variable, format:
+        `_data/cmip6/{source_id}/{variable_id}/{variable_id}_{source_id}.zarr`
+        Each group (see group_name()) is a self-contained hierarchy with its
+        own consolidated metadata, so groups can be written by separate
+        processes without updating shared metadata.
+
+    Inputs:
+    - source_id (string): model family, e.g. 'UKESM1-0-LL'
+    - variable_id (string): variable, e.g. 'pr', 'siconc'
+
+    Outputs:
+    - (string): store path
+    '''
+    return f'_data/cmip6/{source_id}/{variable_id}/{variable_id}_{source_id}.zarr'
+
+
+def time_range(store, group):
+    '''
+    Function: time_range()
+        Get the first and last month of a group, from its time coordinate
+
+    Inputs:
+    - store (string): Zarr store path
+    - group (string): group name, see group_name()
+
+    Outputs:
+    - (tuple): (start, end) months as YYYYMM integers, or None if the group
+        does not exist or has no time dimension
+    '''
+    group_path = Path(store, group)
+    if not group_path.exists():
+        return None
+
+    with xarray.open_zarr(group_path, consolidated=True, decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True)) as data:
+        if 'time' not in data.dims or data.sizes['time'] == 0:
+            return None
+
+        time = data.time.isel(time=[0, -1])
+        months = (time.dt.year * 100 + time.dt.month).values
+
+    return int(months[0]), int(months[1])
+
+
+def write(data, store, group, time_chunk=12):
+    '''
+    Function: write()
+        Write data to a group of a Zarr store with consolidated metadata.
+        Data is written to a temporary group first, so an interrupted write
+        never leaves a partial group behind.
+
+    Inputs:
+    - data (xarray.Dataset): data to write
+    - store (string): Zarr store path
+    - group (string): group name, see group_name()
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+
+    Outputs:
+    - (Path): group path
+    '''
+    data, encoding = _prepare(data, { 'time': time_chunk })
+    group_path = Path(store, group)
+    group_tmp = f'{group}.tmp'
+    if Path(store, group_tmp).exists():
+        shutil.rmtree(Path(store, group_tmp))
+
+    data.to_zarr(Path(store, group_tmp), mode='w', consolidated=True, encoding=encoding)
+
+    if group_path.exists():
+        shutil.rmtree(group_path)
+
+    os.replace(Path(store, group_tmp), group_path)
+
+    return group_path
+
+
+def write_region(data, store, group, region, isel=True):
+    '''
+    Function: write_region()
+        Write a region of data to a group created by initialize().
+        Regions must align with chunk boundaries, so that separate processes
+        can write different regions of the same group at once.
+
+    Inputs:
+    - data (xarray.Dataset): data, with the full time axis
+    - store (string): Zarr store path
+    - group (string): group name, see group_name()
+    - region (dict): e.g. { 'time': slice(0, 120) }
+    - isel (bool): whether to select region from data, False if data only
+        contains the region already
+        default: True
+    '''
+    if isel:
+        data = data.isel(region)
+
+    data = data.drop_vars([v for v in data.variables if not set(region).issubset(data[v].dims)])
+    for v in data.variables.values():
+        v.encoding = {}
+
+    # Sources can be chunked differently from the group, e.g. netCDF stores
+    # time_bnds of an unlimited time axis in (1, 2) chunks, and dask chunks
+    # must not overlap the group's chunks
+    if any(v.chunks != None for v in data.variables.values()):
+        chunks = _stored_chunks(Path(store, group))
+        data = data.chunk({ d: size for d, size in chunks.items() if d in data.dims })
+
+    data.to_zarr(Path(store, group), region=region, consolidated=False)
+
+
+def _combine_chunks(data, chunks):
+    v = data[_main_variable(data)]
+    combined = {}
+    for dim, stored in zip(v.dims, v.encoding.get('chunks', v.shape)):
+        size = chunks.get(dim)
+        size = v.sizes[dim] if size == -1 else size
+        if size != None and size > stored:
+            combined[dim] = size // stored * stored
+
+    return data.chunk(combined) if len(combined) else data
+
+
+def _main_variable(data):
+    return max(data.data_vars, key=lambda v: data[v].size)
+
+
+def _prepare(data, chunks):
+    chunks = { d: min(size, data.sizes[d]) for d, size in chunks.items() if d in data.dims }
+    data = data.chunk(chunks) if len(chunks) else data.copy()
+
+    encoding = {}
+    for name, v in data.variables.items():
+        encoding[name] = { k: v.encoding[k] for k in _KEEP_ENCODING if k in v.encoding }
+        if name not in data.dims and v.ndim > 0:
+            encoding[name]['chunks'] = tuple(
+                chunks.get(dim, size) for dim, size in zip(v.dims, v.shape)
+            )
+
+        # Encoding inherited from netCDF (zlib, chunksizes, etc.) does not apply
+        v.encoding = {}
+
+    return data, encoding
+
+
+def _stored_chunks(group_path):
+    # Chunk size of each dimension of the variables of a group
+    chunks = {}
+    with xarray.open_zarr(group_path, consolidated=True, decode_times=False) as data:
+        for name, v in data.variables.items():
+            if name not in data.dims:
+                chunks.update(zip(v.dims, v.encoding.get('chunks', v.shape)))
+
+    return chunks
+
+
+def _write_region_from_file(path, store, group, region):
+    with xarray.open_dataset(path, chunks={}, decode_times=xarray.coders.CFDatetimeCoder(use_cftime=True)) as data:
+        write_region(data, store, group, region)
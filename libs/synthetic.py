@@ -0,0 +1,605 @@
+from pathlib import Path
+import cftime
+import dask
+import dask.array
+import libs.vars
+import numpy as np
+import os
+import scipy.spatial
+import xarray
+import zlib
+
+# Shape (j, i) of the ORCA1 ocean grid the processed files are regridded to
+ORCA1_SHAPE = (330, 360)
+
+# Shape (lat, lon) of the N96 atmosphere grid of source files
+N96_SHAPE = (144, 192)
+
+# Directory synthetic data is written to, laid out as the repository's
+# _data directory, e.g. {ROOT}/_data/cmip6/{source_id}/{variable_id}/...
+# Run code with ROOT as the working directory to read it with libs.local
+ROOT = '_data/_synthetic'
+
+# Shipped NSIDC mask, remapped to the synthetic grid by nsidc_mask()
+NSIDC_SOURCE_PATH = '_data/NSIDC_Regions_Masks.nc'
+
+# NSIDC mask values of land and coast
+NSIDC_LAND = [20, 21]
+
+VARIABLES = {
+    'evspsbl': {
+        'component': 'Amon',
+        'long_name': 'Evaporation Including Sublimation and Transpiration',
+        'units': 'kg m-2 s-1'
+    },
+    'pr': {
+        'component': 'Amon',
+        'long_name': 'Precipitation',
+        'units': 'kg m-2 s-1'
+    },
+    'prsn': {
+        'component': 'Amon',
+        'long_name': 'Snowfall Flux',
+        'units': 'kg m-2 s-1'
+    },
+    'siconc': {
+        'component': 'SImon',
+        'long_name': 'Sea-Ice Area Percentage (Ocean Grid)',
+        'units': '%'
+    }
+}
+
+
+def ensemble(members=10):
+    '''
+    Function: ensemble()
+        Get ensemble members of synthetic data: the members of
+        libs.vars.ensemble() first (so notebooks read synthetic data
+        unchanged), then synthetic members 'SYN-011', 'SYN-012', ...
+
+    Inputs:
+    - members (int): number of members
+        default: 10
+
+    Outputs:
+    - (array): ensemble items, formatted as libs.vars.ensemble()
+    '''
+    items = libs.vars.ensemble()[:members]
+    rng = np.random.default_rng(0)
+
+    for k in range(len(items) + 1, members + 1):
+        items.append({
+            'color': '#{:02x}{:02x}{:02x}'.format(*rng.integers(0, 256, 3)),
+            'experiment_id': 'ssp585',
+            'si_collapse': False,
+            'source_id': f'SYN-{k:03d}',
+            'variant_label': 'r1i1p1f1'
+        })
+
+    return items
+
+
+def fields(variable_id, latitude, longitude, time, source_id='SYN-001', land=None, seed=0):
+    '''
+    Function: fields()
+        Calculate plausible monthly fields of a variable: an Arctic ice edge
+        that retreats with warming and has a seasonal cycle, precipitation
+        from the tropics and storm tracks, which increases in the Arctic,
+        snowfall where a temperature proxy is below freezing, and
+        evaporation reduced by sea ice, with spatially correlated noise.
+        Each member (source_id) has its own ice edge bias, warming rate
+        and precipitation scaling. Values only depend on the member, the
+        seed and the year of each time step, so they are reproducible
+        whichever time steps are calculated together.
+
+    Inputs:
+    - variable_id (string): variable, one of VARIABLES
+    - latitude (np.array): 2D latitude
+    - longitude (np.array): 2D longitude
+    - time (array): cftime dates
+    - source_id (string): member
+        default: 'SYN-001'
+    - land (np.array): boolean land mask, where ocean variables are NaN
+        default: None (all ocean)
+    - seed (int): random seed
+        default: 0
+
+    Outputs:
+    - (np.array): float32 values, with dimensions (time, ...latitude dims)
+    '''
+    if variable_id not in VARIABLES:
+        raise ValueError(f'`variable_id` should be one of {list(VARIABLES)}, got {variable_id}')
+
+    member = np.random.default_rng([seed, zlib.crc32(source_id.encode())])
+    params = {
+        'edge': member.normal(0, 2),
+        'warming': member.uniform(0.7, 1.3),
+        'wet': member.uniform(0.85, 1.15)
+    }
+
+    years = np.array([t.year for t in time])
+    months = np.array([t.month for t in time])
+    values = np.empty((len(time),) + latitude.shape, dtype=np.float32)
+
+    for year in np.unique(years):
+        steps = years == year
+        rng = np.random.default_rng([seed, zlib.crc32(source_id.encode()), zlib.crc32(variable_id.encode()), int(year)])
+        values[steps] = _field(
+            variable_id,
+            latitude,
+            longitude,
+            year,
+            months[steps][:, None, None],
+            params,
+            rng
+        )
+
+    if variable_id == 'siconc' and type(land) == np.ndarray:
+        values[:, land] = np.nan
+
+    return values
+
+
+def monthly_time(start, end, calendar='360_day'):
+    '''
+    Function: monthly_time()
+        Get mid-month dates and bounds of every month of a year range
+
+    Inputs:
+    - start (int): first year
+    - end (int): last year (inclusive)
+    - calendar (string): cftime calendar
+        default: '360_day'
+
+    Outputs:
+    - (tuple): (dates, bounds), where bounds has shape (months, 2)
+    '''
+    months = [(y, m) for y in range(start, end + 1) for m in range(1, 13)]
+    dates = [cftime.datetime(y, m, 16, calendar=calendar) for y, m in months]
+    bounds = [
+        [cftime.datetime(y, m, 1, calendar=calendar), cftime.datetime(y + m // 12, m % 12 + 1, 1, calendar=calendar)]
+        for y, m in months
+    ]
+
+    return np.array(dates), np.array(bounds)
+
+
+def n96_grid(shape=N96_SHAPE):
+    '''
+    Function: n96_grid()
+        Get a regular atmosphere grid, as the native grid of source files
+
+    Inputs:
+    - shape (tuple): (lat, lon)
+        default: N96_SHAPE
+
+    Outputs:
+    - (xarray.Dataset): grid, with coordinates lat, lon and bounds lat_bnds,
+        lon_bnds
+    '''
+    lat_edges = np.linspace(-90, 90, shape[0] + 1)
+    lon_edges = np.linspace(0, 360, shape[1] + 1)
+
+    return xarray.Dataset(
+        data_vars={
+            'lat_bnds': (('lat', 'bnds'), np.stack([lat_edges[:-1], lat_edges[1:]], axis=-1)),
+            'lon_bnds': (('lon', 'bnds'), np.stack([lon_edges[:-1], lon_edges[1:]], axis=-1))
+        },
+        coords={
+            'lat': ('lat', (lat_edges[:-1] + lat_edges[1:]) / 2, { 'bounds': 'lat_bnds', 'units': 'degrees_north' }),
+            'lon': ('lon', (lon_edges[:-1] + lon_edges[1:]) / 2, { 'bounds': 'lon_bnds', 'units': 'degrees_east' })
+        }
+    )
+
+
+def nsidc_mask(grid, source_path=NSIDC_SOURCE_PATH):
+    '''
+    Function: nsidc_mask()
+        Remap the NSIDC region mask to a grid, taking the nearest source
+        cell of each grid cell (as xesmf's nearest_s2d), as the mask of
+        libs.cells.NSIDC_MASK_PATH. Cells south of the mask are 0.
+
+    Inputs:
+    - grid (xarray.Dataset): grid, see orca_grid()
+    - source_path (string): NSIDC mask on its polar stereographic grid
+        default: NSIDC_SOURCE_PATH
+
+    Outputs:
+    - (xarray.DataArray): mask, with the latitude/longitude of grid
+    '''
+    with xarray.open_dataset(source_path) as source:
+        source_xyz = _xyz(source.lat.values.ravel(), source.lon.values.ravel())
+        source_mask = source.mask.values.ravel()
+        min_latitude = float(source.lat.min())
+
+    # Only cells inside the mask are looked up, as searches for cells far
+    # from any source cell are slow
+    latitude = grid.latitude.values
+    inside = latitude >= min_latitude
+    _, nearest = scipy.spatial.cKDTree(source_xyz).query(_xyz(latitude[inside], grid.longitude.values[inside]))
+    mask = np.zeros(latitude.shape)
+    mask[inside] = source_mask[nearest]
+
+    return xarray.DataArray(
+        mask,
+        coords=grid.coords,
+        dims=grid.latitude.dims,
+        name='mask',
+        attrs={ 'long_name': 'NSIDC Regional mask', 'units': 'none' }
+    )
+
+
+def orca_grid(shape=ORCA1_SHAPE):
+    '''
+    Function: orca_grid()
+        Get a tripolar grid shaped as ORCA1. South of 20°N rows are
+        parallels, from 78°S. North of it, rows are nested ellipses on the
+        polar stereographic plane, collapsing to a line between two poles
+        over Siberia (80°E) and Canada (100°W), so the top row folds onto
+        itself as in ORCA. Cell areas are calculated on the sphere.
+
+    Inputs:
+    - shape (tuple): (j, i)
+        default: ORCA1_SHAPE
+
+    Outputs:
+    - (xarray.Dataset): grid, with coordinates j, i, latitude, longitude,
+        and variable areacello (m²)
+    '''
+    n_north = shape[0] * 3 // 11
+    n_south = shape[0] - n_north
+    longitude = (73.5 + np.arange(shape[1])) * np.pi / 180
+
+    # Stereographic radius of the transition latitude and the poles
+    r0 = np.tan(np.radians(90 - 20) / 2)
+    d = np.tan(np.radians(90 - 65) / 2)
+    axis = np.radians(80)
+
+    s = np.arange(1, n_north + 1)[:, None] / n_north
+    a = r0 * (1 - s) + d * s
+    b = r0 * (1 - s)
+    x_rotated = a * np.cos(longitude - axis)
+    y_rotated = b * np.sin(longitude - axis)
+    x = x_rotated * np.cos(axis) - y_rotated * np.sin(axis)
+    y = x_rotated * np.sin(axis) + y_rotated * np.cos(axis)
+
+    latitude = np.concatenate([
+        np.repeat(np.linspace(-78, 20, n_south, endpoint=False)[:, None], shape[1], axis=1),
+        90 - 2 * np.degrees(np.arctan(np.hypot(x, y)))
+    ])
+    longitude = np.concatenate([
+        np.repeat(np.degrees(longitude)[None, :], n_south, axis=0),
+        np.degrees(np.arctan2(y, x))
+    ])
+    longitude = (longitude + 180) % 360 - 180
+
+    # Area of the parallelogram spanned by neighbouring cells on the sphere
+    xyz = _xyz(latitude, longitude)
+    area = np.linalg.norm(np.cross(np.gradient(xyz, axis=0), np.gradient(xyz, axis=1)), axis=-1)
+
+    coords = {
+        'i': ('i', np.arange(shape[1])),
+        'j': ('j', np.arange(shape[0])),
+        'latitude': (('j', 'i'), latitude, { 'standard_name': 'latitude', 'units': 'degrees_north' }),
+        'longitude': (('j', 'i'), longitude, { 'standard_name': 'longitude', 'units': 'degrees_east' })
+    }
+
+    return xarray.Dataset(
+        data_vars={
+            'areacello': (('j', 'i'), (area * 6371000.0 ** 2).astype(np.float32), { 'units': 'm2' })
+        },
+        coords=coords
+    )
+
+
+def write(
+    root=ROOT,
+    members=10,
+    variables=list(VARIABLES),
+    start=1980,
+    end=2100,
+    shape=ORCA1_SHAPE,
+    seed=0,
+    force=False,
+    verbose=True
+):
+    '''
+    Function: write()
+        Write synthetic processed files of an ensemble, with the filenames
+        and layout of downloaded and processed CMIP6 data: monthly 360_day
+        fields on an ORCA1-shaped grid, historical up to 2014 and ssp585
+        from 2015, as well as UKESM1-0-LL areacello and the NSIDC mask on
+        the same grid. Run code with root as the working directory to read
+        them with libs.local.get_data()/libs.ensemble.get_and_preprocess().
+        Each file is about 0.6GB per 100 years on the ORCA1 grid.
+
+    Inputs:
+    - root (string): directory to write to
+        default: ROOT
+    - members (int or array): number of members (see ensemble()), or
+        ensemble items
+        default: 10
+    - variables (array): variable_ids, any of VARIABLES
+        default: all of VARIABLES
+    - start (int): first year
+        default: 1980
+    - end (int): last year (inclusive)
+        default: 2100
+    - shape (tuple): grid shape (j, i)
+        default: ORCA1_SHAPE
+    - seed (int): random seed
+        default: 0
+    - force (bool): whether to overwrite existing files
+        default: False
+    - verbose (bool): whether to print each file written
+        default: True
+
+    Outputs:
+    - (array): paths of files written or existing
+    '''
+    items = ensemble(members) if type(members) == int else members
+    grid = orca_grid(shape)
+    mask = nsidc_mask(grid)
+    land = np.isin(mask.values, NSIDC_LAND) | (grid.latitude.values < -70)
+
+    paths = []
+    fixed = [
+        (Path(root, '_data/cmip6/UKESM1-0-LL/areacello/areacello_Ofx_UKESM1-0-LL_piControl_r1i1p1f2_gn.nc'), grid),
+        (Path(root, '_data/_cache/NSIDC_Regions_Masks_Ocean_nearest_s2d.nc'), mask.to_dataset())
+    ]
+    for path, data in fixed:
+        if force or not path.exists():
+            _write(data, path)
+            verbose and print(f'   -> Written {path}')
+        paths.append(str(path))
+
+    experiments = [
+        ('historical', start, min(end, 2014)),
+        ('ssp585', max(start, 2015), end)
+    ]
+
+    for item in items:
+        for variable_id in variables:
+            component = VARIABLES[variable_id]['component']
+            grid_label = item.get(variable_id, {}).get('grid_label', 'gn')
+
+            for experiment_id, year_start, year_end in experiments:
+                if year_start > year_end:
+                    continue
+
+                path = Path(
+                    root,
+                    f'_data/cmip6/{item["source_id"]}/{variable_id}',
+                    f'{variable_id}_{component}_{item["source_id"]}_{experiment_id}_{item["variant_label"]}_{grid_label}_{year_start}01-{year_end}12_processed.nc'
+                )
+                if path.exists() and not force:
+                    paths.append(str(path))
+                    continue
+
+                data = _dataset(variable_id, grid, land, year_start, year_end, item['source_id'], seed)
+                data.attrs.update({
+                    'experiment_id': experiment_id,
+                    'grid_label': grid_label,
+                    'source_id': item['source_id'],
+                    'table_id': component,
+                    'variable_id': variable_id,
+                    'variant_label': item['variant_label']
+                })
+                _write(data, path)
+                verbose and print(f'   -> Written {path}')
+                paths.append(str(path))
+
+    return paths
+
+
+def write_source(
+    root=ROOT,
+    members=1,
+    variable_id='pr',
+    start=2015,
+    end=2024,
+    calendar='noleap',
+    years_per_file=10,
+    seed=0,
+    force=False
+):
+    '''
+    Function: write_source()
+        Write synthetic source files, as downloaded from ESGF before
+        processing (see libs.utils.ingest()): monthly fields on the N96
+        atmosphere grid, with a noleap calendar, split into files of
+        years_per_file years, e.g. `pr_Amon_{source_id}_ssp585_{variant}_gn_201501-202412.nc`
+
+    Inputs:
+    - root (string): directory to write to
+        default: ROOT
+    - members (int or array): number of members (see ensemble()), or
+        ensemble items
+        default: 1
+    - variable_id (string): variable, one of the Amon VARIABLES
+        default: 'pr'
+    - start (int): first year, of ssp585
+        default: 2015
+    - end (int): last year (inclusive)
+        default: 2024
+    - calendar (string): cftime calendar
+        default: 'noleap'
+    - years_per_file (int): number of years per file
+        default: 10
+    - seed (int): random seed
+        default: 0
+    - force (bool): whether to overwrite existing files
+        default: False
+
+    Outputs:
+    - (dict): source file paths of each member, keyed by source_id
+    '''
+    if VARIABLES.get(variable_id, {}).get('component') != 'Amon':
+        raise ValueError(f'`variable_id` should be an Amon variable of VARIABLES, got {variable_id}')
+
+    items = ensemble(members) if type(members) == int else members
+    grid = n96_grid()
+    latitude, longitude = xarray.broadcast(grid.lat, grid.lon)
+
+    paths = {}
+    for item in items:
+        paths[item['source_id']] = []
+        for year_start in range(start, end + 1, years_per_file):
+            year_end = min(end, year_start + years_per_file - 1)
+            path = Path(
+                root,
+                f'_data/cmip6/{item["source_id"]}/{variable_id}',
+                f'{variable_id}_Amon_{item["source_id"]}_ssp585_{item["variant_label"]}_gn_{year_start}01-{year_end}12.nc'
+            )
+            paths[item['source_id']].append(str(path))
+            if path.exists() and not force:
+                continue
+
+            time, time_bnds = monthly_time(year_start, year_end, calendar)
+            data = grid.assign_coords(time=('time', time, { 'bounds': 'time_bnds' }))
+            data['time_bnds'] = (('time', 'bnds'), time_bnds)
+            data[variable_id] = (
+                ('time', 'lat', 'lon'),
+                fields(variable_id, latitude.values, longitude.values, time, item['source_id'], seed=seed),
+                {
+                    'long_name': VARIABLES[variable_id]['long_name'],
+                    'units': VARIABLES[variable_id]['units']
+                }
+            )
+            data.attrs = {
+                'experiment_id': 'ssp585',
+                'source_id': item['source_id'],
+                'variable_id': variable_id,
+                'variant_label': item['variant_label']
+            }
+            _write(data, path)
+
+    return paths
+
+
+def _dataset(variable_id, grid, land, start, end, source_id, seed):
+    # Dataset of one file, computed a year at a time as it is written
+    time, time_bnds = monthly_time(start, end)
+    shape = grid.latitude.shape
+    years = [
+        dask.array.from_delayed(
+            dask.delayed(fields)(
+                variable_id,
+                grid.latitude.values,
+                grid.longitude.values,
+                time[k:k + 12],
+                source_id,
+                land,
+                seed
+            ),
+            shape=(12,) + shape,
+            dtype=np.float32
+        )
+        for k in range(0, len(time), 12)
+    ]
+
+    data = grid.drop_vars('areacello').assign_coords(time=('time', time, { 'bounds': 'time_bnds' }))
+    data['time_bnds'] = (('time', 'bnds'), time_bnds)
+    data[variable_id] = (
+        ('time',) + grid.latitude.dims,
+        dask.array.concatenate(years),
+        {
+            'long_name': VARIABLES[variable_id]['long_name'],
+            'units': VARIABLES[variable_id]['units']
+        }
+    )
+
+    return data
+
+
+def _field(variable_id, latitude, longitude, year, months, params, rng):
+    # Fields of the months of one year, see fields()
+    north = latitude > 0
+    abs_latitude = np.abs(latitude)
+    warming = params['warming'] * max(0, (year - 1980) / 120) ** 1.5
+
+    # Temperature proxy (°C), warmest in July in the north, January in the
+    # south, with Arctic amplified warming
+    season = np.cos(2 * np.pi * (months - 7) / 12) * np.where(north, 1, -1)
+    temperature = 28 - 0.55 * abs_latitude + 14 * (abs_latitude / 90) * season\
+        + 8 * warming * (abs_latitude / 90) ** 2
+
+    # Ice edge (°N/°S) furthest from the pole in March/September
+    ice_season = np.cos(2 * np.pi * (months - 3) / 12) * np.where(north, 1, -1)
+    edge = np.where(
+        north,
+        70 + params['edge'] - 7 * ice_season + 4 * np.sin(np.radians(longitude)) + 12 * warming,
+        62 - 5 * ice_season + 4 * warming
+    )
+    siconc = 97 * np.clip((abs_latitude - edge) / 6 + 0.5, 0, 1)
+
+    # Noise on a grid 10 times coarser, so fields are spatially correlated
+    def noise(scale):
+        shape = (len(months),) + tuple(-(-n // 10) for n in latitude.shape)
+        coarse = rng.normal(0, scale, shape)
+        smooth = coarse.repeat(10, axis=1).repeat(10, axis=2)[:, :latitude.shape[0], :latitude.shape[1]]
+        return smooth + rng.normal(0, scale / 4, smooth.shape)
+
+    if variable_id == 'siconc':
+        return np.clip(siconc + np.where(siconc > 0, noise(4), 0), 0, 100)
+
+    # Precipitation (kg m-2 s-1) of the tropics and storm tracks, wettest
+    # in late summer in the Arctic, increasing with warming
+    pr = params['wet'] * (
+        3e-5 * np.exp(-((latitude - 5) / 12) ** 2)
+        + 2e-5 * np.exp(-((abs_latitude - 45) / 15) ** 2)
+        + 0.6e-5
+    ) * (1 - 0.3 * np.cos(2 * np.pi * (months - 3) / 12) * (abs_latitude > 50))\
+        * (1 + 0.4 * warming * (abs_latitude / 90) ** 2)
+    pr = pr * np.exp(noise(0.3) - 0.045)
+
+    if variable_id == 'pr':
+        return pr
+
+    if variable_id == 'prsn':
+        return pr / (1 + np.exp((temperature - 1) / 1.5))
+
+    # Evaporation (kg m-2 s-1) increasing with temperature, reduced by sea ice
+    evspsbl = (0.3e-5 + 3e-5 * np.clip((temperature + 10) / 40, 0, 1)) * (1 - 0.8 * siconc / 100)
+
+    return evspsbl * np.exp(noise(0.15))
+
+
+def _write(data, path, time_chunk=12):
+    # Compressed and chunked as libs.utils.ingest_encoding(), written to a
+    # temporary file first
+    encoding = {}
+    for name, v in data.variables.items():
+        if name not in data.dims and v.ndim > 1 and v.dtype.kind == 'f':
+            encoding[name] = {
+                'chunksizes': tuple(min(time_chunk, size) if dim == 'time' else size for dim, size in zip(v.dims, v.shape)),
+                'complevel': 1,
+                'shuffle': True,
+                'zlib': True
+            }
+
+    if 'time' in data.dims:
+        encoding['time'] = { 'units': 'days since 1850-01-01', 'calendar': data.time.values[0].calendar }
+        encoding['time_bnds'] = { 'units': 'days since 1850-01-01', 'calendar': data.time.values[0].calendar }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_suffix('.tmp')
+    data.to_netcdf(
+        path_tmp,
+        encoding=encoding,
+        engine='netcdf4',
+        unlimited_dims=['time'] if 'time' in data.dims else None
+    )
+    os.replace(path_tmp, path)
+
+
+def _xyz(latitude, longitude):
+    # Unit vectors of points on the sphere
+    latitude = np.radians(latitude)
+    longitude = np.radians(longitude)
+
+    return np.stack([
+        np.cos(latitude) * np.cos(longitude),
+        np.cos(latitude) * np.sin(longitude),
+        np.sin(latitude)
+    ], axis=-1)
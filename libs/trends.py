@@ -0,0 +1,243 @@
+import dask
+import libs.ensemble
+import numpy as np
+import scipy.stats
+import xarray
+
+# Maximum number of pairwise slopes held in memory at once for Sen's slope
+SEN_MAX_VALUES = 2 ** 24
+
+
+def fit(
+    data,
+    dim='time',
+    division=None,
+    alpha=0.05,
+    mann_kendall=False,
+    per_years=10
+):
+    '''
+    Function: fit()
+        Fit least-squares linear trends, with standard errors and p-values,
+        along a dimension of data in every cell/region, member and
+        month/season at once. Fits are closed form from six sums, which are
+        accumulated for all groups in one pass over the (chunked) data.
+        Missing values are skipped, so e.g. cells masked to siconc > 0 are
+        fitted over the time steps they are defined.
+
+        With a member dimension, ensemble agreement is calculated from the
+        same fits: the fraction of members whose trend has the sign of the
+        ensemble median trend, and the fraction that also are significant.
+
+    Inputs:
+    - data (xarray): data to fit, e.g. spatial fields (optionally stacked,
+        see libs.ensemble.stack()) or regional series, or a Dataset with one
+        variable per member (e.g. from libs.local.get_ensemble_series()),
+        which is stacked
+    - dim (string): dimension to fit along. Slopes are per per_years years
+        for 'time', and per per_years units of its coordinate otherwise,
+        e.g. for 'year' after data.groupby('time.year').mean()
+        default: 'time'
+    - division (string): fit each month/season separately
+        allowed values: None, 'month', 'season'
+        default: None
+    - alpha (float): significance level of ensemble agreement
+        default: 0.05
+    - mann_kendall (bool): whether to also calculate the Mann-Kendall test
+        and Sen's slope, which need all of dim in memory for each cell
+        default: False
+    - per_years (float): trend period
+        default: 10 (i.e. trends per decade)
+
+    Outputs:
+    - (xarray.Dataset): trends, with dim replaced by the month/season (if
+        division), and variables
+        - count: number of values fitted
+        - intercept: fitted value at the first step of dim
+        - pvalue: two-sided p-value of the slope (t-test)
+        - slope: trend per per_years
+        - stderr: standard error of the slope
+        - mk_pvalue, mk_s, sen_slope: Mann-Kendall p-value and statistic,
+            Sen's slope per per_years (if mann_kendall)
+        - agreement, agreement_significant: see above (if member dimension)
+    '''
+    if division not in [None, 'month', 'season']:
+        raise ValueError(f'`division` should be either `None`, `month` or `season`, got {division}')
+
+    if division != None and dim != 'time':
+        raise ValueError(f'`division` can only be used with `dim` time, got {dim}')
+
+    if type(data) == xarray.Dataset:
+        data = libs.ensemble.stack(data)
+
+    x = _steps(data, dim, per_years)
+    y = data.astype(np.float64)
+    valid = y.notnull()
+    x_valid = x.where(valid)
+
+    # Prefixed so sums can't collide with dimensions/coordinates of data,
+    # e.g. x/y of curvilinear grids
+    sums = xarray.Dataset({
+        'sum_n': valid.astype(np.float64),
+        'sum_x': x_valid,
+        'sum_xx': x_valid ** 2,
+        'sum_xy': x_valid * y,
+        'sum_y': y,
+        'sum_yy': y ** 2
+    })
+    sums = sums.groupby(data[dim][f'{dim}.{division}']).sum(dim) if division != None else sums.sum(dim)
+
+    mk = None
+    if mann_kendall:
+        if division != None:
+            key = data[dim][f'{dim}.{division}']
+            labels = np.unique(key.values)
+            mk = xarray.concat(
+                [_mann_kendall(y.isel({ dim: key.values == l }), x.isel({ dim: key.values == l }), dim) for l in labels],
+                dim=division
+            ).assign_coords({ division: labels })
+        else:
+            mk = _mann_kendall(y, x, dim)
+
+    # One pass over data for all statistics
+    sums, mk = dask.compute(sums, mk)
+
+    n = sums.sum_n
+    s_xx = sums.sum_xx - sums.sum_x ** 2 / n
+    s_xy = sums.sum_xy - sums.sum_x * sums.sum_y / n
+    s_yy = sums.sum_yy - sums.sum_y ** 2 / n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (s_xy / s_xx).where(n >= 2)
+        intercept = (sums.sum_y - slope * sums.sum_x) / n
+        residual = (s_yy - slope * s_xy).clip(min=0)
+        stderr = np.sqrt(residual / (n - 2) / s_xx).where(n >= 3)
+        t = slope / stderr
+
+    pvalue = xarray.apply_ufunc(
+        lambda t, df: 2 * scipy.stats.t.sf(np.abs(t), df),
+        t,
+        n - 2
+    ).where(stderr.notnull())
+
+    trends = xarray.Dataset({
+        'count': n,
+        'intercept': intercept,
+        'pvalue': pvalue,
+        'slope': slope,
+        'stderr': stderr
+    })
+
+    if type(mk) == xarray.Dataset:
+        trends = trends.merge(mk)
+
+    if 'member' in trends.dims:
+        trends = trends.merge(agreement(trends, alpha))
+
+    trends.attrs = {
+        **data.attrs,
+        'dim': dim,
+        'division': str(division),
+        'per_years': per_years
+    }
+
+    return trends
+
+
+def agreement(trends, alpha=0.05, dim='member'):
+    '''
+    Function: agreement()
+        Calculate ensemble agreement of trends: the fraction of members
+        whose slope has the sign of the ensemble median slope, and the
+        fraction that also have a p-value below alpha
+
+    Inputs:
+    - trends (xarray.Dataset): see fit()
+    - alpha (float): significance level
+        default: 0.05
+    - dim (string): member dimension
+        default: 'member'
+
+    Outputs:
+    - (xarray.Dataset): { 'agreement': (xarray), 'agreement_significant': (xarray) }
+    '''
+    defined = trends.slope.notnull()
+    sign = np.sign(trends.slope.median(dim, skipna=True))
+    agrees = (np.sign(trends.slope) == sign) & defined
+    members = defined.sum(dim)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return xarray.Dataset({
+            'agreement': (agrees.sum(dim) / members).where(members > 0),
+            'agreement_significant': ((agrees & (trends.pvalue < alpha)).sum(dim) / members).where(members > 0)
+        })
+
+
+def _mann_kendall(y, x, dim):
+    # Mann-Kendall test (without tie correction) and Sen's slope along dim,
+    # chunked over all other dimensions
+    if y.chunks != None:
+        y = y.chunk({ dim: -1 })
+
+    def _test(values, steps):
+        shape = values.shape[:-1]
+        values = values.reshape(-1, values.shape[-1])
+        n_steps = values.shape[-1]
+        valid = ~np.isnan(values)
+        n = valid.sum(axis=-1)
+
+        s = np.zeros(len(values))
+        for k in range(1, n_steps):
+            s += np.nan_to_num(np.sign(values[:, k:] - values[:, :-k])).sum(axis=-1)
+
+        variance = n * (n - 1) * (2 * n + 5) / 18
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.where(s > 0, s - 1, np.where(s < 0, s + 1, 0)) / np.sqrt(variance)
+        pvalue = np.where(n >= 3, 2 * scipy.stats.norm.sf(np.abs(z)), np.nan)
+
+        # Sen's slope: median of slopes of all pairs, in batches of cells
+        i, j = np.triu_indices(n_steps, k=1)
+        dx = steps[j] - steps[i]
+        batch = max(1, SEN_MAX_VALUES // max(1, len(i)))
+        sen = np.full(len(values), np.nan)
+        for start in range(0, len(values), batch):
+            block = values[start:start + batch]
+            slopes = (block[:, j] - block[:, i]) / dx
+            with np.errstate(all='ignore'):
+                defined = np.isfinite(slopes).any(axis=-1)
+                if defined.any():
+                    sen[start:start + batch][defined] = np.nanmedian(slopes[defined], axis=-1)
+
+        return (
+            pvalue.reshape(shape),
+            s.reshape(shape),
+            np.where(n >= 2, sen, np.nan).reshape(shape)
+        )
+
+    pvalue, s, sen = xarray.apply_ufunc(
+        _test,
+        y,
+        kwargs={ 'steps': x.values },
+        input_core_dims=[[dim]],
+        output_core_dims=[[], [], []],
+        dask='parallelized',
+        output_dtypes=[np.float64, np.float64, np.float64]
+    )
+
+    return xarray.Dataset({ 'mk_pvalue': pvalue, 'mk_s': s, 'sen_slope': sen })
+
+
+def _steps(data, dim, per_years):
+    # Position of each step along dim, from the first, in trend periods
+    if dim == 'time':
+        # Fractional years, from the month and day of each step, so for any
+        # calendar
+        time = data[dim].dt
+        steps = time.year + (time.month - 1) / 12 + (time.day - 1) / (12 * time.days_in_month)
+    else:
+        steps = data[dim].astype(np.float64)
+
+    return ((steps - steps[0]) / per_years).astype(np.float64).drop_vars(
+        [c for c in data[dim].coords if c != dim],
+        errors='ignore'
+    )
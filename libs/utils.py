@@ -1,14 +1,33 @@
-from dask.diagnostics import ProgressBar
+from collections import OrderedDict
 from datetime import datetime
 from nco import Nco
 from pathlib import Path
+import cf_xarray
 import cftime
-import json
+import hashlib
+import libs.catalog
+import libs.download
+import libs.execution
+import libs.index
+import libs.store
 import netCDF4
-import urllib
+import numpy as np
+import os
 import xarray
 import xesmf
 
+REGRID_WEIGHTS_DIR = '_data/_cache/_regrid_weights'
+REGRIDDER_CACHE_SIZE = 8
+
+# In-memory LRU cache of regridders, see get_regridder()
+_regridders = OrderedDict()
+
+# Set custom User-Agent headers
+ESGF_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11'
+}
+
+
 def compress_nc_file(path, output, options=['-7 -L 1']):
     '''
     Function compress_nc_file():
@@ -36,20 +55,123 @@ def compress_nc_file(path, output, options=['-7 -L 1']):
     return output, diff_str
 
 
+def convert_calendar(
+    data,
+    calendar='360_day',
+    frequency='mon',
+    daily_method='aggregate',
+    day=16
+):
+    '''
+    Function: convert_calendar()
+        Map a noleap, 365_day, all_leap, 366_day, 360_day, gregorian/standard
+        or proleptic_gregorian time axis onto the 360_day calendar, or onto an
+        integer month index, using array arithmetic on the date fields
+        rather than building each date in a loop (monthly dates are only
+        built once per distinct month). Time bounds (`time.attrs['bounds']`
+        or `time_bnds`) are recalculated to match.
+
+    Inputs:
+    - data (xarray): data with a cftime or datetime64 `time` coordinate
+    - calendar (string): target calendar
+        allowed values: '360_day', 'month_index' (i.e. year * 12 + month - 1)
+        default: '360_day'
+    - frequency (string): frequency of data
+        allowed values: 'mon', 'day'
+        default: 'mon'
+    - daily_method (string): how daily data is converted
+        allowed values:
+            'aggregate': monthly means
+            'remap': keep daily data, mapping each day by its fractional
+                position in the year and dropping days that map onto an
+                already used 360_day date (5-6 per year); not allowed with
+                calendar='month_index', which has one step per month
+        default: 'aggregate'
+    - day (int): day of month used for monthly time stamps
+        default: 16
+
+    Outputs:
+    - (xarray): converted data
+    '''
+    if calendar == 'month_index' and frequency == 'day' and daily_method == 'remap':
+        raise ValueError("daily_method='remap' keeps daily steps, which can't be indexed by month; use daily_method='aggregate'")
+
+    source_calendar = data.time.encoding.get('calendar')
+    units = data.time.encoding.get('units', 'days since 1850-01-01')
+    if source_calendar == None:
+        source_calendar = getattr(data.time.values[0], 'calendar', 'proleptic_gregorian')
+
+    year, month, day_of_month, day_of_year = time_fields(data.time)
+    month_index = year * 12 + month - 1
+    bounds = data.time.attrs.get('bounds', 'time_bnds')
+    has_bounds = hasattr(data, 'data_vars') and bounds in data.variables
+    if has_bounds:
+        data = data.drop_vars(bounds)
+
+    if frequency == 'day' and daily_method == 'aggregate':
+        data = _aggregate_monthly(data, month_index)
+        month_index = data.time.values
+        year = month_index // 12
+        month = month_index % 12 + 1
+        frequency = 'mon'
+    elif frequency == 'day':
+        year_length = _year_length(year, source_calendar)
+        target_day_of_year = (day_of_year - 1) * 360 // year_length
+        target = (year - 1) * 360 + target_day_of_year
+        _, keep = np.unique(target, return_index=True)
+        data = data.isel(time=keep)
+        year = year[keep]
+        month = target_day_of_year[keep] // 30 + 1
+        day_of_month = target_day_of_year[keep] % 30 + 1
+        month_index = month_index[keep]
+
+    if calendar == 'month_index':
+        time = month_index
+        time_bounds = np.stack([month_index, month_index + 1], axis=-1)
+    else:
+        # Days since 0001-01-01 in the 360_day calendar
+        start = (year - 1) * 360 + (month - 1) * 30
+        if frequency == 'mon':
+            time, time_bounds = _dates_360(start, length=30, offset=day - 1)
+        else:
+            time, time_bounds = _dates_360(start + day_of_month - 1, length=1, offset=0)
+
+    time_attrs = dict(data.time.attrs)
+    data = data.assign_coords({ 'time': time })
+    data.time.attrs = time_attrs
+
+    if calendar == 'month_index':
+        # No units attribute, so the index isn't decoded as a date on read
+        data.time.attrs.pop('units', None)
+        data.time.attrs.pop('calendar', None)
+        data.time.attrs['long_name'] = 'month index (year * 12 + month - 1)'
+    else:
+        data.time.encoding['calendar'] = '360_day'
+        data.time.encoding['units'] = units
+
+    if has_bounds:
+        data[bounds] = (('time', 'bnds'), time_bounds)
+        data.time.attrs['bounds'] = bounds
+        if calendar != 'month_index':
+            data[bounds].encoding['calendar'] = '360_day'
+            data[bounds].encoding['units'] = units
+
+    return data
+
+
 def convert_to_360_day(i):
-    o = i.copy()
-    o_time = i.time.copy()
-    for i, time in enumerate(o_time.values):
-        o_time.values[i] = cftime.Datetime360Day(
-            time.year,
-            time.month,
-            16 #, has_year_zero=time.has_year_zero
-        )
+    '''
+    Function: convert_to_360_day()
+        Convert monthly data to the 360_day calendar, with each time stamp
+        set to the 16th of the month, see convert_calendar()
 
-    o = o.assign_coords({ 'time': o_time })
-    o.time.encoding['calendar'] = '360_day'
+    Inputs:
+    - i (xarray): monthly data
 
-    return o
+    Outputs:
+    - (xarray): converted data
+    '''
+    return convert_calendar(i, calendar='360_day', frequency='mon', day=16)
 
 
 def daterange_from_filename(filename):
@@ -91,6 +213,7 @@ def download_variable(
     Function: download_variable()
         Retrieve a CMIP6 model output variable from CEDA
         `https://esgf-index1.ceda.ac.uk/search/cmip6-ceda/`
+        Search responses are cached in a local catalog, see libs.catalog
 
     Inputs:
     (used in ceda query):
@@ -123,52 +246,25 @@ def download_variable(
     - save_to_local (bool): whether to download files to local
         default: False
     '''
-    base_url = 'https://esgf-index1.ceda.ac.uk/esg-search/search/'
-    #base_url = 'https://esgf-node.llnl.gov/esg-search/search/'
-    query = {
-        'experiment_id': experiment_id,
-        'format': 'application/solr+json',
-        'grid_label': grid_label,
-        'latest': 'true',
-        'limit': 20,
-        'mip_era': 'CMIP6',
-        'offset': 0,
-        'replica': 'false',
-        'source_id': source_id,
-        'type': 'Dataset',
-        'variable_id': variable_id
-    }
-    if frequency != None:
-        query['frequency'] = frequency
-
-    if table_id != None:
-        query['table_id'] = table_id
-
-    if variant_label != None:
-        query['variant_label'] = variant_label
+    query = esgf_query(
+        experiment_id,
+        source_id,
+        variable_id,
+        frequency=frequency,
+        grid_label=grid_label,
+        table_id=table_id,
+        variant_label=variant_label
+    )
+    headers = ESGF_HEADERS
 
-    # Set custom User-Agent headers
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11'
-    }
-    url = f'{base_url}?{urllib.parse.urlencode(query)}'
-    print('Requesting:')
-    print(f'-> {url}')
+    # Query via local catalog, which pages through all results and only
+    # makes a request if the query hasn't been cached within the ttl
     try:
-        req = urllib.request.Request(url, headers=headers)
-        response = urllib.request.urlopen(req)
-        if response.status < 200 or response.status > 299:
-            msg = '\n'.join([
-                f'An error occurred making request:',
-                f'-> URL: {url}',
-                f'-> Status code: {response.status}',
-            ])
-            raise ConnectionError(msg)
+        results = libs.catalog.search(query, headers=headers)
     except Exception as e:
         print('An error occurred during initial query', e, sep='\n')
         return
 
-    results = json.load(response)['response']['docs']
     if len(results) == 0:
         print('No results found')
         return
@@ -196,7 +292,7 @@ def download_variable(
         except Exception as e:
             print('An error occurred downloading remote files', e, sep='\n')
             print('Attempting to retrieve from local...')
-            local_filenames = get_local_files(item, item_local_path, time_slice)
+            local_filenames = get_local_files(item, item_local_path, ESGF_HEADERS, time_slice)
 
             if len(local_filenames) == 0:
                 print('None found, skipping.')
@@ -207,79 +303,28 @@ def download_variable(
 
         print('-> Processing:')
 
-        # Merge into temp file for further processing
-        # NB this uses ncrcat which preserves original compression
-        merged_file_path = merge_nc_files(local_filenames, f'{item_local_path}/_merged.nc')
-        print('   -> Merged')
-
-        # Open merged file
-        merged_array = xarray.open_mfdataset(
-            paths=merged_file_path,
-            combine='by_coords',
-            autoclose=True,
-            use_cftime=True
-        )
-
-        # Set time coord to 360_day and set encoding if merging and monthly data
-        if 'time' in merged_array:
-            if merged_array.time.encoding['calendar'] != '360_day' and frequency == 'mon':
-                merged_array = convert_to_360_day(merged_array)
-                print('   -> Converted calendar to 360_day')
-
-            # Select slice
-            merged_array = merged_array.sel(time=time_slice)
-
-        # Perform regridding
-        if regrid_kwargs != None:
-            merged_array = regrid(merged_array, **regrid_kwargs)
-            print('   -> Regridded')
-
-        # Generate new filename with updated date ranges
-        merged_array_dates = merged_array[variable_id].time.values
-        first_filename = str(local_filenames[0]).split('/')[-1]
-        filename_split = first_filename.split('_')[0:-1] # Remove date range
-        date_start = merged_array_dates[0].strftime('%Y%m')
-        date_end = merged_array_dates[-1].strftime('%Y%m')
-        filename_split.append(f'{date_start}-{date_end}') # Add new date range
-        combined_filename = '_'.join(filename_split) + '_processed.nc'
-        combined_path = Path(item_local_path, combined_filename)
-
-        if combined_path.exists() and not force_write:
-            # Cleanup & return
-            print('   -> Processed file already exists, skipping write')
-            merged_array.close()
-            Path(merged_file_path).unlink()
-            return combined_path
-
-        # Write to file
-        print(f'   -> Writing to {combined_path}')
-        write = merged_array.to_netcdf(
-            combined_path,
-            compute=False,
-            engine='netcdf4',
-            unlimited_dims=['time']
+        # Stream source files once: calendar conversion, time slice and
+        # regridding are applied lazily and the result is written compressed
+        return ingest(
+            local_filenames,
+            item_local_path,
+            variable_id,
+            force_write=force_write,
+            frequency=frequency,
+            regrid_kwargs=regrid_kwargs,
+            time_slice=time_slice
         )
-        with ProgressBar():
-            write.compute()
-
-        merged_array.close()
-        print('   -> Saved to disk')
-
-        # Finally, compress as to_netcdf() seems to produce large file sizes
-        combined_path, diff = compress_nc_file(combined_path, combined_path)
-        print(f'   -> Compressed (Savings: {diff})')
 
-        # Delete temporary _merged.nc
-        Path(merged_file_path).unlink()
 
-        return combined_path
-
-
-def download_remote_files(item, local_path, headers, time_slice=None):
+def download_remote_files(item, local_path, headers, time_slice=None, max_workers=4):
     '''
     Function: download_remote_files()
-        Downlaoad remote files based off CEDA response item
+        Download remote files based off CEDA response item
         `https://esgf-index1.ceda.ac.uk/search_files/{item_id}/{item_index_node}/`
+        Files are downloaded concurrently, partial downloads are resumed and
+        each file is verified against the checksum in the response,
+        see libs.download.download_files(). Downloaded files are added to the
+        local index (see libs.index)
 
     Inputs:
     - item (dict): item from array response['response']['docs'] from request
@@ -289,112 +334,373 @@ def download_remote_files(item, local_path, headers, time_slice=None):
     - time_slice (slice): filter files against time_slice before downloading
         e.g. slice('2015-01-01', '2101-01-01')
         default: None
+    - max_workers (int): maximum number of concurrent downloads
+        default: 4
 
     Outputs:
     - (array): array of local paths
     '''
-    item_id = item['id']
-    item_index_node = item['index_node']
-    url = f'https://esgf-index1.ceda.ac.uk/search_files/{item_id}/{item_index_node}/?limit=1000'
-    #url = f'https://esgf-node.llnl.gov/search_files/{item_id}/{item_index_node}/?limit=1000'
-    print(url)
-    req = urllib.request.Request(url, headers=headers)
-    response = urllib.request.urlopen(req)
-    if response.status < 200 or response.status > 299:
-        msg = '\n'.join([
-            f'An error occurred making request:',
-            f'-> URL: {url}',
-            f'-> Status code: {response.status}'
-        ])
-        raise ConnectionError(msg)
-
-    results = json.load(response)['response']['docs']
-    local_filenames = []
+    results = libs.catalog.search_files(item, headers=headers)
+    files = libs.download.files_from_search(
+        results,
+        time_slice=time_slice,
+        filter_daterange=lambda s, filename: test_date_bounds(s, *daterange_from_filename(filename))
+    )
 
-    for item in results:
-        file_url = [url.split('|')[0] for url in item['url'] if 'HTTPServer' in url]
-        if len(file_url) == 0:
-            continue
+    print(f'   -> Downloading {len(files)} files to {local_path}')
+    try:
+        return libs.download.download_files(
+            files,
+            local_path,
+            headers=headers,
+            max_workers=max_workers
+        )
+    finally:
+        # Index what was downloaded, even if some downloads failed, so
+        # get_local_files() finds them without re-indexing local_path
+        libs.index.add([str(Path(local_path, f['filename'])) for f in files])
 
-        file_url = file_url[0]
-        filename = urllib.parse.urlparse(file_url).path.split('/')[-1]
 
-        if time_slice != None:
-            date_out_of_bounds = test_date_bounds(
-                time_slice,
-                *daterange_from_filename(filename)
-            )
-            if date_out_of_bounds:
-                continue
+def esgf_query(
+    experiment_id,
+    source_id,
+    variable_id,
+    frequency=None,
+    grid_label='gn',
+    table_id=None,
+    variant_label=None
+):
+    '''
+    Function: esgf_query()
+        Build the ESGF dataset search query used by download_variable()
 
-        local_filename = Path(local_path, filename)
-        local_filename.parent.mkdir(parents=True, exist_ok=True)
-        local_filenames.append(str(local_filename))
+    Inputs:
+    - see download_variable()
 
-        if local_filename.exists():
-            print(f'   -> Already exists, skipping: {local_filename}')
-            continue
+    Outputs:
+    - (dict): query parameters for libs.catalog.search()
+    '''
+    query = {
+        'experiment_id': experiment_id,
+        'grid_label': grid_label,
+        'latest': 'true',
+        'mip_era': 'CMIP6',
+        'replica': 'false',
+        'source_id': source_id,
+        'type': 'Dataset',
+        'variable_id': variable_id
+    }
+    if frequency != None:
+        query['frequency'] = frequency
 
-        print(f'   -> Downloading:')
-        print(f'   -> {file_url}')
-        print(f'   -> {local_filename}')
-        file_response = urllib.request.urlretrieve(
-            file_url,
-            local_filename
-        )
+    if table_id != None:
+        query['table_id'] = table_id
 
-    return local_filenames
+    if variant_label != None:
+        query['variant_label'] = variant_label
+
+    return query
 
 
 def get_local_files(item, local_path, headers, time_slice=None):
-    filename = '_'.join([
-        item['variable_id'][0],
-        item['table_id'][0],
-        item['source_id'][0],
-        item['experiment_id'][0],
-        item['variant_label'][0],
-        item['grid_label'][0],
-        '*'
-    ]) + '.nc'
-
-    matches = [m for m in Path(local_path).glob(filename) if '_processed.nc' not in str(m)]
+    '''
+    Function: get_local_files()
+        Find previously downloaded (unprocessed) files of an ESGF dataset via
+        the local index (see libs.index). If none are indexed, only files of
+        the dataset in local_path are re-indexed.
+
+    Inputs:
+    - item (dict): dataset doc from libs.catalog.search()
+    - local_path (string): directory files were downloaded to
+    - headers (dict): request headers (unused, kept for compatibility)
+    - time_slice (slice): only include files overlapping time_slice
+        default: None
+
+    Outputs:
+    - (array): array of local paths, ordered by date
+    '''
+    facets = {
+        k: item[k][0]
+        for k in ['experiment_id', 'grid_label', 'source_id', 'table_id', 'variable_id', 'variant_label']
+    }
+    records = libs.index.lookup(kind='raw', **facets)
+    if len(records) == 0:
+        pattern = '{variable_id}_{table_id}_{source_id}_{experiment_id}_{variant_label}_{grid_label}_*.nc'.format(**facets)
+        libs.index.update([local_path], pattern=pattern)
+        records = libs.index.lookup(kind='raw', **facets)
+
     local_filenames = []
 
-    for m in matches:
+    for r in records:
         if time_slice != None:
             date_out_of_bounds = test_date_bounds(
                 time_slice,
-                *daterange_from_filename(filename)
+                datetime.strptime(str(r['date_start']), '%Y%m'),
+                datetime.strptime(str(r['date_end']), '%Y%m')
             )
             if date_out_of_bounds:
                 continue
 
-        local_filenames.append(str(m))
+        local_filenames.append(r['path'])
 
     return local_filenames
 
 
-def merge_nc_files(paths, output):
+def get_regridder(
+    data,
+    grid,
+    method='bilinear',
+    extrap_method=None,
+    cache_size=REGRIDDER_CACHE_SIZE,
+    weights_dir=REGRID_WEIGHTS_DIR
+):
     '''
-    Function merge_nc_files():
-        Merge .nc files using `ncrcat` via pynco,
-        which preserves original compression
-        See:
-            https://github.com/nco/pynco
-            http://nco.sourceforge.net/nco.html
+    Function: get_regridder()
+        Get an xesmf.Regridder, reusing weights where possible. Weights are
+        stored on disk keyed by a hash of the source grid coordinates, the
+        target grid coordinates, method and extrap_method, so they are shared
+        across variables, experiments and sessions. Loaded regridders are
+        also kept in an in-memory LRU cache.
 
     Inputs:
-        - paths (array): list of file paths to merge
-        - output (string): merged filepath to write to
+    - data (xarray): data on source grid
+    - grid (xarray): target grid
+    - method (string): xesmf regridding method, e.g. 'bilinear', 'nearest_s2d'
+        default: 'bilinear'
+    - extrap_method (string): xesmf extrapolation method, e.g. 'nearest_s2d'
+        default: None
+    - cache_size (int): maximum number of regridders kept in memory
+        default: REGRIDDER_CACHE_SIZE
+    - weights_dir (string): directory to store weights in
+        default: REGRID_WEIGHTS_DIR
 
-    Output:
-        - (string): merged filepath (same as output)
+    Outputs:
+    - (xesmf.Regridder)
     '''
-    nco = Nco()
-    nco.ncrcat(input=paths, output=output)
+    key = hashlib.sha1('_'.join([
+        grid_hash(data),
+        grid_hash(grid),
+        method,
+        str(extrap_method)
+    ]).encode()).hexdigest()
+
+    if key in _regridders:
+        _regridders.move_to_end(key)
+        return _regridders[key]
+
+    weights_path = Path(weights_dir, f'{method}_{key}.nc')
+    if weights_path.exists():
+        regridder = xesmf.Regridder(
+            data,
+            grid,
+            method=method,
+            extrap_method=extrap_method,
+            weights=str(weights_path)
+        )
+    else:
+        regridder = xesmf.Regridder(data, grid, method=method, extrap_method=extrap_method)
+
+        # Write to temporary file first, as other processes may be
+        # building the same weights
+        weights_path.parent.mkdir(parents=True, exist_ok=True)
+        weights_tmp = Path(weights_dir, f'{method}_{key}.{os.getpid()}.tmp.nc')
+        regridder.to_netcdf(str(weights_tmp))
+        weights_tmp.replace(weights_path)
+
+    _regridders[key] = regridder
+    while len(_regridders) > cache_size:
+        _regridders.popitem(last=False)
+
+    return regridder
+
+
+def grid_hash(data):
+    '''
+    Function: grid_hash()
+        Hash the horizontal grid coordinates (and bounds and mask, if
+        present) of data, i.e. the inputs xesmf uses to calculate regridding
+        weights. Coordinates are found as xesmf finds them: lat/lon, or
+        otherwise from CF attributes (e.g. nav_lat/nav_lon with
+        standard_name latitude/longitude)
+
+    Inputs:
+    - data (xarray): data on a grid xesmf can regrid
+
+    Outputs:
+    - (string): hex digest
+    '''
+    digest = hashlib.sha1()
+
+    for name, coord in _grid_coords(data).items():
+        values = np.ascontiguousarray(coord.values)
+        digest.update(name.encode())
+        digest.update(str(values.shape).encode())
+        digest.update(values.tobytes())
+
+    return digest.hexdigest()
+
+
+def ingest(
+    paths,
+    output_dir,
+    variable_id,
+    complevel=1,
+    force_write=False,
+    frequency=None,
+    regrid_kwargs=None,
+    time_chunk=12,
+    time_slice=None,
+    backend='netcdf'
+):
+    '''
+    Function: ingest()
+        Process source files in a single pass: the files are opened lazily,
+        the calendar is converted, the time slice selected and the data
+        regridded, then written once as a compressed, chunked netCDF4 file.
+        Replaces merging with ncrcat -> to_netcdf() -> compress_nc_file(),
+        which wrote every variable to disk three times.
+
+    Inputs:
+    - paths (array): source file paths
+    - output_dir (string): directory to write processed file to
+    - variable_id (string): variable, e.g. 'pr'
+    - complevel (int): zlib compression level, as `ncks -L`
+        default: 1
+    - force_write (bool): whether to overwrite an existing processed file
+        default: False
+    - frequency (string): frequency of data, e.g. 'mon'
+        default: None
+    - regrid_kwargs (dict): kwargs for regrid()
+        default: None
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+    - time_slice (slice): time slice to select
+        default: None
+    - backend (string): 'netcdf', or 'zarr' to write to a group of the
+        model's Zarr store instead (see libs.store)
+        default: 'netcdf'
+
+    Outputs:
+    - (Path): processed file path, or Zarr group path
+    '''
+    data = xarray.open_mfdataset(
+        paths=paths,
+        combine='by_coords',
+        autoclose=True,
+        use_cftime=True
+    )
+    data = process_merged(data, frequency, time_slice, regrid_kwargs)
+    output = write_ingested(
+        data,
+        paths[0],
+        output_dir,
+        variable_id,
+        backend=backend,
+        complevel=complevel,
+        force_write=force_write,
+        time_chunk=time_chunk
+    )
+    data.close()
+
     return output
 
 
+def ingest_encoding(data, complevel=1, time_chunk=12):
+    '''
+    Function: ingest_encoding()
+        Generate netCDF4 write encoding with zlib compression and chunking.
+        Encoding inherited from source files (chunksizes, original_shape,
+        compression) is discarded, since it no longer matches after
+        regridding.
+
+    Inputs:
+    - data (xarray.Dataset): data to be written
+    - complevel (int): zlib compression level
+        default: 1
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+
+    Outputs:
+    - (dict): encoding for data.to_netcdf()
+    '''
+    keep = ['_FillValue', 'calendar', 'dtype', 'units']
+    encoding = {}
+
+    for name, v in data.variables.items():
+        v_encoding = { k: v.encoding[k] for k in keep if k in v.encoding }
+
+        if name not in data.dims and v.ndim > 0 and v.dtype.kind in 'biuf':
+            v_encoding['zlib'] = True
+            v_encoding['complevel'] = complevel
+            v_encoding['shuffle'] = True
+            v_encoding['chunksizes'] = tuple(
+                min(time_chunk, size) if dim == 'time' else size
+                for dim, size in zip(v.dims, v.shape)
+            )
+
+        encoding[name] = v_encoding
+
+    return encoding
+
+
+def process_merged(data, frequency=None, time_slice=None, regrid_kwargs=None):
+    '''
+    Function: process_merged()
+        Convert calendar, select time slice and regrid merged model output
+
+    Inputs:
+    - data (xarray): merged model output
+    - frequency (string): frequency of data, e.g. 'mon'
+        default: None
+    - time_slice (slice): time slice to select
+        default: None
+    - regrid_kwargs (dict): kwargs for regrid()
+        default: None
+
+    Outputs:
+    - (xarray): processed data
+    '''
+    # Set time coord to 360_day and set encoding if merging monthly or daily data
+    if 'time' in data:
+        if data.time.encoding['calendar'] != '360_day' and frequency in ['mon', 'day']:
+            data = convert_calendar(data, '360_day', frequency=frequency, daily_method='remap')
+            print('   -> Converted calendar to 360_day')
+
+        # Select slice
+        if time_slice != None:
+            data = data.sel(time=time_slice)
+
+    # Perform regridding
+    if regrid_kwargs != None:
+        data = regrid(data, **regrid_kwargs)
+        print('   -> Regridded')
+
+    return data
+
+
+def processed_filename(source_filename, dates):
+    '''
+    Function: processed_filename()
+        Generate the processed filename for merged source files,
+        with the date range updated to the processed dates, e.g.
+        `pr_Amon_UKESM1-0-LL_ssp585_r2i1p1f2_gn_201501-210012_processed.nc`
+
+    Inputs:
+    - source_filename (string): path or filename of first source file
+    - dates (array): cftime dates of processed data
+
+    Outputs:
+    - (string): filename
+    '''
+    first_filename = str(source_filename).split('/')[-1]
+    filename_split = first_filename.split('_')[0:-1] # Remove date range
+    date_start = dates[0].strftime('%Y%m')
+    date_end = dates[-1].strftime('%Y%m')
+    filename_split.append(f'{date_start}-{date_end}') # Add new date range
+
+    return '_'.join(filename_split) + '_processed.nc'
+
+
 def regrid(
     data,
     grid=xesmf.util.grid_global(1.875, 1.25),
@@ -408,8 +714,8 @@ def regrid(
         if data.attrs['grid'] == grid.attrs['grid']:
             return data
 
-    # Perform regridding
-    regridder = xesmf.Regridder(data, grid, method=method, extrap_method=extrap_method)
+    # Perform regridding, reusing cached weights for this source/target grid
+    regridder = get_regridder(data, grid, method=method, extrap_method=extrap_method)
     data_regridded = regridder(data)
 
     # Re-add attributes from original data
@@ -436,12 +742,129 @@ def regrid(
 
     if save_file != None:
         write = data_regridded.to_netcdf(save_file, compute=False)
-        with ProgressBar():
+        with libs.execution.progress():
             write.compute()
 
     return data_regridded
 
 
+def write_ingested(
+    data,
+    source_path,
+    output_dir,
+    variable_id,
+    backend='netcdf',
+    complevel=1,
+    force_write=False,
+    time_chunk=12
+):
+    '''
+    Function: write_ingested()
+        Write processed data (see process_merged()) to its processed file,
+        named from the first source file and the dates of data, or to the
+        group of the model's Zarr store. Existing outputs are kept unless
+        force_write. Used by ingest() and libs.scheduler, so both write the
+        same outputs.
+
+    Inputs:
+    - data (xarray.Dataset): processed data
+    - source_path (string): path of the first source file
+    - output_dir (string): directory to write processed file to
+    - variable_id (string): variable, e.g. 'pr'
+    - backend (string): 'netcdf', or 'zarr' (see libs.store)
+        default: 'netcdf'
+    - complevel (int): zlib compression level of netCDF files
+        default: 1
+    - force_write (bool): whether to overwrite an existing output
+        default: False
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+
+    Outputs:
+    - (Path): processed file path, or Zarr group path
+    '''
+    output = Path(output_dir, processed_filename(source_path, data[variable_id].time.values))
+
+    if backend == 'zarr':
+        facets = libs.index.parse_filename(output)
+        store = libs.store.store_path(facets['source_id'], facets['variable_id'])
+        group = libs.store.group_name(facets['table_id'], facets['experiment_id'], facets['variant_label'], facets['grid_label'])
+        output = Path(store, group)
+
+    if output.exists() and not force_write:
+        print('   -> Processed file already exists, skipping write')
+        return output
+
+    print(f'   -> Writing to {output}')
+    if backend == 'zarr':
+        libs.store.write(data, store, group, time_chunk=time_chunk)
+    else:
+        write_processed(data, output, complevel=complevel, time_chunk=time_chunk)
+    print('   -> Saved to disk')
+
+    return output
+
+
+def write_processed(data, output, complevel=1, time_chunk=12):
+    '''
+    Function: write_processed()
+        Write processed data to a compressed, chunked netCDF4 file, with
+        compression set in the write encoding (see ingest_encoding()).
+        Data is written to a temporary file first, so an interrupted write
+        never leaves a partial processed file behind.
+
+    Inputs:
+    - data (xarray.Dataset): data to write
+    - output (string): file path to write to
+    - complevel (int): zlib compression level
+        default: 1
+    - time_chunk (int): number of time steps per chunk
+        default: 12
+
+    Outputs:
+    - (Path): file path (same as output)
+    '''
+    output = Path(output)
+    output_tmp = Path(f'{output}.tmp')
+    write = data.to_netcdf(
+        output_tmp,
+        compute=False,
+        encoding=ingest_encoding(data, complevel=complevel, time_chunk=time_chunk),
+        engine='netcdf4',
+        unlimited_dims=['time'] if 'time' in data.dims else None
+    )
+    with libs.execution.progress():
+        write.compute()
+
+    output_tmp.replace(output)
+    libs.index.add([output])
+
+    return output
+
+
+def time_fields(time):
+    '''
+    Function: time_fields()
+        Get the year, month, day of month and day of year of a time
+        coordinate as integer arrays, read from its (cftime or pandas) index
+        rather than from each date in turn
+
+    Inputs:
+    - time (xarray.DataArray): time coordinate
+
+    Outputs:
+    - (tuple): integer arrays (year, month, day, day_of_year)
+    '''
+    index = time.to_index()
+
+    return (
+        np.asarray(index.year),
+        np.asarray(index.month),
+        np.asarray(index.day),
+        np.asarray(index.dayofyear)
+    )
+
+
 def test_date_bounds(time_slice, test_start, test_stop):
     time_stop = datetime.strptime(time_slice.stop, '%Y-%m-%d')
     date_out_of_bounds = test_start < test_start
@@ -451,3 +874,101 @@ def test_date_bounds(time_slice, test_start, test_stop):
     time_start = datetime.strptime(time_slice.start, '%Y-%m-%d')
     date_out_of_bounds = time_start > test_stop
     return date_out_of_bounds
+
+
+def _aggregate_monthly(data, month_index):
+    # Months are contiguous runs along a sorted time axis, so in-memory
+    # variables are averaged with a single np.add.reduceat per variable.
+    # Dask-backed variables use groupby (which uses flox if installed)
+    starts = np.flatnonzero(np.diff(month_index, prepend=month_index[0] - 1) != 0)
+    months = month_index[starts]
+    is_dataset = hasattr(data, 'data_vars')
+    variables = data.data_vars if is_dataset else { data.name: data }
+    monthly = {}
+
+    for name, v in variables.items():
+        if 'time' not in v.dims:
+            continue
+
+        if v.chunks != None:
+            v_monthly = v.assign_coords({ 'time': month_index }).groupby('time').mean('time')
+            monthly[name] = v_monthly.transpose(*v.dims)
+            continue
+
+        axis = v.dims.index('time')
+        values = np.asarray(v.values, dtype=float)
+        valid = ~np.isnan(values)
+        total = np.add.reduceat(np.where(valid, values, 0), starts, axis=axis)
+        count = np.add.reduceat(valid, starts, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total / count, np.nan)
+
+        monthly[name] = xarray.DataArray(
+            mean,
+            dims=v.dims,
+            coords={ k: c for k, c in v.coords.items() if 'time' not in c.dims },
+            attrs=v.attrs,
+            name=name
+        ).assign_coords({ 'time': months })
+
+    if not is_dataset:
+        return monthly[data.name]
+
+    return xarray.merge([
+        xarray.Dataset(monthly, attrs=data.attrs),
+        data.drop_vars(list(monthly)).drop_dims('time', errors='ignore')
+    ])
+
+
+def _dates_360(start, length, offset):
+    # Each distinct date is only built once, and shared between the time
+    # stamps and the bounds (e.g. the end of one day is the start of the next)
+    days = np.unique(np.concatenate([start, start + length, start + offset]))
+    dates = cftime.num2date(days, 'days since 0001-01-01', '360_day')
+
+    def lookup(x):
+        return dates[np.searchsorted(days, x)]
+
+    return lookup(start + offset), np.stack([lookup(start), lookup(start + length)], axis=-1)
+
+
+def _year_length(year, calendar):
+    if calendar == '360_day':
+        return np.full(year.shape, 360)
+
+    if calendar in ['noleap', '365_day']:
+        return np.full(year.shape, 365)
+
+    if calendar in ['all_leap', '366_day']:
+        return np.full(year.shape, 366)
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    if calendar == 'julian':
+        leap = year % 4 == 0
+
+    return 365 + leap.astype(int)
+
+
+def _grid_coords(data):
+    # Horizontal grid coordinates of data, found as xesmf does
+    variables = data.variables if type(data) == xarray.Dataset else data.coords
+
+    if 'lat' in variables and 'lon' in variables:
+        coords = { 'lat': data['lat'], 'lon': data['lon'] }
+        bounds = { 'lat_b': 'lat_b', 'lon_b': 'lon_b' }
+    else:
+        try:
+            coords = { 'lat': data.cf['latitude'], 'lon': data.cf['longitude'] }
+        except (KeyError, AttributeError, ValueError):
+            raise ValueError('`data` should have lat/lon coordinates, or CF latitude/longitude coordinates, to regrid')
+
+        bounds = {
+            'lat_b': coords['lat'].attrs.get('bounds', 'vertices_latitude'),
+            'lon_b': coords['lon'].attrs.get('bounds', 'vertices_longitude')
+        }
+
+    for key, name in [*bounds.items(), ('mask', 'mask')]:
+        if name in variables:
+            coords[key] = data[name]
+
+    return coords
@@ -0,0 +1,52 @@
+from pathlib import Path
+import libs.synthetic
+import numpy as np
+import pytest
+import sys
+import xarray
+
+# Spawned worker processes (e.g. of libs.store.convert()) import libs from
+# the repository root, whatever the working directory of a test
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # Paths of libs.local, libs.index and libs.store are relative to the
+    # working directory
+    monkeypatch.chdir(tmp_path)
+
+    return tmp_path
+
+
+@pytest.fixture
+def write_processed():
+    def write(experiment_id, start, end, variable_id='pr', source_id='SYN-001'):
+        # A small processed file, written as libs.utils.write_processed()
+        # does: compressed, chunked by year, along an unlimited time axis
+        time, time_bnds = libs.synthetic.monthly_time(start, end)
+        values = np.arange(len(time) * 6, dtype=np.float32).reshape(len(time), 2, 3) + start * 100
+        data = xarray.Dataset(
+            {
+                variable_id: (('time', 'j', 'i'), values),
+                'time_bnds': (('time', 'bnds'), time_bnds)
+            },
+            coords={ 'time': ('time', time, { 'bounds': 'time_bnds' }) },
+            attrs={ 'experiment_id': experiment_id, 'source_id': source_id }
+        )
+        data.time.encoding['units'] = 'days since 1850-01-01'
+
+        path = Path(
+            '_data/cmip6', source_id, variable_id,
+            f'{variable_id}_Amon_{source_id}_{experiment_id}_r1i1p1f1_gn_{start}01-{end}12_processed.nc'
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data.to_netcdf(
+            path,
+            encoding={ variable_id: { 'chunksizes': (12, 2, 3), 'complevel': 1, 'zlib': True } },
+            unlimited_dims=['time']
+        )
+
+        return str(path)
+
+    return write
@@ -0,0 +1,46 @@
+import libs.analysis
+import numpy as np
+import pytest
+import xarray
+
+
+def _data(n_steps, dtype=np.float64):
+    rng = np.random.default_rng(0)
+    values = rng.normal(loc=5, size=(n_steps, 3, 2)).astype(dtype)
+    values[3, 1, 0] = np.nan
+    values[-10:, 2, 1] = np.nan
+
+    return xarray.DataArray(values, dims=('time', 'y', 'x'))
+
+
+@pytest.mark.parametrize('n_steps, window, min_periods, chunk', [
+    (120, 24, None, None),
+    (120, 24, None, 10),
+    (120, 25, 3, 7),
+    (120, 60, 1, 120),
+    (30, 60, None, 10),
+    (30, 60, 5, 10),
+    (100, 240, None, 100)
+])
+def test_smoothed_mean_matches_rolling(n_steps, window, min_periods, chunk):
+    data = _data(n_steps)
+    expected = data.rolling(time=window, center=True, min_periods=min_periods).mean()
+
+    smoothed = libs.analysis.smoothed_mean(
+        data.chunk(time=chunk) if chunk != None else data,
+        time=window,
+        min_periods=min_periods
+    )
+
+    assert smoothed.dims == data.dims
+    np.testing.assert_allclose(smoothed.values, expected.values, rtol=1e-12, atol=1e-12)
+
+
+def test_smoothed_mean_float32():
+    data = _data(240, np.float32)
+    expected = data.astype(np.float64).rolling(time=60, center=True).mean()
+
+    smoothed = libs.analysis.smoothed_mean(data, time=60)
+
+    assert smoothed.dtype == np.float32
+    np.testing.assert_allclose(smoothed.values, expected.values, rtol=1e-6)
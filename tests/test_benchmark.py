@@ -0,0 +1,54 @@
+from pathlib import Path
+import libs.benchmark
+import libs.synthetic
+import pytest
+
+REPO = Path(__file__).parents[1]
+
+
+@pytest.fixture
+def synthetic(tmp_path, monkeypatch):
+    def write(start, end):
+        # The NSIDC mask is regridded from the repository's copy
+        monkeypatch.chdir(REPO)
+        root = tmp_path / f'{start}-{end}'
+        libs.synthetic.write(root, members=1, variables=['pr'], start=start, end=end, shape=(30, 40), verbose=False)
+        monkeypatch.chdir(root)
+
+        return root
+
+    return write
+
+
+@pytest.mark.parametrize('start, end', [(1980, 2010), (2015, 2100), (2020, 2010)])
+def test_run_requires_both_experiments(start, end, tmp_path):
+    with pytest.raises(ValueError, match='historical'):
+        libs.benchmark.run(
+            cases=['convert_calendar'],
+            scales=[1],
+            root=tmp_path,
+            start=start,
+            end=end,
+            generate_data=False,
+            history_path=tmp_path / 'history.jsonl'
+        )
+
+
+def test_run_case_fails_without_members(synthetic):
+    synthetic(2000, 2010)
+    options = { 'climatology_period': ('2000-01-01', '2005-01-01'), 'sources': {} }
+
+    result = libs.benchmark._run_case('climatology_monthly', 1, options)
+
+    assert result['status'] == 'failed'
+    assert 'Loaded 0 of 1 members' in result['error']
+
+
+def test_run_case(synthetic):
+    synthetic(2010, 2020)
+    options = { 'climatology_period': ('2010-01-01', '2015-01-01'), 'sources': {} }
+
+    result = libs.benchmark._run_case('climatology_monthly', 1, options)
+
+    assert result['status'] == 'done'
+    assert result['seconds'] > 0
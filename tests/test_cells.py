@@ -0,0 +1,65 @@
+import libs.cells
+import libs.synthetic
+import numpy as np
+import pytest
+import xarray
+
+
+@pytest.fixture
+def grid(data_dir):
+    rng = np.random.default_rng(0)
+    shape = (8, 10)
+    coords = {
+        'latitude': (('j', 'i'), np.linspace(50, 90, shape[0])[:, None] * np.ones(shape)),
+        'longitude': (('j', 'i'), np.linspace(-180, 180, shape[1])[None, :] * np.ones(shape))
+    }
+
+    mask = rng.choice([0, 6, 8, 15], size=shape).astype(np.float64)
+    mask_path = data_dir / libs.cells.NSIDC_MASK_PATH
+    mask_path.parent.mkdir(parents=True)
+    xarray.Dataset(
+        { 'mask': (('j', 'i'), mask) },
+        coords=coords
+    ).to_netcdf(mask_path)
+
+    time, time_bnds = libs.synthetic.monthly_time(2000, 2001)
+    data = xarray.Dataset(
+        {
+            'pr': (('time', 'j', 'i'), rng.normal(size=(len(time),) + shape).astype(np.float32), { 'units': 'kg m-2 s-1' }),
+            'time_bnds': (('time', 'bnds'), time_bnds)
+        },
+        coords={ **coords, 'time': time },
+        attrs={ 'source_id': 'SYN-001' }
+    )
+    in_cells = (data.latitude > 60) & np.isin(mask, [6, 8, 15])
+
+    return { 'data': data, 'in_cells': in_cells }
+
+
+def test_pack_unpack_dataarray(grid):
+    data = grid['data'].pr
+    packed = libs.cells.pack(data)
+
+    assert packed.dims == ('time', 'cell')
+    assert packed.sizes['cell'] == int(grid['in_cells'].sum())
+
+    unpacked = libs.cells.unpack(packed)
+
+    assert unpacked.dims == data.dims
+    assert 'cell_index' not in unpacked.attrs
+    xarray.testing.assert_equal(unpacked.reset_coords(drop=True), data.where(grid['in_cells']).reset_coords(drop=True))
+
+
+@pytest.mark.parametrize('chunks', [None, { 'time': 5 }])
+def test_pack_unpack_dataset(grid, chunks):
+    data = grid['data'].chunk(chunks) if chunks != None else grid['data']
+    packed = libs.cells.pack(data)
+
+    unpacked = libs.cells.unpack(packed)
+
+    assert list(unpacked.data_vars) == ['pr', 'time_bnds']
+    assert unpacked.attrs == { 'source_id': 'SYN-001' }
+    assert unpacked.pr.attrs == { 'units': 'kg m-2 s-1' }
+    xarray.testing.assert_equal(unpacked.time_bnds, grid['data'].time_bnds)
+    xarray.testing.assert_equal(unpacked.pr.reset_coords(drop=True), grid['data'].pr.where(grid['in_cells']).reset_coords(drop=True))
+    np.testing.assert_equal(unpacked.latitude.values, grid['data'].latitude.values)
@@ -0,0 +1,91 @@
+import libs.comoments
+import numpy as np
+import pytest
+import xarray
+
+CLIMATOLOGY = slice('2000-01-01', '2005-01-01')
+
+
+def _data(seed, members=2, n_years=12):
+    rng = np.random.default_rng(seed)
+    time = xarray.date_range('2000-01-01', periods=n_years * 12, freq='MS', calendar='360_day', use_cftime=True)
+    values = rng.normal(size=(members, len(time), 3, 4)) + np.cos(np.arange(len(time)) / 6)[:, None, None]
+
+    # Missing steps, and a cell without a climatology
+    values[:, ::5, 0, 0] = np.nan
+    values[:, :61, 2, 3] = np.nan
+
+    return xarray.DataArray(
+        values,
+        dims=('member', 'time', 'j', 'i'),
+        coords={ 'member': ['a', 'b'][:members], 'time': time },
+        name=f'v{seed}'
+    )
+
+
+def _expected(data_a, data_b, period, division='season', correlation_period=None, lag=0):
+    # Previous method: correlation of anomalies from the climatology of one
+    # month/season
+    data_b = data_b.shift(time=-lag)
+    group_a = data_a.time[f'time.{division}']
+    group_b = data_b.time[f'time.{division}']
+    baseline_a = data_a.sel(time=CLIMATOLOGY).where(group_a == period).mean('time')
+    baseline_b = data_b.sel(time=CLIMATOLOGY).where(group_a == period).mean('time')
+    item_a = data_a.where(group_a == period) - baseline_a
+    item_b = data_b.where(group_a == period) - baseline_b
+
+    if correlation_period != None:
+        item_a = item_a.sel(time=correlation_period)
+        item_b = item_b.sel(time=correlation_period)
+
+    return xarray.corr(item_a, item_b, dim='time')
+
+
+def _correlation(data_a, data_b, **kwargs):
+    return libs.comoments.correlation(
+        libs.comoments.accumulate(data_a, data_b, climatology_period=CLIMATOLOGY, **kwargs)
+    )
+
+
+@pytest.mark.parametrize('chunks', [None, { 'time': 25, 'i': 2 }])
+def test_correlation_matches_anomaly_corr(chunks):
+    data_a, data_b = _data(0), _data(1)
+    if chunks != None:
+        data_a, data_b = data_a.chunk(chunks), data_b.chunk(chunks)
+
+    corr = _correlation(data_a, data_b, division='season')
+
+    assert list(corr.season.values) == ['DJF', 'JJA', 'MAM', 'SON']
+    for season in corr.season.values:
+        expected = _expected(_data(0), _data(1), season).transpose(*corr.sel(season=season).dims)
+        np.testing.assert_allclose(corr.sel(season=season).values, expected.values, rtol=1e-10)
+
+    assert corr.isel(j=2, i=3).isnull().all()
+
+
+def test_correlation_month_period_lag():
+    data_a, data_b = _data(0), _data(1)
+    period = slice('2003-01-01', '2011-01-01')
+
+    corr = _correlation(data_a, data_b.chunk(time=30), division='month', correlation_period=period, lag=2)
+
+    assert corr.attrs['lag'] == 2
+    for month in [1, 6, 12]:
+        expected = _expected(data_a, data_b, month, 'month', period, lag=2)
+        np.testing.assert_allclose(
+            corr.sel(month=month).values,
+            expected.transpose(*corr.sel(month=month).dims).values,
+            rtol=1e-10
+        )
+
+
+def test_correlation_variables():
+    data_a, data_b, data_c = _data(0), _data(1), _data(2)
+
+    corr = _correlation(data_a, [data_b, data_c], division='season')
+
+    assert list(corr['variable'].values) == ['v1', 'v2']
+    xarray.testing.assert_allclose(
+        corr.sel(variable='v2', drop=True),
+        _correlation(data_a, data_c, division='season')
+    )
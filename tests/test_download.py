@@ -0,0 +1,175 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import libs.download
+import pytest
+import threading
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+
+        start = 0
+        if self.headers.get('Range') != None:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        partial = start > 0
+        if partial and server.bad_ranges > 0:
+            # e.g. a proxy replying with the whole file as a 206
+            server.bad_ranges -= 1
+            start = 0
+
+        body = CONTENT[start:]
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Length', str(len(body)))
+        if partial:
+            self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+        self.end_headers()
+
+        if server.drops > 0:
+            # Drop the connection part way through the body
+            server.drops -= 1
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.requests = []
+    httpd.bad_ranges = 0
+    httpd.drops = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    yield httpd
+
+    libs.download.close_connections()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server, filename='file.nc'):
+    return f'http://127.0.0.1:{server.server_address[1]}/{filename}'
+
+
+def _item(server, filename='file.nc', checksum=hashlib.sha256(CONTENT).hexdigest()):
+    return {
+        'checksum': checksum,
+        'checksum_type': 'SHA256',
+        'filename': filename,
+        'size': len(CONTENT),
+        'url': _url(server, filename)
+    }
+
+
+def test_download_file_resumes_dropped_connection(server, tmp_path):
+    server.drops = 1
+    path = tmp_path / 'file.nc'
+
+    record = libs.download.download_file(
+        _url(server),
+        path,
+        checksum=hashlib.sha256(CONTENT).hexdigest(),
+        size=len(CONTENT),
+        block_size=4096
+    )
+
+    assert path.read_bytes() == CONTENT
+    assert not (tmp_path / 'file.nc.part').exists()
+    assert record['status'] == 'verified'
+    assert server.requests == [None, f'bytes={len(CONTENT) // 3}-']
+
+
+def test_download_file_resumes_existing_part(server, tmp_path):
+    path = tmp_path / 'file.nc'
+    (tmp_path / 'file.nc.part').write_bytes(CONTENT[:1000])
+
+    libs.download.download_file(_url(server), path, checksum=hashlib.sha256(CONTENT).hexdigest())
+
+    assert path.read_bytes() == CONTENT
+    assert server.requests == ['bytes=1000-']
+
+
+def test_download_file_restarts_unexpected_range(server, tmp_path):
+    server.bad_ranges = 1
+    path = tmp_path / 'file.nc'
+    (tmp_path / 'file.nc.part').write_bytes(CONTENT[:1000])
+
+    # Without a checksum or size, so only the Content-Range check applies
+    libs.download.download_file(_url(server), path)
+
+    assert path.read_bytes() == CONTENT
+    assert server.requests == ['bytes=1000-', None]
+
+
+def test_download_file_checksum_mismatch(server, tmp_path):
+    path = tmp_path / 'file.nc'
+
+    with pytest.raises(ConnectionError, match='Checksum mismatch'):
+        libs.download.download_file(_url(server), path, checksum='0' * 64, retries=2)
+
+    assert not path.exists()
+    assert not (tmp_path / 'file.nc.part').exists()
+    assert server.requests == [None, None]
+
+
+def test_download_files_manifest(server, tmp_path):
+    items = [_item(server, 'a.nc'), _item(server, 'b.nc', checksum=None)]
+
+    paths = libs.download.download_files(items, tmp_path, verbose=False)
+    manifest = libs.download.read_manifest(tmp_path)
+
+    assert paths == [str(tmp_path / 'a.nc'), str(tmp_path / 'b.nc')]
+    assert manifest['a.nc']['status'] == 'verified'
+    assert manifest['a.nc']['checksum'] == items[0]['checksum']
+    assert manifest['b.nc']['status'] == 'unverified'
+    assert manifest['b.nc']['size'] == len(CONTENT)
+
+    # Downloaded files are skipped
+    libs.download.download_files(items, tmp_path, verbose=False)
+    assert len(server.requests) == 2
+
+
+def test_download_files_replaces_partial_file(server, tmp_path):
+    # e.g. left by urlretrieve, with no checksum to verify against
+    (tmp_path / 'a.nc').write_bytes(CONTENT[:1000])
+    item = _item(server, 'a.nc', checksum=None)
+
+    assert not libs.download.is_downloaded(tmp_path / 'a.nc', item)
+
+    libs.download.download_files([item], tmp_path, verbose=False)
+    assert (tmp_path / 'a.nc').read_bytes() == CONTENT
+
+
+def test_download_files_closes_connections(server, tmp_path, monkeypatch):
+    connections = []
+    get_connection = libs.download._get_connection
+    monkeypatch.setattr(
+        libs.download,
+        '_get_connection',
+        lambda *args: connections.append(get_connection(*args)) or connections[-1]
+    )
+    items = [_item(server, f'{k}.nc') for k in 'abcdef']
+
+    libs.download.download_files(items, tmp_path, max_workers=3, verbose=False)
+
+    assert len(connections) == len(items)
+    assert all(conn.sock == None for conn in connections)
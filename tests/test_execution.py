@@ -0,0 +1,61 @@
+from dask.diagnostics import ProgressBar
+import dask
+import dask.array
+import libs.execution
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def default_scheduler():
+    yield
+
+    libs.execution.shutdown()
+
+
+@pytest.mark.parametrize('component, chunks', [
+    ('Amon', { 'time': 240 }),
+    ('Ofx', {}),
+    ('Omon', { 'time': 120 }),
+    ('SImon', { 'time': 120 }),
+    ('obs', { 'time': 120 }),
+    ('series', { 'time': -1 }),
+    ('Lmon', libs.execution.DEFAULT_CHUNKS)
+])
+def test_chunks_for(component, chunks):
+    assert libs.execution.chunks_for(component) == chunks
+
+    # A copy, so callers can change it
+    libs.execution.chunks_for(component)['time'] = 1
+    assert libs.execution.chunks_for(component) == chunks
+
+
+@pytest.mark.parametrize('backend', ['threads', 'processes'])
+def test_setup_local(backend):
+    default = dask.config.get('scheduler', None)
+
+    assert libs.execution.setup(backend, n_workers=2) == None
+    assert dask.config.get('scheduler') == backend
+    assert dask.config.get('num_workers') == 2
+    assert libs.execution.client() == None
+    assert type(libs.execution.progress()) == ProgressBar
+    assert int(dask.array.ones(10, chunks=2).sum().compute()) == 10
+
+    libs.execution.shutdown()
+
+    assert dask.config.get('scheduler', None) == default
+    assert dask.config.get('num_workers', None) == None
+
+
+def test_setup_restores_after_repeated_calls():
+    with dask.config.set(scheduler='sync'):
+        libs.execution.setup('processes')
+        libs.execution.setup('threads', n_workers=3)
+        assert dask.config.get('scheduler') == 'threads'
+
+        libs.execution.shutdown()
+        assert dask.config.get('scheduler') == 'sync'
+
+
+def test_setup_unknown_backend():
+    with pytest.raises(ValueError, match='backend'):
+        libs.execution.setup('mpi')
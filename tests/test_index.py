@@ -0,0 +1,55 @@
+from pathlib import Path
+import libs.index
+
+
+def _record(start, end):
+    return { 'date_end': end, 'date_start': start, 'path': f'{start}-{end}.nc' }
+
+
+def _paths(records):
+    return [r['path'] for r in records]
+
+
+def test_cover_range():
+    records = [_record(198001, 199912), _record(200001, 201412), _record(198001, 201412)]
+
+    assert _paths(libs.index.cover(records, 198001, 201412)) == ['198001-201412.nc']
+    assert _paths(libs.index.cover(records, 200001, 201412)) == ['198001-201412.nc']
+    assert libs.index.cover(records, 197001, 201412) == []
+
+
+def test_cover_split_files():
+    records = [_record(201501, 204912), _record(205001, 210012)]
+
+    assert _paths(libs.index.cover(records)) == ['201501-204912.nc', '205001-210012.nc']
+    assert _paths(libs.index.cover(records, 205001, 206012)) == ['205001-210012.nc']
+
+
+def test_cover_ignores_files_before_gap():
+    # e.g. a leftover file of an earlier period
+    records = [_record(190001, 195012), _record(198001, 201412)]
+
+    assert _paths(libs.index.cover(records)) == ['198001-201412.nc']
+    assert libs.index.cover(records, 190001, 201412) == []
+
+
+def test_cover_contiguous_through_overlaps():
+    records = [_record(190001, 195012), _record(194001, 198512), _record(198001, 201412)]
+
+    assert _paths(libs.index.cover(records)) == ['190001-195012.nc', '194001-198512.nc', '198001-201412.nc']
+
+
+def test_update_pattern(data_dir, write_processed):
+    pr = write_processed('ssp585', 2015, 2020)
+    tas = write_processed('ssp585', 2015, 2020, variable_id='tas')
+    libs.index.update()
+    Path(pr).unlink()
+    Path(tas).unlink()
+    pr_new = write_processed('historical', 1980, 2014)
+
+    counts = libs.index.update(['_data/cmip6/SYN-001/pr'], pattern='pr_Amon_SYN-001_*.nc')
+
+    assert counts == { 'added': 1, 'removed': 1, 'unchanged': 0, 'updated': 0 }
+    assert _paths(libs.index.lookup(variable_id='pr')) == [pr_new]
+    # Records outside the pattern are left as they were
+    assert _paths(libs.index.lookup(variable_id='tas')) == [tas]
@@ -0,0 +1,66 @@
+import libs.index
+import libs.local
+
+
+def _years(data):
+    return int(data.time.dt.year[0]), int(data.time.dt.year[-1])
+
+
+def _get(**kwargs):
+    return libs.local.get_data('Amon', 'ssp585', 'SYN-001', 'pr', 'r1i1p1f1', **kwargs)
+
+
+def test_get_data_default_ranges(data_dir, write_processed):
+    write_processed('historical', 1980, 2014)
+    write_processed('ssp585', 2015, 2100)
+
+    assert _years(_get()) == (2015, 2100)
+    assert _years(_get(include_hist=True)) == (1980, 2100)
+    assert _years(_get(include_hist=True, date_range=('205001', '210012'))) == (1980, 2100)
+    assert _get(date_range=('205001', '210012')).time.size == 51 * 12
+
+
+def test_get_data_ignores_files_before_gap(data_dir, write_processed):
+    write_processed('historical', 1900, 1950)
+    write_processed('historical', 1980, 2014)
+    write_processed('ssp585', 2015, 2100)
+
+    data = _get(include_hist=True)
+    assert _years(data) == (1980, 2100)
+    assert int(data.pr.isel(time=0, j=0, i=0)) == 198000
+
+
+def test_get_data_trims_longer_files(data_dir, write_processed):
+    write_processed('historical', 1850, 2014)
+    write_processed('ssp585', 2015, 2100)
+
+    assert _years(_get(include_hist=True)) == (1980, 2100)
+
+
+def test_get_data_newest_contiguous_dates(data_dir, write_processed):
+    # Files not covering the DATE_RANGES range of the experiment
+    write_processed('historical', 1950, 1960)
+    write_processed('historical', 2005, 2014)
+    write_processed('ssp585', 2015, 2030)
+
+    assert _years(_get(include_hist=True)) == (2005, 2030)
+
+
+def test_get_data_missing_range(data_dir, write_processed):
+    write_processed('ssp585', 2015, 2100)
+
+    assert _get(date_range=('201001', '210012')) == None
+
+
+def test_get_data_indexes_new_files(data_dir, write_processed, monkeypatch):
+    write_processed('ssp585', 2015, 2100)
+    assert _years(_get()) == (2015, 2100)
+
+    # Only files of the requested model run are re-indexed on a miss
+    updates = []
+    update = libs.index.update
+    monkeypatch.setattr(libs.index, 'update', lambda *args, **kwargs: updates.append(kwargs) or update(*args, **kwargs))
+    write_processed('historical', 1980, 2014)
+
+    assert _years(_get(include_hist=True)) == (1980, 2100)
+    assert updates == [{ 'pattern': 'pr_Amon_SYN-001_*_r1i1p1f1_gn*.nc' }]
@@ -0,0 +1,80 @@
+import importlib
+import libs.analysis
+import libs.memo
+import numpy as np
+import os
+import pytest
+import sys
+import xarray
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(libs.memo, 'CACHE_DIR', str(tmp_path / '_memo'))
+    libs.memo.clear()
+
+    yield tmp_path / '_memo'
+
+    libs.memo.clear()
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    # Package whose memoized function calls into a sibling module
+    root = tmp_path / 'src'
+    (root / 'memopkg').mkdir(parents=True)
+    (root / 'memopkg' / '__init__.py').write_text('')
+    (root / 'memopkg' / 'helpers.py').write_text('def scale(data):\n    return data * 2\n')
+    (root / 'memopkg' / 'analysis.py').write_text(
+        'import libs.memo\n'
+        'import memopkg.helpers\n\n'
+        '@libs.memo.memoize\n'
+        'def doubled(data):\n'
+        '    return memopkg.helpers.scale(data)\n'
+    )
+    monkeypatch.syspath_prepend(str(root))
+
+    yield root
+
+    for name in [m for m in sys.modules if m.startswith('memopkg')]:
+        del sys.modules[name]
+
+
+def _data():
+    return xarray.DataArray(np.arange(12.0).reshape(4, 3), dims=('time', 'x'), name='pr').chunk(time=2)
+
+
+def test_memoize_hits(cache_dir):
+    data = _data().assign_coords(time=xarray.date_range('2000-01-01', periods=4, freq='MS', use_cftime=True))
+
+    first = libs.analysis.calendar_division_mean(data, 'JAN')
+    second = libs.analysis.calendar_division_mean(data.copy(), 'JAN')
+
+    xarray.testing.assert_identical(first, second)
+    assert libs.memo.stats()['hits'] == 1
+    assert libs.memo.stats()['misses'] == 1
+    assert list(cache_dir.glob('*.tmp')) == []
+
+
+def test_code_files_include_callees():
+    files = libs.memo._code_files(libs.analysis.correlation_clim.__wrapped__)
+
+    assert libs.analysis.__file__ in files
+    assert sys.modules['libs.comoments'].__file__ in files
+
+
+def test_callee_change_invalidates(cache_dir, package):
+    import memopkg.analysis
+
+    assert (memopkg.analysis.doubled(_data()) == _data() * 2).all()
+    assert libs.memo.stats()['misses'] == 1
+
+    # Same bytes of the memoized function, different callee
+    helpers = package / 'memopkg' / 'helpers.py'
+    helpers.write_text('def scale(data):\n    return data * 3\n')
+    os.utime(helpers, (0, 0))
+    importlib.reload(sys.modules['memopkg.helpers'])
+
+    assert (memopkg.analysis.doubled(_data()) == _data() * 3).all()
+    assert libs.memo.stats()['misses'] == 2
+    assert libs.memo.stats()['hits'] == 0
@@ -0,0 +1,87 @@
+import libs.plot
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+import xarray
+
+matplotlib.use('Agg')
+
+
+@pytest.fixture(autouse=True)
+def stereo_cache(monkeypatch):
+    # Coastlines are read from Natural Earth, which may need downloading
+    monkeypatch.setattr(libs.plot, '_stereo_coastlines', lambda: [np.array([[0.0, 0.0], [1e5, 1e5]])])
+    libs.plot._stereo_cache.clear()
+
+    yield libs.plot._stereo_cache
+
+    libs.plot._stereo_cache.clear()
+    plt.close('all')
+
+
+def _data(offset=0):
+    j, i = np.meshgrid(np.arange(12), np.arange(16), indexing='ij')
+    values = np.sin(i / 3) * 40 + j * 5 + offset
+    values[0, 0] = np.nan
+
+    return xarray.DataArray(
+        values,
+        dims=('j', 'i'),
+        coords={
+            'latitude': (('j', 'i'), 40 + j * 4.5),
+            'longitude': (('j', 'i'), -180 + i * 22.5)
+        }
+    )
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    { 'robust': True },
+    { 'cmap': 'PuBu_r', 'levels': 11, 'vmin': 0, 'vmax': 100 },
+    { 'cmap': 'RdBu_r', 'levels': 21, 'vmin': -1, 'vmax': 1, 'extend': 'neither' },
+    { 'levels': 7 },
+    { 'levels': [-20, 0, 10, 40] },
+    { 'center': 30 },
+    { 'vmin': 10 }
+])
+def test_stereo_colors_match_xarray(kwargs):
+    data = _data(-30)
+    values = data.values
+
+    expected = data.plot.pcolormesh(x='longitude', y='latitude', add_colorbar=False, **kwargs)
+    colors = libs.plot._stereo_colors(values, kwargs)
+    mesh = matplotlib.cm.ScalarMappable(colors['norm'], colors['cmap'])
+    if colors['norm'] == None:
+        mesh.set_clim(colors['vmin'], colors['vmax'])
+
+    finite = np.isfinite(values)
+    # Discrete colors are taken from the colormap by BoundaryNorm, rather
+    # than resampled, so may differ by one of its 256 colors
+    np.testing.assert_allclose(mesh.to_rgba(values)[finite], expected.to_rgba(values)[finite], atol=0.03)
+
+
+def test_stereo_mesh_transposed():
+    data = _data()
+    kwargs = { 'vmin': 0, 'vmax': 100 }
+
+    panel = libs.plot._stereo_panel(data, kwargs)
+    panel_transposed = libs.plot._stereo_panel(data.transpose('i', 'j'), kwargs)
+
+    assert panel['mesh']['crop'] == { 'j': slice(4, 12) }
+    assert panel['values'].shape == (8, 16)
+    np.testing.assert_array_equal(panel_transposed['values'], panel['values'])
+    np.testing.assert_array_equal(panel['values'], np.ma.masked_invalid(data.values[4:]))
+
+
+def test_nstereo_decorations_cached(monkeypatch, stereo_cache):
+    calls = []
+    monkeypatch.setattr(libs.plot, '_stereo_coastlines', lambda: calls.append(1) or [np.array([[0.0, 0.0], [1e5, 1e5]])])
+    arr = [{ 'data': _data(k), 'label': f'{k}' } for k in [0, 10, 20]]
+
+    fig, subfigs = libs.plot.nstereo(arr, 'title', { 'cmap': 'PuBu', 'vmin': 0, 'vmax': 100 })
+    libs.plot.nstereo(arr, 'title', { 'cmap': 'PuBu', 'vmin': 0, 'vmax': 100 })
+
+    assert len(calls) == 1
+    assert len(subfigs) == 3
+    assert len(subfigs[0].axes.collections) == 3
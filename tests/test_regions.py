@@ -0,0 +1,99 @@
+import libs.cells
+import libs.ensemble
+import libs.regions
+import libs.vars
+import numpy as np
+import pytest
+import xarray
+
+
+@pytest.fixture
+def grid(data_dir):
+    rng = np.random.default_rng(0)
+    shape = (8, 10)
+    latitude = np.linspace(50, 90, shape[0])[:, None] * np.ones(shape)
+    longitude = np.linspace(-180, 180, shape[1])[None, :] * np.ones(shape)
+    coords = {
+        'latitude': (('j', 'i'), latitude),
+        'longitude': (('j', 'i'), longitude)
+    }
+
+    # At the default path, as read by libs.ensemble.time_series_regional()
+    mask_path = data_dir / libs.cells.NSIDC_MASK_PATH
+    mask_path.parent.mkdir(parents=True)
+    xarray.Dataset(
+        { 'mask': (('j', 'i'), rng.choice([0, 6, 7, 8, 9, 10, 11, 12, 13, 15], size=shape).astype(np.float64)) },
+        coords=coords
+    ).to_netcdf(mask_path)
+
+    weight = xarray.DataArray(rng.uniform(1, 2, size=shape), dims=('j', 'i'), coords=coords, name='areacello')
+    weight[0, 0] = np.nan
+
+    values = rng.normal(size=(2, 24) + shape)
+    values[:, :, 5, 5] = np.nan
+    values[:, 3] = np.nan
+    data = xarray.DataArray(values, dims=('member', 'time', 'j', 'i'), coords=coords, name='pr')
+
+    return { 'data': data, 'mask_path': str(mask_path), 'weight': weight.fillna(0) }
+
+
+def _expected(grid, region, method):
+    with xarray.open_dataset(grid['mask_path']) as mask:
+        in_region = np.isin(mask.mask.values, region['values'])
+
+    data = grid['data'].where(grid['data'].latitude > 60).where(in_region)
+    weighted = data.weighted(grid['weight'])
+
+    return getattr(weighted, method)(('j', 'i'), skipna=True)
+
+
+@pytest.mark.parametrize('method', ['mean', 'sum'])
+@pytest.mark.parametrize('chunks', [None, { 'time': 5, 'j': 4 }])
+def test_reduce_matches_weighted(grid, method, chunks):
+    matrix = libs.regions.weight_matrix(grid['weight'], mask_path=grid['mask_path'])
+    data = grid['data'].chunk(chunks) if chunks != None else grid['data']
+
+    reduced = libs.regions.reduce(data, matrix, method=method)
+
+    assert reduced.dims == ('member', 'time', 'region')
+    for region in libs.vars.nsidc_regions():
+        np.testing.assert_allclose(
+            reduced.sel(region=region['label']).values,
+            _expected(grid, region, method).values,
+            rtol=1e-12,
+            atol=1e-12
+        )
+
+
+def test_reduce_packed(grid):
+    index = libs.cells.cell_index(grid['weight'].latitude, grid['weight'].longitude, mask_path=grid['mask_path'])
+    weight = libs.cells.pack(grid['weight'], index)
+    matrix = libs.regions.weight_matrix(weight, mask_path=grid['mask_path'])
+
+    reduced = libs.regions.reduce(libs.cells.pack(grid['data'], index), matrix)
+
+    for region in libs.vars.nsidc_regions():
+        np.testing.assert_allclose(
+            reduced.sel(region=region['label']).values,
+            _expected(grid, region, 'mean').values,
+            rtol=1e-12
+        )
+
+
+def test_time_series_regional(grid):
+    process = lambda data: data * 2
+    reduced = libs.ensemble.time_series_regional(grid['data'], grid['weight'], 'mean', process, statistics=['raw'])['raw']
+
+    for region in libs.vars.nsidc_regions()[:3]:
+        with xarray.open_dataset(grid['mask_path']) as mask:
+            in_region = np.isin(mask.mask.values, region['values'])
+
+        data = grid['data'].where(grid['data'].latitude > 60).where(in_region)
+        expected = libs.ensemble.time_series_weighted(data, grid['weight'], 'mean', process, statistics=['raw'])['raw']
+
+        xarray.testing.assert_allclose(reduced.sel(region=region['label'], drop=True), expected.drop_vars('region', errors='ignore'))
+
+
+def test_reduce_method():
+    with pytest.raises(ValueError, match='method'):
+        libs.regions.reduce(xarray.DataArray([1.0]), { 'dims': (), 'matrix': None }, method='max')
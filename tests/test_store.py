@@ -0,0 +1,39 @@
+import libs.local
+import libs.store
+import xarray
+
+
+def _get(backend, **kwargs):
+    return libs.local.get_data('Amon', 'ssp585', 'SYN-001', 'pr', 'r1i1p1f1', backend=backend, **kwargs)
+
+
+def test_convert_round_trip(data_dir, write_processed):
+    paths = [write_processed('historical', 1980, 2014), write_processed('ssp585', 2015, 2040)]
+    libs.store.convert(paths, max_workers=1, region_size=60)
+
+    netcdf = _get('netcdf', include_hist=True)
+    zarr = _get('zarr', include_hist=True)
+
+    assert zarr.time.size == (2040 - 1980 + 1) * 12
+    xarray.testing.assert_identical(netcdf.load(), zarr.load())
+
+
+def test_date_range_same_for_backends(data_dir, write_processed):
+    paths = [write_processed('historical', 1970, 2014), write_processed('ssp585', 2015, 2040)]
+    libs.store.convert(paths, max_workers=1)
+
+    for kwargs in [
+        { 'include_hist': True },
+        { 'include_hist': True, 'date_range': ('202001', '203012') },
+        { 'date_range': ('202001', '203012') }
+    ]:
+        netcdf = _get('netcdf', **kwargs)
+        zarr = _get('zarr', **kwargs)
+        xarray.testing.assert_identical(netcdf.load(), zarr.load())
+
+    # Historical data is joined over its own dates
+    data = _get('zarr', include_hist=True, date_range=('202001', '203012'))
+    assert int(data.time.dt.year[0]) == 1980
+
+    assert _get('netcdf', date_range=('201001', '203012')) == None
+    assert _get('zarr', date_range=('201001', '203012')) == None
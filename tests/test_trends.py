@@ -0,0 +1,65 @@
+import libs.trends
+import numpy as np
+import pytest
+import scipy.stats
+import xarray
+
+
+def _data(seed=0, n_years=12):
+    rng = np.random.default_rng(seed)
+    time = xarray.date_range('2000-01-01', periods=n_years * 12, freq='MS', calendar='noleap', use_cftime=True)
+    values = rng.normal(size=(len(time), 3, 4)) + np.linspace(0, 5, len(time))[:, None, None]
+    values[::7, 0, 0] = np.nan
+
+    return xarray.DataArray(
+        values,
+        dims=('time', 'y', 'x'),
+        coords={ 'time': time, 'y': np.arange(3) * 100.0, 'x': np.arange(4) * 100.0 }
+    )
+
+
+def _years(time):
+    years = np.array([t.year + (t.month - 1) / 12 for t in time.values])
+    return years - years[0]
+
+
+@pytest.mark.parametrize('chunks', [None, { 'time': 50, 'x': 2 }])
+def test_fit_matches_scipy_with_xy_dims(chunks):
+    data = _data()
+    trends = libs.trends.fit(data.chunk(chunks) if chunks != None else data, mann_kendall=True, per_years=1)
+    steps = _years(data.time)
+
+    for j in range(3):
+        for i in range(4):
+            values = data.isel(y=j, x=i).values
+            valid = ~np.isnan(values)
+            expected = scipy.stats.linregress(steps[valid], values[valid])
+            cell = trends.isel(y=j, x=i)
+
+            assert cell['count'] == valid.sum()
+            assert np.isclose(cell.slope, expected.slope)
+            assert np.isclose(cell.intercept, expected.intercept)
+            assert np.isclose(cell.stderr, expected.stderr)
+            assert np.isclose(cell.pvalue, expected.pvalue)
+            assert np.isclose(cell.sen_slope, scipy.stats.theilslopes(values[valid], steps[valid]).slope)
+
+
+def test_fit_division_month():
+    data = _data()
+    trends = libs.trends.fit(data, division='month', per_years=10)
+    steps = _years(data.time) / 10
+
+    assert trends.slope.dims == ('month', 'y', 'x')
+    for month in [1, 7]:
+        values = data.isel(y=1, x=2).values[data.time.dt.month == month]
+        expected = scipy.stats.linregress(steps[data.time.dt.month == month], values)
+
+        assert np.isclose(trends.slope.sel(month=month).isel(y=1, x=2), expected.slope)
+
+
+def test_fit_member_agreement():
+    data = xarray.concat([_data(seed) for seed in range(4)], dim='member')
+    data[3] = -data[3]
+    trends = libs.trends.fit(data)
+
+    assert np.allclose(trends.agreement, 0.75)
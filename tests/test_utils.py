@@ -0,0 +1,84 @@
+from pathlib import Path
+import libs.store
+import libs.synthetic
+import numpy as np
+import pytest
+import xarray
+
+# libs.utils needs xesmf (and ESMF) and nco
+utils = pytest.importorskip('libs.utils')
+
+
+def _nemo_grid(offset=0):
+    # Curvilinear grid with CF coordinates named as in NEMO output
+    lat, lon = np.meshgrid(np.linspace(50, 89, 30) + offset, np.linspace(0, 359, 40), indexing='ij')
+
+    return xarray.Dataset(coords={
+        'nav_lat': (('y', 'x'), lat, { 'standard_name': 'latitude', 'units': 'degrees_north' }),
+        'nav_lon': (('y', 'x'), lon, { 'standard_name': 'longitude', 'units': 'degrees_east' })
+    })
+
+
+def test_grid_hash_cf_coordinates():
+    assert utils.grid_hash(_nemo_grid()) == utils.grid_hash(_nemo_grid())
+    assert utils.grid_hash(_nemo_grid()) != utils.grid_hash(_nemo_grid(0.5))
+
+
+def test_grid_hash_lat_lon():
+    grid = xarray.Dataset(coords={ 'lat': np.arange(-89.5, 90), 'lon': np.arange(0.5, 360) })
+    data = xarray.DataArray(np.zeros((180, 360)), dims=('lat', 'lon'), coords=grid.coords)
+
+    assert utils.grid_hash(grid) == utils.grid_hash(data)
+    assert utils.grid_hash(grid) != utils.grid_hash(grid.assign_coords(lat=grid.lat + 0.25))
+
+
+def test_grid_hash_without_coordinates():
+    with pytest.raises(ValueError):
+        utils.grid_hash(xarray.Dataset(coords={ 'y': np.arange(3), 'x': np.arange(4) }))
+
+
+def _processed(start=2015, end=2016):
+    time, time_bnds = libs.synthetic.monthly_time(start, end)
+
+    return xarray.Dataset(
+        {
+            'pr': (('time', 'j', 'i'), np.ones((len(time), 2, 3), dtype=np.float32)),
+            'time_bnds': (('time', 'bnds'), time_bnds)
+        },
+        coords={ 'time': time }
+    )
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_write_ingested(data_dir, backend):
+    source_path = '_data/cmip6/SYN-001/pr/pr_Amon_SYN-001_ssp585_r1i1p1f1_gn_201501-201612.nc'
+    output_dir = Path(source_path).parent
+    output_dir.mkdir(parents=True)
+
+    output = utils.write_ingested(_processed(), source_path, output_dir, 'pr', backend=backend)
+
+    if backend == 'zarr':
+        assert output == Path(libs.store.store_path('SYN-001', 'pr'), 'Amon_ssp585_r1i1p1f1_gn')
+    else:
+        assert output == output_dir / 'pr_Amon_SYN-001_ssp585_r1i1p1f1_gn_201501-201612_processed.nc'
+    assert output.exists()
+
+    # Existing outputs are kept
+    mtime = output.stat().st_mtime
+    assert utils.write_ingested(_processed(), source_path, output_dir, 'pr', backend=backend) == output
+    assert output.stat().st_mtime == mtime
+
+
+def _daily(start=2000, end=2001):
+    time = xarray.date_range(f'{start}-01-01', f'{end}-12-31', freq='D', calendar='noleap', use_cftime=True)
+
+    return xarray.DataArray(np.arange(len(time), dtype=float), dims='time', coords={ 'time': time }, name='pr')
+
+
+def test_convert_calendar_daily_month_index():
+    converted = utils.convert_calendar(_daily(), calendar='month_index', frequency='day')
+
+    assert list(converted.time.values) == list(range(2000 * 12, 2002 * 12))
+    assert converted.values[0] == 15
+    with pytest.raises(ValueError, match='remap'):
+        utils.convert_calendar(_daily(), calendar='month_index', frequency='day', daily_method='remap')